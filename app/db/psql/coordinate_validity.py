@@ -0,0 +1,26 @@
+import argparse
+from sqlalchemy import text
+from app.db.psql.database import engine
+from app.db.psql.models import Location
+from app.db.psql.models.location import VALID_COORDINATES_SQL
+
+
+def ensure_coordinate_validity():
+    # Brings a locations table created before valid_coordinates existed up to the model.
+    # Postgres computes the flag for every row while adding the column and keeps it up to
+    # date on insert/update, so ingest never sets it and requests never recompute it.
+    with engine.begin() as connection:
+        connection.execute(text(f"""
+            ALTER TABLE locations ADD COLUMN IF NOT EXISTS valid_coordinates boolean NOT NULL
+            GENERATED ALWAYS AS ({VALID_COORDINATES_SQL}) STORED
+        """))
+        for index in Location.__table__.indexes:
+            index.create(connection, checkfirst=True)
+        connection.execute(text("ANALYZE locations"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add the coordinate validity column and its partial indexes")
+    parser.parse_args()
+    ensure_coordinate_validity()
+    print("locations.valid_coordinates and its partial indexes are in place")
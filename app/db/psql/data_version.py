@@ -0,0 +1,33 @@
+import os
+import time
+from threading import Lock
+from app.db.psql.database import engine
+from app.repository.backends import backend
+
+DATA_VERSION_TTL = float(os.getenv("DATA_VERSION_TTL", "5"))
+TRACKED_TABLES = [
+    'events', 'casualties', 'locations', 'regions', 'countries', 'cities',
+    'attack_types', 'target_types', 'terrorist_group'
+]
+
+_lock = Lock()
+_state = {'version': None, 'checked_at': 0.0}
+
+
+def fetch_data_version() -> str:
+    with engine.connect() as connection:
+        return backend.data_version(connection, TRACKED_TABLES)
+
+
+def get_data_version() -> str:
+    with _lock:
+        now = time.monotonic()
+        if _state['version'] is None or now - _state['checked_at'] > DATA_VERSION_TTL:
+            _state['version'] = fetch_data_version()
+            _state['checked_at'] = now
+        return _state['version']
+
+
+def invalidate_data_version():
+    with _lock:
+        _state['version'] = None
@@ -1,10 +1,189 @@
+import itertools
 import os
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+from threading import Lock, Thread
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
 
 load_dotenv(verbose=True)
 db_url = os.getenv("PSQL_URL")
+# postgres, or duckdb to serve a read-only file exported by app.repository.backends
+REPOSITORY_BACKEND = os.getenv("REPOSITORY_BACKEND", "postgres")
+DUCKDB_PATH = os.getenv("DUCKDB_PATH", "stats.duckdb")
+replica_urls = [url.strip() for url in os.getenv("PSQL_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_HEALTH_INTERVAL = float(os.getenv("PSQL_REPLICA_HEALTH_INTERVAL", "10"))
+REPLICA_MAX_LAG = float(os.getenv("PSQL_REPLICA_MAX_LAG")) if os.getenv("PSQL_REPLICA_MAX_LAG") else None
+REPLICA_REQUIRE_DATA_VERSION = os.getenv("PSQL_REPLICA_REQUIRE_DATA_VERSION", "false").lower() == "true"
+# seconds a health probe waits for a replica to accept the connection and answer
+REPLICA_PROBE_TIMEOUT = int(os.getenv("PSQL_REPLICA_PROBE_TIMEOUT", "2"))
+# compiled SQL kept per engine; every shape of every repo query should fit
+SQL_COMPILED_CACHE_SIZE = int(os.getenv("SQL_COMPILED_CACHE_SIZE", "1000"))
+# psycopg 3 (postgresql+psycopg://) prepares a statement server-side once a connection ran
+# it this many times; empty disables it, as a transaction-pooling pgbouncer requires
+PSQL_PREPARE_THRESHOLD = os.getenv("PSQL_PREPARE_THRESHOLD", "5")
 
-engine = create_engine(db_url)
-session_maker = sessionmaker(bind=engine)
+
+def engine_options(url) -> dict:
+    options = {'query_cache_size': SQL_COMPILED_CACHE_SIZE}
+    if make_url(url).drivername == 'postgresql+psycopg':
+        options['connect_args'] = {
+            'prepare_threshold': int(PSQL_PREPARE_THRESHOLD) if PSQL_PREPARE_THRESHOLD else None
+        }
+    return options
+
+
+def replica_engine_options(url) -> dict:
+    options = engine_options(url)
+    options['connect_args'] = {**options.get('connect_args', {}), 'connect_timeout': REPLICA_PROBE_TIMEOUT}
+    return options
+
+
+if REPOSITORY_BACKEND == 'duckdb':
+    engine = create_engine(f"duckdb:///{DUCKDB_PATH}", connect_args={'read_only': True},
+                           query_cache_size=SQL_COMPILED_CACHE_SIZE)
+    replica_urls = []
+else:
+    engine = create_engine(db_url, **engine_options(db_url))
+replica_engines = [create_engine(url, pool_pre_ping=True, **replica_engine_options(url)) for url in replica_urls]
+
+
+class ReplicaSet:
+    # Round-robins reads over the replicas that passed their last health check. A replica
+    # is unhealthy when it is unreachable, replays WAL more than max_lag seconds behind,
+    # or (optionally) has not yet replayed the newest event of the current data version.
+    # With no healthy replica every read fails over to the primary. Probes run in the
+    # background, one at a time per replica, so a request never waits on a slow replica;
+    # until its first probe has answered a replica is not used.
+    def __init__(self, primary, replicas, interval, max_lag=None, require_data_version=False):
+        self.primary = primary
+        self.replicas = replicas
+        self.interval = interval
+        self.max_lag = max_lag
+        self.require_data_version = require_data_version
+        self._health = {replica: (False, 0.0) for replica in replicas}
+        self._cycle = itertools.cycle(replicas)
+        self._probing = set()
+        self._lock = Lock()
+
+    def check(self, replica) -> bool:
+        try:
+            with replica.connect() as connection:
+                connection.execute(text("SELECT set_config('statement_timeout', :timeout, true)"),
+                                   {'timeout': str(REPLICA_PROBE_TIMEOUT * 1000)})
+                lag = connection.execute(text("""
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() THEN 0
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+                    END
+                """)).scalar()
+                if self.max_lag is not None and lag > self.max_lag:
+                    return False
+                if self.require_data_version:
+                    from app.db.psql.data_version import get_data_version
+                    newest_event = int(get_data_version().split('.')[0])
+                    replayed = connection.execute(text("SELECT coalesce(max(id), 0) FROM events")).scalar()
+                    return replayed >= newest_event
+                return True
+        except SQLAlchemyError:
+            return False
+
+    def is_healthy(self, replica) -> bool:
+        # The last probe's answer; an outdated one starts a new probe but is still returned
+        healthy, checked_at = self._health[replica]
+        if time.monotonic() - checked_at > self.interval:
+            self._probe_in_background(replica)
+        return healthy
+
+    def _probe_in_background(self, replica):
+        with self._lock:
+            if replica in self._probing:
+                return
+            self._probing.add(replica)
+        Thread(target=self._probe, args=(replica,), name='replica-probe', daemon=True).start()
+
+    def _probe(self, replica):
+        try:
+            self._health[replica] = (self.check(replica), time.monotonic())
+        finally:
+            with self._lock:
+                self._probing.discard(replica)
+
+    def _reset_after_fork(self):
+        # probes running in the parent did not survive the fork
+        self._probing = set()
+        self._lock = Lock()
+
+    def mark_unhealthy(self, replica):
+        if replica in self._health:
+            self._health[replica] = (False, time.monotonic())
+
+    def choose(self):
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = next(self._cycle)
+            if self.is_healthy(replica):
+                return replica
+        return self.primary
+
+    def status(self):
+        return [
+            {'url': replica.url.render_as_string(hide_password=True), 'healthy': healthy}
+            for replica, (healthy, _) in self._health.items()
+        ]
+
+
+replica_set = ReplicaSet(engine, replica_engines, REPLICA_HEALTH_INTERVAL,
+                         REPLICA_MAX_LAG, REPLICA_REQUIRE_DATA_VERSION)
+os.register_at_fork(after_in_child=replica_set._reset_after_fork)
+
+for _replica in replica_engines:
+    @event.listens_for(_replica, "handle_error")
+    def _on_replica_error(context, replica=_replica):
+        if context.is_disconnect:
+            replica_set.mark_unhealthy(replica)
+
+
+class RoutingSession(Session):
+    # Reads go to one replica picked when the session first needs a connection, so a
+    # session sees a single consistent server; flushes and DML always use the primary
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            return engine
+        if not hasattr(self, '_read_engine'):
+            self._read_engine = replica_set.choose()
+        return self._read_engine
+
+
+# Set for the duration of a batch request: every session opened meanwhile is the batch's
+# snapshot session, so all of its endpoints read the same data
+shared_session: ContextVar = ContextVar('shared_session', default=None)
+
+
+class SharingSessionMaker(sessionmaker):
+    def __call__(self, **local_kw):
+        shared = shared_session.get()
+        if shared is not None:
+            return nullcontext(shared)
+        return super().__call__(**local_kw)
+
+
+session_maker = SharingSessionMaker(bind=engine, class_=RoutingSession)
+
+# Absolute time.monotonic() deadline for the statements of the current request
+statement_deadline: ContextVar = ContextVar('statement_deadline', default=None)
+
+
+@event.listens_for(RoutingSession, "after_begin")
+def _apply_statement_deadline(session, transaction, connection):
+    deadline = statement_deadline.get()
+    if deadline is not None and connection.dialect.name == 'postgresql':
+        remaining_ms = max(1, int((deadline - time.monotonic()) * 1000))
+        connection.execute(text("SELECT set_config('statement_timeout', :timeout, true)"),
+                           {'timeout': str(remaining_ms)})
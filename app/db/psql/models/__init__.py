@@ -11,3 +11,4 @@ from .city import City
 from .country import Country
 from .region import Region
 from .terrorist_group import TerroristGroup
+from .group_coparticipation import GroupCoparticipation, GroupCoparticipationState
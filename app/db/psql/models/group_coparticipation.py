@@ -0,0 +1,15 @@
+from sqlalchemy import Column, Integer, String, ForeignKey
+from app.db.psql.models import Base
+
+class GroupCoparticipation(Base):
+    __tablename__ = 'group_coparticipation'
+
+    group_a_id = Column(Integer, ForeignKey('terrorist_group.id'), primary_key=True)
+    group_b_id = Column(Integer, ForeignKey('terrorist_group.id'), primary_key=True)
+    shared_events = Column(Integer, nullable=False)
+
+class GroupCoparticipationState(Base):
+    __tablename__ = 'group_coparticipation_state'
+
+    id = Column(Integer, primary_key=True)
+    data_version = Column(String, nullable=False)
@@ -1,7 +1,14 @@
-from sqlalchemy import Column, Integer, Float, ForeignKey
+from sqlalchemy import Column, Integer, Float, Boolean, ForeignKey, Computed, Index
 from sqlalchemy.orm import relationship
 from app.db.psql.models import Base
 
+# Coordinates a map can place: both present, in range and not the 0/0 placeholder.
+# NaN compares greater than every number in Postgres, so it fails the range checks.
+VALID_COORDINATES_SQL = (
+    "coalesce(latitude BETWEEN -90 AND 90 AND longitude BETWEEN -180 AND 180 "
+    "AND latitude <> 0 AND longitude <> 0, false)"
+)
+
 class Location(Base):
     __tablename__ = 'locations'
 
@@ -11,9 +18,22 @@ class Location(Base):
     country_id = Column(Integer, ForeignKey('countries.id'), nullable=True)
     city_id = Column(Integer, ForeignKey('cities.id'), nullable=True)
     region_id = Column(Integer, ForeignKey('regions.id'), nullable=True)
+    # Computed once when a row is written; see ensure_coordinate_validity for existing tables
+    valid_coordinates = Column(Boolean, Computed(VALID_COORDINATES_SQL, persisted=True), nullable=False)
 
     # Relationships with explicit foreign_keys
     event = relationship("Event", back_populates="location", uselist=False)
     country = relationship("Country", back_populates="location", uselist=False)
     city = relationship("City", back_populates="location", uselist=False)
-    region = relationship("Region", back_populates="location", uselist=False)
\ No newline at end of file
+    region = relationship("Region", back_populates="location", uselist=False)
+
+    # Partial indexes over mappable rows only, covering the coordinates so map queries
+    # can be answered from the index
+    __table_args__ = (
+        Index('ix_locations_valid', 'id', postgresql_include=['latitude', 'longitude'],
+              postgresql_where=valid_coordinates),
+        Index('ix_locations_valid_region', 'region_id', postgresql_include=['latitude', 'longitude'],
+              postgresql_where=valid_coordinates),
+        Index('ix_locations_valid_country', 'country_id', postgresql_include=['latitude', 'longitude'],
+              postgresql_where=valid_coordinates),
+    )
@@ -0,0 +1,51 @@
+import importlib
+import threading
+from typing import Callable, Dict, List, Optional
+
+FAMILIES = ('data', 'charts', 'maps')
+
+
+class LazyModule:
+    # Stands in for a heavy module and imports it on first attribute access, so importing
+    # the service layer does not pay for matplotlib/folium/pandas until an endpoint needs them
+    def __init__(self, name: str, family: str, before: Optional[Callable[[], None]] = None):
+        self._name = name
+        self._family = family
+        self._before = before
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    if self._before:
+                        self._before()
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({self._family}, {state})>"
+
+
+_registry: Dict[str, List[LazyModule]] = {family: [] for family in FAMILIES}
+
+
+def lazy_import(name: str, family: str, before: Optional[Callable[[], None]] = None) -> LazyModule:
+    module = LazyModule(name, family, before)
+    _registry[family].append(module)
+    return module
+
+
+def use_agg_backend():
+    importlib.import_module('matplotlib').use('Agg')
+
+
+def warm_up_imports(families=FAMILIES):
+    for family in families:
+        for module in _registry[family]:
+            module.load()
@@ -1,10 +1,16 @@
 from flask import Flask
 from app.rout.psql_routs import stats_blueprint
+from app.rout.job_routs import jobs_blueprint
+from app.rout.batch_routs import batch_blueprint
+from app.rout.export_routs import export_blueprint
 from flask_cors import CORS
 
 app = Flask(__name__)
 CORS(app)
 app.register_blueprint(stats_blueprint,url_prefix='/sql_stats')
+app.register_blueprint(jobs_blueprint,url_prefix='/sql_stats/jobs')
+app.register_blueprint(batch_blueprint,url_prefix='/sql_stats/batch')
+app.register_blueprint(export_blueprint,url_prefix='/sql_stats/export')
 
 if __name__ == "__main__":
     print("Starting SQL Flask Server")
@@ -0,0 +1,43 @@
+import os
+import resource
+from contextvars import ContextVar
+from typing import Optional
+
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0"))
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# RSS at the start of the current request, set while accounting or a budget is enabled
+request_rss: ContextVar = ContextVar('request_rss', default=None)
+
+
+class MemoryBudgetExceeded(Exception):
+    def __init__(self, grown: int, stage: str):
+        super().__init__(f"Request grew the worker by {grown / 2 ** 20:.0f} MB at {stage}, "
+                         f"over the {MEMORY_BUDGET_MB:.0f} MB budget")
+        self.grown = grown
+        self.stage = stage
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return max_rss_bytes()
+
+
+def max_rss_bytes() -> int:
+    # high-water mark of the process; ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def check_memory_budget(stage: str, start: Optional[int] = None):
+    # Called between the big allocation steps (decoded results, frames, figures, pages).
+    # RSS is per process, so concurrent requests share the growth they cause; the budget
+    # is a guard against one request taking the worker down, not exact attribution.
+    start = request_rss.get() if start is None else start
+    if start is None or not MEMORY_BUDGET_MB:
+        return
+    grown = rss_bytes() - start
+    if grown > MEMORY_BUDGET_MB * 2 ** 20:
+        raise MemoryBudgetExceeded(grown, stage)
@@ -0,0 +1,120 @@
+import math
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Iterable, Optional
+from sqlalchemy import event
+from app.db.psql.database import RoutingSession
+
+APPROX_SAMPLE_PERCENT = float(os.getenv("APPROX_SAMPLE_PERCENT", "5"))
+# A fixed REPEATABLE seed keeps an approximate answer stable between requests, so it can be
+# cached and revalidated like an exact one
+APPROX_SEED = int(os.getenv("APPROX_SEED", "8200"))
+Z_95 = 1.96
+# label suffix of the sum of squares selected next to each sampled sum
+SQUARES_SUFFIX = '__squares'
+
+
+class Approximation:
+    # Set for a request that asked for approx=true. event_query keeps each event with
+    # probability percent/100 (a Bernoulli sample) and scales counts and sums by
+    # 100/percent. The error bound is that of the least certain figure a response is
+    # built from: counts from the smallest sampled count, sums from their sampled values'
+    # sum of squares. Sketch-based distinct counts add their own (fixed) error.
+    def __init__(self, percent: float = APPROX_SAMPLE_PERCENT, seed: int = APPROX_SEED):
+        self.percent = percent
+        self.seed = seed
+        self.used = False
+        self.count_labels = set()
+        self.sum_labels = set()
+        self.min_sampled = None
+        self.sum_error = 0.0
+        self.sketch_error = 0.0
+        self._lock = Lock()
+
+    @property
+    def fraction(self) -> float:
+        return self.percent / 100
+
+    @property
+    def scale(self) -> float:
+        return 100 / self.percent
+
+    def observe(self, estimates: Iterable):
+        sampled = [value * self.fraction for value in estimates if value]
+        if sampled:
+            with self._lock:
+                smallest = min(sampled)
+                self.min_sampled = smallest if self.min_sampled is None else min(self.min_sampled, smallest)
+
+    def observe_sums(self, estimates: Iterable, squares: Iterable):
+        # 95% relative error of a Horvitz-Thompson sum: its variance is estimated by
+        # (1 - p) / p^2 times the sampled sum of squares
+        errors = [
+            Z_95 * math.sqrt((1 - self.fraction) * float(square)) / (float(estimate) * self.fraction)
+            for estimate, square in zip(estimates, squares) if estimate and square is not None
+        ]
+        if errors:
+            with self._lock:
+                self.sum_error = max(self.sum_error, max(errors))
+
+    def observe_sketch(self, relative_error: float):
+        with self._lock:
+            self.used = True
+            self.sketch_error = max(self.sketch_error, Z_95 * relative_error)
+
+    def error_bound(self) -> Optional[float]:
+        # None when the estimates were read without passing through observe
+        bounds = [error for error in (self.sketch_error, self.sum_error) if error]
+        if self.min_sampled is not None:
+            # a Horvitz-Thompson count estimated from n sampled events
+            bounds.append(Z_95 * math.sqrt((1 - self.fraction) / max(self.min_sampled, 1)))
+        return max(bounds, default=None)
+
+
+approximation: ContextVar = ContextVar('approximation', default=None)
+
+
+@contextmanager
+def exactly():
+    # Runs the enclosed queries on all rows even inside an approximate request
+    token = approximation.set(None)
+    try:
+        yield
+    finally:
+        approximation.reset(token)
+
+
+def observe_columns(columns):
+    sample = approximation.get()
+    if sample is not None:
+        for label in sample.count_labels & columns.keys():
+            sample.observe(columns[label])
+        for label in sample.sum_labels & columns.keys():
+            # absent when the rows were fetched through the session, which observed them
+            if label + SQUARES_SUFFIX in columns:
+                sample.observe_sums(columns[label], columns.pop(label + SQUARES_SUFFIX))
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def _observe_estimates(orm_execute_state):
+    sample = approximation.get()
+    labels = sample.count_labels | sample.sum_labels if sample is not None else ()
+    if not labels or not orm_execute_state.is_select:
+        return None
+    result = orm_execute_state.invoke_statement()
+    keys = list(result.keys())
+    if not labels & set(keys):
+        return result
+    rows = result.freeze()
+    data = rows.data
+    for i, key in enumerate(keys):
+        if key in sample.count_labels:
+            sample.observe(row[i] for row in data)
+        elif key in sample.sum_labels and key + SQUARES_SUFFIX in keys:
+            square = keys.index(key + SQUARES_SUFFIX)
+            sample.observe_sums([row[i] for row in data], [row[square] for row in data])
+    result = rows()
+    hidden = [i for i, key in enumerate(keys) if key.endswith(SQUARES_SUFFIX)]
+    return result.columns(*(i for i in range(len(keys)) if i not in hidden)) if hidden else result
@@ -0,0 +1,161 @@
+import argparse
+import os
+from typing import Dict
+from sqlalchemy import BigInteger, Float, cast, func, text
+from app.db.psql.database import DUCKDB_PATH, engine
+from app.repository.approximation import observe_columns
+from app.repository.columnar import binary_statement, fetch_columns as copy_fetch_columns, numeric_array
+from app.lazy_modules import lazy_import
+from app.memory_budget import check_memory_budget
+
+np = lazy_import('numpy', 'data')
+pd = lazy_import('pandas', 'data')
+duckdb = lazy_import('duckdb', 'data')
+
+# An event is sampled when the low bits of its hash fall in the first percent of buckets
+SAMPLE_BUCKETS = 1 << 20
+
+
+def sample_threshold(percent: float) -> int:
+    return round(percent / 100 * SAMPLE_BUCKETS)
+
+
+class PostgresBackend:
+    name = 'postgresql'
+    # persisting the co-participation index and the batch savepoints/temp tables need writes
+    writable = True
+
+    def fetch_columns(self, session, query) -> Dict[str, object]:
+        columns = copy_fetch_columns(session, query)
+        observe_columns(columns)
+        return columns
+
+    def width_bucket(self, column, low, high, bins):
+        return func.width_bucket(cast(column, Float), float(low), float(high), bins)
+
+    def sample_condition(self, event_id, percent: float, seed: int):
+        # A seeded hash of the id keeps each event independently with the given
+        # probability, as TABLESAMPLE BERNOULLI would, but as a WHERE condition that needs
+        # no change to the FROM clause
+        return func.hashint8extended(cast(event_id, BigInteger), seed).op('&')(SAMPLE_BUCKETS - 1) < \
+            sample_threshold(percent)
+
+    def data_version(self, connection, tables) -> str:
+        # max(events.id) is answered from the primary key index, the pg_stat counters
+        # change on every insert/update/delete so edits to existing rows are seen too
+        max_event_id = connection.execute(text("SELECT coalesce(max(id), 0) FROM events")).scalar()
+        changes = connection.execute(
+            text("""
+                SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0)
+                FROM pg_stat_user_tables
+                WHERE relname = ANY(:tables)
+            """),
+            {'tables': tables}
+        ).scalar()
+        return f"{max_event_id}.{changes}"
+
+
+class DuckDBBackend:
+    # A read-only DuckDB file exported from Postgres (see export_to_duckdb). It speaks the
+    # same SQL for everything the repos use except width_bucket, has no statement timeout
+    # (deadlines do not fire) and cannot persist the co-participation index, which is
+    # exported with the data instead.
+    name = 'duckdb'
+    writable = False
+
+    def fetch_columns(self, session, query) -> Dict[str, object]:
+        statement, _ = binary_statement(query.statement if hasattr(query, 'statement') else query)
+        connection = session.connection()
+        sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+        cursor = connection.connection.dbapi_connection.cursor()
+        cursor.execute(sql)
+        columns = cursor.fetchnumpy()
+        check_memory_budget('result transfer')
+        columns = {name: self._normalize(values) for name, values in columns.items()}
+        observe_columns(columns)
+        return columns
+
+    @staticmethod
+    def _normalize(values):
+        # Shape results like the Postgres COPY path: NaN for missing floats, object arrays
+        # for nullable ints, lists for text and text lists, numeric lists as numeric_array
+        if isinstance(values, np.ma.MaskedArray):
+            if values.dtype.kind == 'f':
+                return values.filled(np.nan)
+            if values.dtype.kind in 'iu' and values.mask.any():
+                return np.array([None if masked else int(v) for v, masked in zip(values.data, values.mask)],
+                                dtype=object)
+            values = values.data if values.dtype.kind in 'iu' else values.astype(object).filled(None)
+        if values.dtype.kind in 'iu':
+            return values.astype(np.int64)
+        if values.dtype.kind == 'f':
+            return values.astype(np.float64)
+        return [
+            # list rows arrive as (masked) arrays, whose tolist() gives None for NULL elements
+            (numeric_array(row.tolist(), row.dtype.kind in 'iu') if row.dtype.kind in 'iuf' else row.tolist())
+            if isinstance(row, np.ndarray) else row
+            for row in values.tolist()
+        ]
+
+    def width_bucket(self, column, low, high, bins):
+        # width_bucket for the [low, high) range, computed arithmetically
+        position = (cast(column, Float) - float(low)) * bins / (float(high) - float(low))
+        return cast(func.floor(position), BigInteger) + 1
+
+    def sample_condition(self, event_id, percent: float, seed: int):
+        return func.hash(event_id, seed).op('&')(SAMPLE_BUCKETS - 1) < sample_threshold(percent)
+
+    def data_version(self, connection, tables) -> str:
+        # the file is only replaced by a new export, so its mtime stands in for the counters
+        max_event_id = connection.execute(text("SELECT coalesce(max(id), 0) FROM events")).scalar()
+        return f"{max_event_id}.{int(os.path.getmtime(DUCKDB_PATH))}"
+
+
+BACKENDS = {'postgresql': PostgresBackend, 'duckdb': DuckDBBackend}
+backend = BACKENDS[engine.dialect.name]()
+
+
+def duckdb_table_ddl(table) -> str:
+    # The declared column types, so nullable integers (which pandas reads as float64) are
+    # stored as integers again; values of computed columns are copied like the others
+    from duckdb_engine import Dialect
+    dialect = Dialect()
+    columns = [
+        # Float is double precision in Postgres but single precision in DuckDB
+        f'"{column.name}" ' + ('DOUBLE' if isinstance(column.type, Float) else column.type.compile(dialect=dialect))
+        for column in table.columns
+    ]
+    primary_key = ', '.join(f'"{column.name}"' for column in table.primary_key.columns)
+    if primary_key:
+        columns.append(f'PRIMARY KEY ({primary_key})')
+    return f'CREATE TABLE "{table.name}" ({", ".join(columns)})'
+
+
+def export_to_duckdb(path: str, source_url: str, chunk_size: int = 100_000):
+    # Copies every mapped table (including the co-participation index) into a new DuckDB
+    # file, which REPOSITORY_BACKEND=duckdb then serves read-only
+    from sqlalchemy import create_engine
+    from app.db.psql.models import Base
+    source = create_engine(source_url)
+    target = duckdb.connect(path)
+    try:
+        for table in Base.metadata.sorted_tables:
+            target.execute(f'DROP TABLE IF EXISTS "{table.name}"')
+            target.execute(duckdb_table_ddl(table))
+            names = ', '.join(f'"{column.name}"' for column in table.columns)
+            for chunk in pd.read_sql_table(table.name, source, chunksize=chunk_size):
+                target.register('chunk', chunk)
+                target.execute(f'INSERT INTO "{table.name}" ({names}) SELECT {names} FROM chunk')
+                target.unregister('chunk')
+    finally:
+        target.close()
+        source.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the Postgres tables to a DuckDB file")
+    parser.add_argument('path', nargs='?', default=DUCKDB_PATH)
+    parser.add_argument('--source', default=os.getenv("PSQL_URL"))
+    args = parser.parse_args()
+    export_to_duckdb(args.path, args.source)
+    print(f"Exported {args.source.rsplit('@', 1)[-1]} to {args.path}")
@@ -0,0 +1,246 @@
+import struct
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+from sqlalchemy import ARRAY, BigInteger, Boolean, Float, Integer, Numeric, Text, cast, func
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+from sqlalchemy.sql.elements import Label
+from app.lazy_modules import lazy_import
+from app.memory_budget import check_memory_budget
+
+np = lazy_import('numpy', 'data')
+
+PGCOPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+PGCOPY_TRAILER = b'\xff\xff'
+BUDGET_CHECK_ROWS = 65536
+# COPY arrives a row at a time with psycopg 3; rows are decoded in batches of about this size
+DECODE_BATCH_BYTES = 1 << 20
+# wire kind -> (COPY binary dtype, what NULL is sent as)
+FIXED_WIDTH = {
+    'int': ('>i8', 0),
+    'float': ('>f8', 0.0),
+    'bool': ('?', False)
+}
+
+
+def wire_kind(sa_type):
+    # Every scalar column is cast to one of a few wire types so it can be decoded without
+    # knowing its OID (COPY binary does not send column types); arrays describe themselves.
+    # ARRAY is the generic type, which func.array_agg returns, as well as the dialect's.
+    if isinstance(sa_type, ARRAY):
+        return 'array', None
+    if isinstance(sa_type, Boolean):
+        return 'bool', Boolean()
+    if isinstance(sa_type, Integer):
+        return 'int', BigInteger()
+    if isinstance(sa_type, (Float, Numeric)):
+        return 'float', DOUBLE_PRECISION()
+    return 'text', Text()
+
+
+def binary_statement(statement):
+    columns, kinds = [], []
+    for column in statement.selected_columns:
+        kind, wire_type = wire_kind(column.type)
+        element = column.element if isinstance(column, Label) else column
+        columns.append((cast(element, wire_type) if wire_type is not None else element).label(column.name))
+        kinds.append(kind)
+    return statement.with_only_columns(*columns), kinds
+
+
+def client_cursor(dbapi_connection):
+    # psycopg 3 cursors bind parameters server-side; only its ClientCursor can mogrify
+    cursor = dbapi_connection.cursor()
+    if hasattr(cursor, 'mogrify'):
+        return cursor
+    cursor.close()
+    import psycopg
+    return psycopg.ClientCursor(dbapi_connection)
+
+
+def mogrify(cursor, connection, statement, params=None) -> str:
+    # The values are bound into the statement so render_postcompile can expand IN lists
+    # (country filters), which COPY cannot take as parameters
+    if params:
+        statement = statement.params(**params)
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    sql = cursor.mogrify(str(compiled), compiled.params)
+    return sql.decode() if isinstance(sql, bytes) else sql
+
+
+@contextmanager
+def dbapi_errors(connection, sql: Optional[str] = None):
+    # Raw cursor calls bypass SQLAlchemy's exception translation; re-raising its DBAPIError
+    # wrappers lets callers such as with_deadline recognise a canceled statement
+    dbapi = connection.dialect.loaded_dbapi
+    try:
+        yield
+    except dbapi.Error as error:
+        raise DBAPIError.instance(sql, None, error, dbapi.Error, dialect=connection.dialect) from error
+
+
+def copy_to(session, statement, sink, options: str = 'FORMAT binary'):
+    # Writes COPY (statement) TO STDOUT into sink chunk by chunk as the server sends it
+    connection = session.connection()
+    with client_cursor(connection.connection.dbapi_connection) as cursor:
+        copy_sql = f"COPY ({mogrify(cursor, connection, statement)}) TO STDOUT ({options})"
+        with dbapi_errors(connection, copy_sql):
+            if hasattr(cursor, 'copy_expert'):
+                cursor.copy_expert(copy_sql, sink)
+            else:
+                with cursor.copy(copy_sql) as copy:
+                    for chunk in copy:
+                        sink.write(chunk)
+
+
+def copy_chunks(session, statement, params, options: str) -> Iterator[bytes]:
+    # Yields COPY (statement) TO STDOUT output as the server sends it; psycopg 3 only,
+    # psycopg2's copy_expert writes the whole output before returning
+    connection = session.connection()
+    with client_cursor(connection.connection.dbapi_connection) as cursor:
+        copy_sql = f"COPY ({mogrify(cursor, connection, statement, params)}) TO STDOUT ({options})"
+        with dbapi_errors(connection, copy_sql):
+            with cursor.copy(copy_sql) as copy:
+                for chunk in copy:
+                    yield bytes(chunk)
+
+
+def fixed_width_statement(statement):
+    # Sends every column as a non-null value plus an is-null flag, so all rows of the
+    # COPY output have the same size and decode as one structured array. (None, None)
+    # when a column is text or an array.
+    columns, kinds = [], []
+    for column in statement.selected_columns:
+        kind, wire_type = wire_kind(column.type)
+        if kind not in FIXED_WIDTH:
+            return None, None
+        element = column.element if isinstance(column, Label) else column
+        null_value = cast(FIXED_WIDTH[kind][1], wire_type)
+        columns.append(func.coalesce(cast(element, wire_type), null_value).label(column.name))
+        columns.append(element.is_(None).label(f'{column.name}__null'))
+        kinds.append(kind)
+    return statement.with_only_columns(*columns), kinds
+
+
+class FixedWidthDecoder:
+    # File-like sink for the COPY binary output of a fixed_width_statement. Complete rows
+    # are decoded with np.frombuffer about every DECODE_BATCH_BYTES, so neither the whole
+    # payload nor a Python object per field is ever held.
+    def __init__(self, kinds: List[str]):
+        self.kinds = kinds
+        fields = [('field_count', '>i2')]
+        for i, kind in enumerate(kinds):
+            fields += [(f'length{i}', '>i4'), (f'value{i}', FIXED_WIDTH[kind][0]),
+                       (f'null_length{i}', '>i4'), (f'null{i}', '?')]
+        self.dtype = np.dtype(fields)
+        self.widths = [np.dtype(FIXED_WIDTH[kind][0]).itemsize for kind in kinds]
+        self.buffer = bytearray()
+        self.header_read = False
+        self.values = [[] for _ in kinds]
+        self.nulls = [[] for _ in kinds]
+        self.rows = 0
+
+    def write(self, data) -> int:
+        self.buffer += data
+        if len(self.buffer) >= DECODE_BATCH_BYTES:
+            self._decode()
+        return len(data)
+
+    def _decode(self):
+        if not self.header_read and not self._read_header():
+            return
+        count = len(self.buffer) // self.dtype.itemsize
+        if count:
+            rows = np.frombuffer(self.buffer, dtype=self.dtype, count=count)
+            if (rows['field_count'] != 2 * len(self.kinds)).any() or any(
+                    (rows[f'length{i}'] != width).any() or (rows[f'null_length{i}'] != 1).any()
+                    for i, width in enumerate(self.widths)):
+                raise ValueError("Unexpected row layout in PGCOPY binary payload")
+            for i in range(len(self.kinds)):
+                self.values[i].append(rows[f'value{i}'].astype(rows[f'value{i}'].dtype.newbyteorder('=')))
+                self.nulls[i].append(rows[f'null{i}'].copy())
+            # the view pins the buffer, which cannot shrink while it exists
+            del rows
+            del self.buffer[:count * self.dtype.itemsize]
+            if (self.rows + count) // BUDGET_CHECK_ROWS > self.rows // BUDGET_CHECK_ROWS:
+                check_memory_budget('result decoding')
+            self.rows += count
+
+    def _read_header(self) -> bool:
+        fixed = len(PGCOPY_SIGNATURE) + 8
+        if len(self.buffer) < fixed:
+            return False
+        if not self.buffer.startswith(PGCOPY_SIGNATURE):
+            raise ValueError("Not a PGCOPY binary payload")
+        (extension_length,) = struct.unpack_from('>i', self.buffer, len(PGCOPY_SIGNATURE) + 4)
+        if len(self.buffer) < fixed + extension_length:
+            return False
+        del self.buffer[:fixed + extension_length]
+        self.header_read = True
+        return True
+
+    def columns(self, names: List[str]) -> Dict[str, object]:
+        # numbers as numpy arrays (NULL -> NaN for floats, object arrays for nullable ints), bools as lists
+        self._decode()
+        if not self.header_read or bytes(self.buffer) != PGCOPY_TRAILER:
+            raise ValueError("Truncated PGCOPY binary payload")
+        result = {}
+        for i, (name, kind) in enumerate(zip(names, self.kinds)):
+            native = np.dtype(FIXED_WIDTH[kind][0]).newbyteorder('=')
+            values = np.concatenate(self.values[i]) if self.values[i] else np.empty(0, dtype=native)
+            nulls = np.concatenate(self.nulls[i]) if self.nulls[i] else np.empty(0, dtype=bool)
+            if kind == 'float':
+                values[nulls] = np.nan
+            elif kind == 'int' and nulls.any():
+                values = values.astype(object)
+                values[nulls] = None
+            elif kind == 'bool':
+                values = [None if null else bool(value) for value, null in zip(values, nulls)]
+            result[name] = values
+        return result
+
+
+def fetch_columns(session, query) -> Dict[str, object]:
+    # Returns the result column-wise. Numeric and bool results stream through
+    # COPY ... TO STDOUT (FORMAT binary) and decode vectorised; results with text or arrays
+    # are fetched normally, where the driver's C loaders do the decoding.
+    statement = query.statement if hasattr(query, 'statement') else query
+    fixed, kinds = fixed_width_statement(statement)
+    if fixed is None:
+        result = session.execute(statement)
+        return columns_from_rows(statement, result.all(), result.keys())
+    decoder = FixedWidthDecoder(kinds)
+    copy_to(session, fixed, decoder)
+    check_memory_budget('result transfer')
+    return decoder.columns([column.name for column in statement.selected_columns])
+
+
+def columns_from_rows(statement, rows, keys=None) -> Dict[str, object]:
+    # Shapes rows of an already executed statement like fetch_columns. Small results of
+    # cached statements are read this way: COPY cannot be prepared and re-renders its SQL.
+    # keys names the columns the rows hold when execution left some selected ones out.
+    result = {}
+    columns = [column for column in statement.selected_columns if keys is None or column.name in keys]
+    for i, column in enumerate(columns):
+        kind, _ = wire_kind(column.type)
+        values = [row[i] for row in rows]
+        if kind == 'float':
+            values = np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)
+        elif kind == 'int':
+            values = np.array(values, dtype=object) if None in values else \
+                np.array([int(v) for v in values], dtype=np.int64)
+        elif kind == 'array' and isinstance(column.type.item_type, (Integer, Float, Numeric)):
+            integer = isinstance(column.type.item_type, Integer)
+            values = [None if v is None else numeric_array(v, integer) for v in values]
+        result[column.name] = values
+    return result
+
+
+def numeric_array(values: List, integer: bool):
+    # One row of a numeric array column, typed like a numeric column: int64 (an object
+    # array when an element is NULL) for integer elements, float64 with NaN otherwise
+    if integer:
+        return np.array(values, dtype=object) if None in values else \
+            np.array([int(v) for v in values], dtype=np.int64)
+    return np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)
+
@@ -0,0 +1,193 @@
+import argparse
+import os
+from dataclasses import dataclass, field
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import delete, select, text
+from sqlalchemy.exc import ProgrammingError
+from app.db.psql.data_version import get_data_version, invalidate_data_version
+from app.db.psql.database import engine
+from app.db.psql.models import GroupCoparticipation, GroupCoparticipationState, TerroristGroup
+from app.repository.backends import backend
+
+# Two groups co-participate on a date when both have an event on that (year, month, day);
+# shared_events counts such dates, matching groups_coparticipation_repo
+REBUILD_SQL = text("""
+    WITH day_groups AS (
+        SELECT DISTINCT e.year, e.month, e.day, e.group_id
+        FROM events e
+        JOIN terrorist_group g ON g.id = e.group_id
+        WHERE g.group_name != 'Unknown'
+          AND e.year IS NOT NULL AND e.month IS NOT NULL AND e.day IS NOT NULL
+    )
+    INSERT INTO group_coparticipation (group_a_id, group_b_id, shared_events)
+    SELECT a.group_id, b.group_id, count(*)
+    FROM day_groups a
+    JOIN day_groups b ON a.year = b.year AND a.month = b.month AND a.day = b.day
+    WHERE a.group_id < b.group_id
+    GROUP BY a.group_id, b.group_id
+""")
+
+
+def rebuild_coparticipation_index(data_version: Optional[str] = None) -> str:
+    # The ingest step after loading events (python -m app.repository.coparticipation_index);
+    # workers only fall back to it in the background when they find the index behind the
+    # data. EXCLUSIVE mode still lets readers see the previous index until the commit, and
+    # a process that waited on another's rebuild of the same version skips its own.
+    tables = [GroupCoparticipation.__table__, GroupCoparticipationState.__table__]
+    GroupCoparticipation.metadata.create_all(engine, tables=tables)
+    data_version = data_version or get_data_version()
+    with engine.begin() as connection:
+        connection.execute(text("LOCK TABLE group_coparticipation IN EXCLUSIVE MODE"))
+        if connection.execute(select(GroupCoparticipationState.data_version)).scalar() == data_version:
+            return data_version
+        connection.execute(delete(GroupCoparticipation))
+        connection.execute(REBUILD_SQL)
+        connection.execute(delete(GroupCoparticipationState))
+        connection.execute(GroupCoparticipationState.__table__.insert().values(id=1, data_version=data_version))
+    return data_version
+
+
+def persisted_version() -> Optional[str]:
+    # Read from the primary like the rebuild writes it: a replica may not have replayed
+    # the latest rebuild yet
+    with engine.connect() as connection:
+        try:
+            return connection.execute(select(GroupCoparticipationState.data_version)).scalar()
+        except ProgrammingError:
+            # the index tables have not been created yet
+            return None
+
+
+@dataclass
+class CoparticipationIndex:
+    data_version: str
+    names: Dict[int, str]
+    ids: Dict[str, int]
+    adjacency: Dict[int, Dict[int, int]]
+    ranked: Dict[int, List[Tuple[int, int]]]
+    _clusters: Dict[int, List[List[int]]] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, data_version: str) -> 'CoparticipationIndex':
+        with engine.connect() as connection:
+            edges = connection.execute(select(
+                GroupCoparticipation.group_a_id,
+                GroupCoparticipation.group_b_id,
+                GroupCoparticipation.shared_events
+            )).all()
+            names = dict(connection.execute(select(TerroristGroup.id, TerroristGroup.group_name)).all())
+        adjacency = {}
+        for a, b, shared in edges:
+            adjacency.setdefault(a, {})[b] = shared
+            adjacency.setdefault(b, {})[a] = shared
+        ranked = {
+            group: sorted(neighbors.items(), key=lambda item: (-item[1], names[item[0]]))
+            for group, neighbors in adjacency.items()
+        }
+        return cls(data_version, names, {name: i for i, name in names.items()}, adjacency, ranked)
+
+    def group_id(self, name: str) -> Optional[int]:
+        return self.ids.get(name)
+
+    def top_partners(self, group: int, k: int) -> List[Tuple[str, int]]:
+        return [(self.names[partner], shared) for partner, shared in self.ranked.get(group, [])[:k]]
+
+    def shared_events(self, group_a: int, group_b: int) -> int:
+        return self.adjacency.get(group_a, {}).get(group_b, 0)
+
+    def top_pairs(self, n: Optional[int] = None) -> List[Tuple[Tuple[str, str], int]]:
+        pairs = [
+            (tuple(sorted((self.names[a], self.names[b]))), shared)
+            for a, neighbors in self.adjacency.items()
+            for b, shared in neighbors.items() if a < b
+        ]
+        pairs.sort(key=lambda pair: -pair[1])
+        return pairs[:n] if n else pairs
+
+    def clusters(self, min_shared: int = 1) -> List[List[str]]:
+        # Connected components over edges with at least min_shared shared events,
+        # memoised per threshold for the lifetime of this index
+        if min_shared not in self._clusters:
+            seen, components = set(), []
+            for start in self.adjacency:
+                if start in seen:
+                    continue
+                component, stack = [], [start]
+                seen.add(start)
+                while stack:
+                    group = stack.pop()
+                    component.append(group)
+                    for partner, shared in self.adjacency[group].items():
+                        if shared >= min_shared and partner not in seen:
+                            seen.add(partner)
+                            stack.append(partner)
+                if len(component) > 1:
+                    components.append(component)
+            components.sort(key=len, reverse=True)
+            self._clusters[min_shared] = components
+        return [sorted(self.names[g] for g in component) for component in self._clusters[min_shared]]
+
+
+_lock = Lock()
+_index: Dict[str, CoparticipationIndex] = {}
+_refreshing = {'thread': None}
+
+
+def refresh_coparticipation_index(current: Optional[str] = None) -> CoparticipationIndex:
+    # Brings the persisted index up to the current data version where the backend can
+    # write it (read-only backends serve the index exported along with the data), then
+    # swaps the loaded copy in whole
+    current = current or get_data_version()
+    if backend.writable:
+        current = rebuild_coparticipation_index(current)
+    index = CoparticipationIndex.load(current)
+    _index['current'] = index
+    return index
+
+
+def _refresh_in_background(current: str):
+    with _lock:
+        thread = _refreshing['thread']
+        if thread is not None and thread.is_alive():
+            return
+        thread = Thread(target=refresh_coparticipation_index, args=(current,),
+                        name='coparticipation-refresh', daemon=True)
+        _refreshing['thread'] = thread
+        thread.start()
+
+
+def get_coparticipation_index() -> CoparticipationIndex:
+    # Serves the last built index while a newer one is built and loaded off the request
+    # path; a request only waits when no index has been built at all
+    current = get_data_version()
+    index = _index.get('current')
+    if index is None:
+        with _lock:
+            index = _index.get('current')
+            if index is None:
+                persisted = persisted_version() if backend.writable else current
+                if persisted is None:
+                    index = refresh_coparticipation_index(current)
+                else:
+                    index = CoparticipationIndex.load(persisted)
+                    _index['current'] = index
+    if index.data_version != current:
+        _refresh_in_background(current)
+    return index
+
+
+def _reset_after_fork():
+    global _lock
+    _lock = Lock()
+    _refreshing['thread'] = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the persisted group co-participation index")
+    parser.parse_args()
+    invalidate_data_version()
+    print(f"Rebuilt group co-participation index for data version {rebuild_coparticipation_index()}")
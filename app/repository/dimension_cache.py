@@ -0,0 +1,79 @@
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, List, Tuple, Union
+from sqlalchemy import select
+from app.db.psql.data_version import get_data_version
+from app.db.psql.database import session_maker
+from app.db.psql.models import AttackType, Country, Region, TargetType, TerroristGroup
+
+
+class UnknownDimensionValue(LookupError):
+    def __init__(self, filter_name: str, value: str):
+        super().__init__(f"Unknown {filter_name.replace('_', ' ')} '{value}'")
+        self.filter_name = filter_name
+        self.value = value
+
+
+@dataclass
+class DimensionCache:
+    data_version: str
+    # region and country names are not unique, so a name can stand for several ids
+    regions: Dict[str, List[int]]
+    countries: Dict[str, List[int]]
+    groups: Dict[str, int]
+    attack_types: Dict[str, int]
+    target_types: Dict[str, int]
+
+    @classmethod
+    def load(cls, data_version: str) -> 'DimensionCache':
+        with session_maker() as session:
+            regions = {}
+            for name, region_id in session.execute(select(Region.name, Region.id).order_by(Region.id)):
+                regions.setdefault(name, []).append(region_id)
+            countries = {}
+            for name, country_id in session.execute(select(Country.name, Country.id).order_by(Country.id)):
+                countries.setdefault(name, []).append(country_id)
+            groups = dict(session.execute(select(TerroristGroup.group_name, TerroristGroup.id)).all())
+            attack_types = dict(session.execute(select(AttackType.name, AttackType.id)).all())
+            target_types = dict(session.execute(select(TargetType.name, TargetType.id)).all())
+        return cls(data_version, regions, countries, groups, attack_types, target_types)
+
+    def resolve(self, filter_name: str, value: str) -> Union[int, Tuple[int, ...]]:
+        ids = {
+            'region': self.regions,
+            'country': self.countries,
+            'group': self.groups,
+            'attack_type': self.attack_types,
+            'target_type': self.target_types
+        }[filter_name].get(value)
+        if ids is None:
+            raise UnknownDimensionValue(filter_name, value)
+        return tuple(ids) if isinstance(ids, list) else ids
+
+
+NAME_FILTERS = ('region', 'country', 'group', 'attack_type', 'target_type')
+
+_lock = Lock()
+_cache: Dict[str, DimensionCache] = {}
+
+
+def get_dimension_cache() -> DimensionCache:
+    current = get_data_version()
+    cache = _cache.get('current')
+    if cache is not None and cache.data_version == current:
+        return cache
+    with _lock:
+        cache = _cache.get('current')
+        if cache is None or cache.data_version != current:
+            cache = DimensionCache.load(current)
+            _cache['current'] = cache
+        return cache
+
+
+def check_filter_names(filters):
+    # Raises UnknownDimensionValue for the first name filter the data does not contain,
+    # so a typo is rejected before any query runs
+    cache = get_dimension_cache()
+    for name, value in filters.active().items():
+        if name in NAME_FILTERS:
+            cache.resolve(name, value)
@@ -0,0 +1,119 @@
+import csv
+import importlib.util
+import io
+import json
+import os
+from typing import Iterator, Optional
+from app.db.psql.database import session_maker
+from app.db.psql.models import Event
+from app.repository.backends import backend
+from app.repository.columnar import copy_chunks, wire_kind
+from app.repository.query_builder import EventFilters, event_select, filter_params
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "10000"))
+EXPORT_ROW_GROUP_ROWS = int(os.getenv("EXPORT_ROW_GROUP_ROWS", "100000"))
+# pyarrow is optional and only imported by a parquet export
+PARQUET_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+EXPORT_COLUMNS = [
+    'event_id', 'year', 'month', 'day', 'region', 'country', 'latitude', 'longitude', 'group_name',
+    'attack_type', 'target_type', 'killed', 'wounded', 'success', 'suicide', 'summary'
+]
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet'
+}
+
+
+def export_statement(filter_names):
+    # One row per event with its dimensions denormalized; outer joins keep events
+    # without a group, location or casualty record
+    return event_select(EXPORT_COLUMNS, filter_names=filter_names, outer=True).order_by(Event.id)
+
+
+def stream_rows(session, statement, params, chunk_rows: int):
+    # Server-side cursor: only chunk_rows rows are held in memory at a time
+    result = session.execute(statement, params, execution_options={'stream_results': True, 'yield_per': chunk_rows})
+    yield from result.partitions(chunk_rows)
+
+
+def csv_chunks(session, statement, params) -> Iterator[bytes]:
+    if backend.name == 'postgresql' and session.connection().dialect.driver == 'psycopg':
+        yield from copy_chunks(session, statement, params, 'FORMAT csv, HEADER')
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(column.name for column in statement.selected_columns)
+    for rows in stream_rows(session, statement, params, EXPORT_CHUNK_ROWS):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def ndjson_chunks(session, statement, params) -> Iterator[bytes]:
+    names = [column.name for column in statement.selected_columns]
+    for rows in stream_rows(session, statement, params, EXPORT_CHUNK_ROWS):
+        yield ''.join(
+            json.dumps(dict(zip(names, row)), default=str, separators=(',', ':')) + '\n' for row in rows
+        ).encode('utf-8')
+
+
+class _ChunkSink(io.RawIOBase):
+    # Collects what the parquet writer wrote since the last drain; tell() keeps counting
+    # across drains so the footer offsets stay right
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_chunks(session, statement, params) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    types = {'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_(), 'text': pa.string()}
+    schema = pa.schema([(column.name, types[wire_kind(column.type)[0]]) for column in statement.selected_columns])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        # every fetched chunk becomes one row group, written out before the next is read
+        for rows in stream_rows(session, statement, params, EXPORT_ROW_GROUP_ROWS):
+            arrays = [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+WRITERS = {'csv': csv_chunks, 'ndjson': ndjson_chunks, 'parquet': parquet_chunks}
+
+
+def export_events_repo(export_format: str, filters: Optional[EventFilters] = None) -> Iterator[bytes]:
+    # Filter names are resolved before the first chunk, so unknown names fail the request
+    # rather than the stream; the session lives as long as the stream is consumed
+    params = filter_params(filters)
+    statement = export_statement(frozenset(params))
+
+    def chunks():
+        with session_maker() as session:
+            yield from WRITERS[export_format](session, statement, params)
+    return chunks()
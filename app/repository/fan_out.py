@@ -0,0 +1,67 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List
+from app.db.psql.database import shared_session
+
+# Shared by all requests, so this also bounds how many pooled connections fan-outs hold
+FAN_OUT_MAX_WORKERS = int(os.getenv("FAN_OUT_MAX_WORKERS", "4"))
+
+_executor = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    # Created on first use in each process: a forked worker does not inherit the master's
+    # threads, so an executor copied from the master would accept work and never run it
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FAN_OUT_MAX_WORKERS, thread_name_prefix='fan-out')
+    return _executor
+
+
+def shutdown_executor():
+    # Called by the master before forking, so no idle fan-out threads outlive the warm-up
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+def _reset_after_fork():
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _run_in_worker(call: Callable[[], Any]) -> Any:
+    _local.active = True
+    try:
+        return call()
+    finally:
+        _local.active = False
+
+
+def fan_out(*calls: Callable[[], Any]) -> List[Any]:
+    # Runs independent sub-queries concurrently and returns their results in order. Each
+    # call must open its own session; it runs in a copy of the caller's context so the
+    # statement deadline still applies. Nested fan-outs run inline to avoid starving the pool,
+    # and so do fan-outs inside a batch, whose one snapshot session cannot be shared by threads.
+    if len(calls) < 2 or getattr(_local, 'active', False) or shared_session.get() is not None:
+        return [call() for call in calls]
+    executor = get_executor()
+    futures = [executor.submit(contextvars.copy_context().run, _run_in_worker, call) for call in calls]
+    try:
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
@@ -1,83 +1,66 @@
+from collections import namedtuple
+from contextlib import nullcontext
 from itertools import combinations
+from dataclasses import replace
 from typing import Optional, List, Tuple, Dict, Set
-import pandas as pd
 from datetime import datetime
-from sqlalchemy import func, case, desc, String, distinct, text, and_, Float, cast, literal
+from sqlalchemy import func, desc, distinct, text, literal, select, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
 from toolz import pipe
 from app.db.psql.database import session_maker
 from app.db.psql.models import AttackType, Casualties, Event, Region, Location, TerroristGroup, TargetType, Country
+from app.repository.query_builder import EventFilters, event_query, hot_columns, hot_statement
+from app.repository.coparticipation_index import get_coparticipation_index
+from app.repository.dimension_cache import get_dimension_cache
+from app.repository.approximation import approximation, exactly
+from app.repository.sketches import SKETCH_FILTERS, HyperLogLog, get_area_sketches
+from app.repository.backends import backend
+from app.repository.fan_out import fan_out
+from app.lazy_modules import lazy_import
+
+pd = lazy_import('pandas', 'data')
 
 # 1
-def deadliest_attacks_repo(top_n):
+def _deadliest_attacks(statement, top_n=None):
+    statement = statement.order_by(desc("casualty_score"))
+    return statement.limit(top_n) if top_n is not None else statement
+
+
+def deadliest_attacks_repo(top_n, filters=None):
     with session_maker() as session:
-        query = session.query(
-            AttackType.name.label("attack_type"),
-            func.sum(
-                case(
-                    (Casualties.killed.isnot(None), Casualties.killed * 2),
-                    else_=0
-                ) +
-                case(
-                    (Casualties.wounded.isnot(None), Casualties.wounded),
-                    else_=0
-                )
-            ).label("casualty_score")
-        ).join(
-            Event, Event.attack_type_id == AttackType.id
-        ).join(
-            Casualties, Event.casualties_id == Casualties.id
-        ).group_by(
-            AttackType.name
-        ).order_by(
-            desc("casualty_score")
+        statement, params = hot_statement(
+            session, _deadliest_attacks,
+            dimensions=['attack_type'],
+            # event_count sizes the sample behind each bar in approximate mode
+            measures=['casualty_score', 'event_count'],
+            filters=filters,
+            from_facts=True,
+            **({'top_n': top_n} if top_n else {})
         )
-        if top_n:
-            query = query.limit(top_n)
-        return query.all()
+        return hot_columns(session, statement, params)
 # 2
-def casualties_by_region_repo(top_n: Optional[int]) -> List[Tuple]:
+def casualties_by_region_repo(top_n: Optional[int], filters: Optional[EventFilters] = None) -> List[Tuple]:
     with session_maker() as session:
         valid_locations = session.query(
             Location.region_id,
             func.avg(Location.latitude).label("lat"),
             func.avg(Location.longitude).label("lon")
         ).filter(
-            and_(
-                Location.latitude.isnot(None),
-                Location.longitude.isnot(None),
-                Location.latitude != 0,
-                Location.longitude != 0,
-                Location.latitude.between(-90, 90),
-                Location.longitude.between(-180, 180)
-            )
+            Location.valid_coordinates
         ).group_by(
             Location.region_id
         ).subquery()
-        query = session.query(
-            Region.name.label("region"),
-            func.count(Event.id).label("event_count"),
-            func.sum(
-                case(
-                    (Casualties.killed.isnot(None), Casualties.killed * 2),
-                    else_=0
-                ) +
-                case(
-                    (Casualties.wounded.isnot(None), Casualties.wounded),
-                    else_=0
-                )
-            ).label("casualty_score"),
+        query = event_query(
+            session,
+            dimensions=['region'],
+            measures=['event_count', 'casualty_score'],
+            filters=filters
+        ).add_columns(
             valid_locations.c.lat,
             valid_locations.c.lon
         ).join(
             valid_locations, valid_locations.c.region_id == Region.id
-        ).join(
-            Location, Location.region_id == Region.id
-        ).join(
-            Event, Event.location_id == Location.id
-        ).join(
-            Casualties, Event.casualties_id == Casualties.id
         ).group_by(
-            Region.name,
             valid_locations.c.lat,
             valid_locations.c.lon
         ).having(
@@ -89,56 +72,75 @@ def casualties_by_region_repo(top_n: Optional[int]) -> List[Tuple]:
 
         return query.all()
 # 3
-def top_casualty_groups_repo():
+TOP_CASUALTY_GROUPS_MEASURES = {
+    'total_casualties': 'total_casualties',
+    'start_year': 'first_year',
+    'end_year': 'last_year',
+    'num_attacks': 'event_count'
+}
+
+
+def _top_casualty_groups(statement):
+    return statement.order_by(desc("total_casualties").nulls_last()).limit(5)
+
+
+def top_casualty_groups_repo(filters=None):
     with session_maker() as session:
-        return session.query(
-            TerroristGroup.group_name,
-            func.sum(Casualties.killed * 2 + Casualties.wounded).label("total_casualties"),
-            func.min(Event.year).label("start_year"),
-            func.max(Event.year).label("end_year"),
-            func.count(Event.id).label("num_attacks")
-        ).join(Event, Event.group_id == TerroristGroup.id
-               ).join(Casualties, Event.casualties_id == Casualties.id
-                      ).group_by(TerroristGroup.group_name
-                                 ).order_by(desc("total_casualties")
-                                            ).limit(5).all()
+        statement, params = hot_statement(
+            session, _top_casualty_groups,
+            dimensions=['group_name'],
+            measures=TOP_CASUALTY_GROUPS_MEASURES,
+            filters=filters,
+            from_facts=True
+        )
+        return session.execute(statement, params or {}).all()
 # 4
-def attack_target_correlation_repo():
+def _unrefined(statement):
+    return statement
+
+
+def attack_target_correlation_repo(filters=None):
     with session_maker() as session:
-        return session.query(
-            AttackType.name,
-            TargetType.name,
-            func.count(Event.id).label("event_count")
-        ).join(Event, Event.attack_type_id == AttackType.id
-               ).join(TargetType, Event.target_type_id == TargetType.id
-                      ).group_by(AttackType.name, TargetType.name).all()
+        statement, params = hot_statement(
+            session, _unrefined,
+            dimensions=['attack_type', 'target_type'],
+            measures=['event_count'],
+            filters=filters,
+            from_facts=True
+        )
+        return hot_columns(session, statement, params)
 # 5
-def attack_trends_repo(year):
-    with session_maker() as session:
-        annual_trends = session.query(
-            Event.year.label('year'),
-            func.count(Event.id).label('attack_count')
-        ).filter(Event.year.isnot(None)
-                 ).group_by(Event.year).order_by(Event.year).all()
-        monthly_trends = session.query(
-            Event.month.label('month'),
-            func.count(Event.id).label('attack_count')
-        ).filter(
-            Event.year == year,
-            Event.month.isnot(None)
-        ).group_by(Event.month).order_by(Event.month).all()
-        return annual_trends, monthly_trends
+def _annual_trends(statement):
+    return statement.where(Event.year.isnot(None)).order_by(Event.year)
+
+
+def _monthly_trends(statement, year):
+    return statement.where(Event.year == year, Event.month.isnot(None)).order_by(Event.month)
+
+
+def attack_trends_repo(year, filters=None):
+    def trends(refine, dimension, **values):
+        with session_maker() as session:
+            statement, params = hot_statement(
+                session, refine,
+                dimensions=[dimension],
+                measures={'attack_count': 'event_count'},
+                filters=filters,
+                **values
+            )
+            return session.execute(statement, params or {}).all()
+
+    return tuple(fan_out(lambda: trends(_annual_trends, 'year'),
+                         lambda: trends(_monthly_trends, 'month', year=year)))
 # 6
-def attack_change_by_region_repo():
+def attack_change_by_region_repo(filters=None):
     with session_maker() as session:
-        attacks_by_region_year = session.query(
-            Region.name.label('region'),
-            Event.year.label('year'),
-            func.count(Event.id).label('attack_count')
-        ).join(Location, Location.region_id == Region.id
-               ).join(Event, Event.location_id == Location.id
-                      ).filter(Event.year.isnot(None)
-                      ).group_by('region', Event.year).subquery()
+        attacks_by_region_year = event_query(
+            session,
+            dimensions=['region', 'year'],
+            measures={'attack_count': 'event_count'},
+            filters=filters
+        ).filter(Event.year.isnot(None)).subquery()
 
         region_changes = session.query(
             attacks_by_region_year.c.region,
@@ -153,27 +155,18 @@ def attack_change_by_region_repo():
                 order_by=attacks_by_region_year.c.year
             ).label('previous_year')
         ).order_by(attacks_by_region_year.c.region, attacks_by_region_year.c.year)
-        df = pd.read_sql(region_changes.statement, session.bind)
+        df = pd.read_sql(region_changes.statement, session.connection())
         return df
 # 7
-def terror_heatmap_repo(time_period, region_filter):
+def terror_heatmap_repo(time_period, filters=None):
     with session_maker() as session:
-        query = session.query(
-            Location.latitude,
-            Location.longitude,
-            Event.year,
-            Event.month,
-            Region.name.label('region'),
-            func.count(Event.id).label('event_count')
-        ).join(
-            Event, Event.location_id == Location.id
-        ).join(
-            Region, Region.id == Location.region_id
+        query = event_query(
+            session,
+            dimensions=['latitude', 'longitude', 'year', 'month', 'region'],
+            measures=['event_count'],
+            filters=filters
         ).filter(
-            Location.latitude.isnot(None),
-            Location.longitude.isnot(None),
-            cast(Location.latitude, Float).isnot(None),
-            cast(Location.longitude, Float).isnot(None)
+            Location.valid_coordinates
         )
         current_year = 2017
         if time_period == 'month':
@@ -188,206 +181,153 @@ def terror_heatmap_repo(time_period, region_filter):
             query = query.filter(Event.year >= current_year - 3)
         elif time_period == '5_years':
             query = query.filter(Event.year >= current_year - 5)
-        if region_filter:
-            query = query.filter(Region.name == region_filter)
-        query = query.group_by(
-            Location.latitude,
-            Location.longitude,
-            Event.year,
-            Event.month,
-            Region.name
-        )
         results = query.all()
-        if results:
-            sample = results[0]
         return results, current_year
 # 8
-def active_groups_heatmap_repo(region_filter):
-    with session_maker() as session:
-        def get_region_center(region_name):
-            return session.query(
-                func.avg(case(
-                    (Location.latitude.between(-90, 90), Location.latitude)
-                )).label('avg_lat'),
-                func.avg(case(
-                    (Location.longitude.between(-180, 180), Location.longitude)
-                )).label('avg_lon')
-            ).join(
-                Region, Location.region_id == Region.id
-            ).filter(
-                Region.name == region_name,
-                Location.latitude != 0,
-                Location.longitude != 0
-            ).first()
+def active_groups_heatmap_repo(filters=None):
+    filters = filters or EventFilters()
 
-        if region_filter:
-            coords = get_region_center(region_filter)
-            return list(session.query(
-                TerroristGroup.group_name,
-                func.count(Event.id).label('attack_count'),
+    def get_region_center(session, region_name):
+        return session.query(
+            func.avg(Location.latitude).label('avg_lat'),
+            func.avg(Location.longitude).label('avg_lon')
+        ).filter(
+            Location.region_id.in_(get_dimension_cache().resolve('region', region_name)),
+            Location.valid_coordinates
+        ).first()
+
+    def top_groups(session, region_name):
+        return event_query(
+            session,
+            dimensions=['group_name'],
+            measures={'attack_count': 'event_count'},
+            filters=replace(filters, region=region_name)
+        ).order_by(
+            desc('attack_count')
+        ).limit(5)
+
+    def region_results(region_name):
+        with session_maker() as session:
+            coords = get_region_center(session, region_name)
+            if not (coords and coords.avg_lat and coords.avg_lon):
+                return []
+            return [{
+                'region_name': region_name,
+                'group_name': group.group_name,
+                'attack_count': group.attack_count,
+                'avg_lat': float(coords.avg_lat),
+                'avg_lon': float(coords.avg_lon)
+            } for group in top_groups(session, region_name).all()]
+
+    if filters.region:
+        with session_maker() as session:
+            coords = get_region_center(session, filters.region)
+            return list(top_groups(session, filters.region).add_columns(
                 literal(coords.avg_lat).label('avg_lat'),
                 literal(coords.avg_lon).label('avg_lon')
-            ).join(
-                Event
-            ).join(
-                Location
-            ).join(
-                Region
-            ).filter(
-                Region.name == region_filter
-            ).group_by(
-                TerroristGroup.group_name
-            ).order_by(
-                desc('attack_count')
-            ).limit(5))
-        else:
-            regions = session.query(Region.name).all()
-            results = []
-
-            for region in regions:
-                coords = get_region_center(region.name)
-                if coords and coords.avg_lat and coords.avg_lon:
-                    top_groups = session.query(
-                        TerroristGroup.group_name,
-                        func.count(Event.id).label('attack_count')
-                    ).join(
-                        Event
-                    ).join(
-                        Location
-                    ).join(
-                        Region
-                    ).filter(
-                        Region.name == region.name
-                    ).group_by(
-                        TerroristGroup.group_name
-                    ).order_by(
-                        desc('attack_count')
-                    ).limit(5).all()
-
-                    for group in top_groups:
-                        results.append({
-                            'region_name': region.name,
-                            'group_name': group.group_name,
-                            'attack_count': group.attack_count,
-                            'avg_lat': float(coords.avg_lat),
-                            'avg_lon': float(coords.avg_lon)
-                        })
-
-            return results
+            ))
+    regions = list(get_dimension_cache().regions)
+    per_region = fan_out(*(lambda name=name: region_results(name) for name in regions))
+    return [row for rows in per_region for row in rows]
 # 9
-def perpetrators_casualties_correlation_repo():
+def perpetrators_casualties_query(session, filters=None):
+    return event_query(
+        session,
+        dimensions=['event_id'],
+        measures={'perpetrator_count': 'perpetrator_count', 'total_casualties': 'casualty_score'},
+        filters=filters
+    )
+def perpetrators_casualties_correlation_repo(filters=None):
+    with session_maker() as session:
+        return backend.fetch_columns(session, perpetrators_casualties_query(session, filters))
+def perpetrators_casualties_stats_repo(filters=None):
+    with session_maker() as session:
+        per_event = perpetrators_casualties_query(session, filters).subquery()
+        x, y = per_event.c.perpetrator_count, per_event.c.total_casualties
+        return session.query(
+            func.count().label('data_points'),
+            func.corr(y, x).label('correlation'),
+            func.regr_slope(y, x).label('slope'),
+            func.regr_intercept(y, x).label('intercept'),
+            func.avg(x).label('avg_perpetrators'),
+            func.avg(y).label('avg_casualties'),
+            func.min(x).label('min_perpetrators'),
+            func.max(x).label('max_perpetrators'),
+            func.min(y).label('min_casualties'),
+            func.max(y).label('max_casualties')
+        ).filter(x > 0, y > 0).one()
+def perpetrators_casualties_density_repo(stats, bins, filters=None):
+    def bucket(column, low, high):
+        high = high if high > low else low + 1
+        return func.least(backend.width_bucket(column, low, high, bins), bins)
+
     with session_maker() as session:
+        per_event = perpetrators_casualties_query(session, filters).subquery()
+        x, y = per_event.c.perpetrator_count, per_event.c.total_casualties
+        x_bin = bucket(x, stats.min_perpetrators, stats.max_perpetrators).label('x_bin')
+        y_bin = bucket(y, stats.min_casualties, stats.max_casualties).label('y_bin')
         return session.query(
-            Event.id,
-            func.count(TerroristGroup.id).label('perpetrator_count'),
-            func.sum(
-                case(
-                    (Casualties.killed.isnot(None), Casualties.killed * 2),
-                    else_=0
-                ) +
-                case(
-                    (Casualties.wounded.isnot(None), Casualties.wounded),
-                    else_=0
-                )
-            ).label('total_casualties')
-        ).join(TerroristGroup, Event.group_id == TerroristGroup.id
-               ).join(Casualties, Event.casualties_id == Casualties.id
-                      ).group_by(Event.id).all()
+            x_bin,
+            y_bin,
+            func.count().label('event_count')
+        ).filter(x > 0, y > 0).group_by(x_bin, y_bin).all()
 # 10
-def events_casualties_correlation_repo(region_name):
+EVENTS_CASUALTIES_MEASURES = {'event_count': 'event_count', 'total_casualties': 'casualty_score'}
+
+
+def events_casualties_correlation_repo(filters=None):
     with session_maker() as session:
-        query = session.query(
-            Region.name.label('region'),
-            func.count(Event.id).label('event_count'),
-            func.sum(
-                case(
-                    (Casualties.killed.isnot(None), Casualties.killed * 2),
-                    else_=0
-                ) +
-                case(
-                    (Casualties.wounded.isnot(None), Casualties.wounded),
-                    else_=0
-                )
-            ).label("total_casualties")
-        ).join(Location, Location.region_id == Region.id
-               ).join(Event, Event.location_id == Location.id
-                      ).join(Casualties, Event.casualties_id == Casualties.id
-                             )
-        if region_name:
-            query = query.filter(Region.name == region_name)
-        return query.group_by(Region.name).all()
+        statement, params = hot_statement(
+            session, _unrefined,
+            dimensions=['region'],
+            measures=EVENTS_CASUALTIES_MEASURES,
+            filters=filters,
+            from_facts=True
+        )
+        return hot_columns(session, statement, params)
 # 11
-def groups_common_goals_repo(region_filter=None, country_filter=None):
+def groups_common_goals_repo(filters=None, coarse=False):
+    # coarse aggregates per country instead of per exact location
     with session_maker() as session:
-        query = session.query(
-            TerroristGroup.group_name,
-            TargetType.name.label('target_type'),
-            Region.name.label('region'),
-            Country.name.label('country'),
-            func.count(Event.id).label('attack_count'),
-            func.avg(Location.latitude).label('lat'),
-            func.avg(Location.longitude).label('lon')
-        ).join(
-            Event, Event.group_id == TerroristGroup.id
-        ).join(
-            TargetType, Event.target_type_id == TargetType.id
-        ).join(
-            Location, Event.location_id == Location.id
-        ).join(
-            Region, Location.region_id == Region.id
-        ).join(
-            Country, Location.country_id == Country.id
-        )
-        if region_filter:
-            query = query.filter(Region.name == region_filter)
-        if country_filter:
-            query = query.filter(Country.name == country_filter)
-        query = query.group_by(
-            TerroristGroup.group_name,
-            TargetType.name,
-            Region.name,
-            Country.name,
-            Location.latitude,
-            Location.longitude
+        return event_query(
+            session,
+            dimensions=['group_name', 'target_type', 'region', 'country'],
+            measures={'attack_count': 'event_count', 'lat': 'avg_lat', 'lon': 'avg_lon'},
+            filters=filters,
+            group_by=[] if coarse else ['latitude', 'longitude']
+        ).filter(
+            Location.valid_coordinates
         ).having(
             func.count(Event.id) > 0
         ).order_by(
-            desc('attack_count')
-        )
-        return query.all()
+            # ties broken by the grouping keys, so the order is the same on every run
+            desc('attack_count'), 'group_name', 'target_type', 'region', 'country', 'lat', 'lon'
+        ).all()
 # 12
-def group_activity_expansion_repo():
+def group_activity_expansion_repo(filters=None):
     with session_maker() as session:
-        first_appearance = session.query(
-            TerroristGroup.group_name,
-            Region.name.label('region_name'),
-            func.min(Event.year).label('first_year'),
-            func.avg(Location.latitude).label('lat'),
-            func.avg(Location.longitude).label('lon'),
-            func.count(Event.id).label('attack_count')
-        ).join(
-            Event, Event.group_id == TerroristGroup.id
-        ).join(
-            Location, Event.location_id == Location.id
-        ).join(
-            Region, Location.region_id == Region.id
+        first_appearance = event_query(
+            session,
+            dimensions={'group_name': 'group_name', 'region_name': 'region'},
+            measures={'first_year': 'first_year', 'lat': 'valid_avg_lat', 'lon': 'valid_avg_lon',
+                      'attack_count': 'event_count'},
+            filters=filters
         ).filter(
             Event.year.isnot(None)
-        ).group_by(
-            TerroristGroup.group_name,
-            Region.name
         ).subquery()
+        # One native array per attribute, all in first-appearance order, instead of JSON text per region
+        def expansion_array(column):
+            return array_agg(aggregate_order_by(
+                column, first_appearance.c.first_year, first_appearance.c.region_name
+            ))
+
         expansion_query = session.query(
             TerroristGroup.group_name,
-            func.array_agg(
-                func.json_build_object(
-                    'region', first_appearance.c.region_name,
-                    'year', first_appearance.c.first_year,
-                    'lat', first_appearance.c.lat,
-                    'lon', first_appearance.c.lon,
-                    'attacks', first_appearance.c.attack_count
-                ).cast(String)
-            ).label('expansions'),
+            expansion_array(first_appearance.c.region_name).label('regions'),
+            expansion_array(first_appearance.c.first_year).label('years'),
+            expansion_array(first_appearance.c.lat).label('lats'),
+            expansion_array(first_appearance.c.lon).label('lons'),
+            expansion_array(first_appearance.c.attack_count).label('attacks'),
             func.count(distinct(first_appearance.c.region_name)).label('region_count')
         ).join(
             first_appearance, first_appearance.c.group_name == TerroristGroup.group_name
@@ -396,11 +336,12 @@ def group_activity_expansion_repo():
         ).having(
             func.count(distinct(first_appearance.c.region_name)) > 1
         ).order_by(
-            text('region_count DESC')
+            # many groups reach the same number of regions; the name keeps the top 10 stable
+            text('region_count DESC'), TerroristGroup.group_name
         ).limit(10)
-        return expansion_query.all()
+        return backend.fetch_columns(session, expansion_query)
 # 13
-def groups_coparticipation_repo() -> List[Tuple[Tuple[str, str], int]]:
+def groups_coparticipation_repo(filters: Optional[EventFilters] = None) -> List[Tuple[Tuple[str, str], int]]:
     def process_events(rows) -> Dict[Tuple[int, int, int], Set[str]]:
         events = {}
         for event_id, year, month, day, summary, group_name in rows:
@@ -419,18 +360,27 @@ def groups_coparticipation_repo() -> List[Tuple[Tuple[str, str], int]]:
                     connections[key] = connections.get(key, 0) + 1
         return connections
 
+    if filters is None or not filters.active():
+        return get_coparticipation_index().top_pairs()
+
     with session_maker() as session:
-        return pipe(
-            session.query(
-                Event.id.label('event_id'),
-                Event.year,
-                Event.month,
-                Event.day,
-                Event.summary,
-                TerroristGroup.group_name
+        query = event_query(
+            session,
+            dimensions=['event_id', 'year', 'month', 'day', 'summary', 'group_name'],
+            # every event has one group, so the group filter cannot apply to the rows paired up
+            filters=replace(filters, group=None)
+        )
+        if filters.group is not None:
+            # the group picks the dates it was active on; all groups active then are counted
+            dates = event_query(session, dimensions=['year', 'month', 'day'], filters=filters).subquery()
+            query = query.filter(
+                tuple_(Event.year, Event.month, Event.day).in_(select(dates.c.year, dates.c.month, dates.c.day))
             )
-            .join(TerroristGroup, Event.group_id == TerroristGroup.id)
+        return pipe(
+            query
             .filter(TerroristGroup.group_name != 'Unknown')
+            # same rule as the index: an event without a complete date shares it with no one
+            .filter(Event.year.isnot(None), Event.month.isnot(None), Event.day.isnot(None))
             .all(),
             process_events,
             count_connections,
@@ -438,41 +388,15 @@ def groups_coparticipation_repo() -> List[Tuple[Tuple[str, str], int]]:
             list
         )
 # 14
-def common_attack_strategies_repo(region_filter=None, country_filter=None):
+def common_attack_strategies_repo(filters=None):
     with session_maker() as session:
-        query = session.query(
-            Region.name.label('region'),
-            Country.name.label('country'),
-            AttackType.name.label('attack_type'),
-            TerroristGroup.group_name,
-            func.count(Event.id).label('attack_count')
-        ).join(
-            Event, Event.attack_type_id == AttackType.id
-        ).join(
-            TerroristGroup, Event.group_id == TerroristGroup.id
-        ).join(
-            Location, Event.location_id == Location.id
-        ).join(
-            Region, Location.region_id == Region.id
-        ).join(
-            Country, Location.country_id == Country.id
+        query = event_query(
+            session,
+            dimensions=['region', 'country', 'attack_type', 'group_name'],
+            measures={'attack_count': 'event_count'},
+            filters=filters
         ).filter(
             AttackType.name != 'Unknown'
-        )
-
-        # Apply filters if provided
-        if region_filter and country_filter:
-            query = query.filter(Region.name == region_filter, Country.name == country_filter)
-        elif region_filter:
-            query = query.filter(Region.name == region_filter)
-        elif country_filter:
-            query = query.filter(Country.name == country_filter)
-
-        query = query.group_by(
-            Region.name,
-            Country.name,
-            AttackType.name,
-            TerroristGroup.group_name
         ).having(
             func.count(Event.id) > 0
         )
@@ -506,18 +430,15 @@ def common_attack_strategies_repo(region_filter=None, country_filter=None):
                       key=lambda x: (x['num_groups'], x['total_attacks']),
                       reverse=True)
 def get_locations_for_common_attacks(region, country):
+    cache = get_dimension_cache()
+    region_ids = cache.resolve('region', region)
     with session_maker() as session:
         # Try to get country-level location first if country is provided
         if country:
-            location = session.query(Location).join(
-                Country, Location.country_id == Country.id
-            ).join(
-                Region, Location.region_id == Region.id
-            ).filter(
-                Region.name == region,
-                Country.name == country,
-                Location.latitude.isnot(None),
-                Location.longitude.isnot(None)
+            location = session.query(Location).filter(
+                Location.region_id.in_(region_ids),
+                Location.country_id.in_(cache.resolve('country', country)),
+                Location.valid_coordinates
             ).first()
 
             if location:
@@ -525,48 +446,64 @@ def get_locations_for_common_attacks(region, country):
 
         # If no country-level location found or no country provided, try region-level
         location = session.query(Location).join(
-            Region, Location.region_id == Region.id
-        ).join(
             Country, Location.country_id == Country.id
         ).filter(
-            Region.name == region,
-            Location.latitude.isnot(None),
-            Location.longitude.isnot(None)
+            Location.region_id.in_(region_ids),
+            Location.valid_coordinates
         ).order_by(
             Country.name
         ).first()
 
         return location
 # 16
-def intergroup_activity_repo(region_filter=None, country_filter=None):
+IntergroupArea = namedtuple('IntergroupArea', ['region', 'country', 'lat', 'lon', 'unique_groups',
+                                               'total_events', 'group_list'])
+def intergroup_activity_sketched_repo(filters, sample):
+    # Areas and their event counts from the events sample; unique groups from the merged
+    # per-year sketches, since a sample undercounts distinct values. Group lists only
+    # hold the groups seen in the sample.
     with session_maker() as session:
-        query = session.query(
-            Region.name.label('region'),
-            Country.name.label('country'),
-            func.avg(Location.latitude).label('lat'),
-            func.avg(Location.longitude).label('lon'),
-            func.count(distinct(TerroristGroup.id)).label('unique_groups'),
-            func.count(Event.id).label('total_events'),
-            func.array_agg(distinct(TerroristGroup.group_name)).label('group_list')
-        ).join(
-            Location, Location.region_id == Region.id
-        ).join(
-            Country, Location.country_id == Country.id
-        ).join(
-            Event, Event.location_id == Location.id
-        ).join(
-            TerroristGroup, Event.group_id == TerroristGroup.id
-        )
-        if region_filter:
-            query = query.filter(Region.name == region_filter)
-        if country_filter:
-            query = query.filter(Country.name == country_filter)
-        query = query.group_by(
-            Region.name,
-            Country.name
+        rows = event_query(
+            session,
+            dimensions=['region', 'country'],
+            measures={'lat': 'avg_lat', 'lon': 'avg_lon', 'total_events': 'event_count', 'group_list': 'group_list'},
+            filters=filters
+        ).filter(
+            Location.valid_coordinates
+        ).all()
+    sketches = get_area_sketches()
+    areas = []
+    for row in rows:
+        sketch = sketches.unique_groups(row.region, row.country, filters.year_from, filters.year_to)
+        unique_groups = round(sketch.count())
+        if unique_groups > 1:
+            areas.append(IntergroupArea(row.region, row.country, row.lat, row.lon, unique_groups,
+                                        row.total_events, row.group_list))
+    sample.observe_sketch(HyperLogLog().relative_error)
+    return sorted(areas, key=lambda area: (-area.unique_groups, area.region, area.country))
+def intergroup_activity_repo(filters=None):
+    filters = filters or EventFilters()
+    sample = approximation.get()
+    if sample is not None and set(filters.active()) <= SKETCH_FILTERS:
+        return intergroup_activity_sketched_repo(filters, sample)
+    # other filters need the exact distinct count, so the whole query runs on all events
+    with (exactly() if sample is not None else nullcontext()), session_maker() as session:
+        query = event_query(
+            session,
+            dimensions=['region', 'country'],
+            measures={
+                'lat': 'avg_lat',
+                'lon': 'avg_lon',
+                'unique_groups': 'unique_groups',
+                'total_events': 'event_count',
+                'group_list': 'group_list'
+            },
+            filters=filters
+        ).filter(
+            Location.valid_coordinates
         ).having(
             func.count(distinct(TerroristGroup.id)) > 1
         ).order_by(
-            desc('unique_groups')
+            desc('unique_groups'), 'region', 'country'
         )
         return query.all()
\ No newline at end of file
@@ -0,0 +1,363 @@
+import os
+from contextvars import ContextVar
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Optional, Tuple, Union
+from sqlalchemy import BigInteger, Boolean, Column, Float, MetaData, Table, bindparam, cast, func, case, distinct, select, \
+    text, type_coerce
+from sqlalchemy.sql import Select
+from app.db.psql.models import AttackType, Casualties, Event, Region, Location, TerroristGroup, TargetType, Country
+from app.repository.approximation import SQUARES_SUFFIX, approximation
+from app.repository.backends import backend
+from app.repository.columnar import columns_from_rows
+from app.repository.dimension_cache import NAME_FILTERS, get_dimension_cache
+
+
+@dataclass(frozen=True)
+class EventFilters:
+    region: Optional[str] = None
+    country: Optional[str] = None
+    group: Optional[str] = None
+    year_from: Optional[int] = None
+    year_to: Optional[int] = None
+    attack_type: Optional[str] = None
+    target_type: Optional[str] = None
+
+    def active(self) -> Dict[str, Union[str, int]]:
+        return {f.name: getattr(self, f.name) for f in fields(self) if getattr(self, f.name) is not None}
+
+
+# name: (table, onclause, joins it depends on); JOIN_ORDER keeps dependencies first
+JOINS = {
+    'location': (Location, Event.location_id == Location.id, ()),
+    'region': (Region, Location.region_id == Region.id, ('location',)),
+    'country': (Country, Location.country_id == Country.id, ('location',)),
+    'group': (TerroristGroup, Event.group_id == TerroristGroup.id, ()),
+    'casualties': (Casualties, Event.casualties_id == Casualties.id, ()),
+    'attack_type': (AttackType, Event.attack_type_id == AttackType.id, ()),
+    'target_type': (TargetType, Event.target_type_id == TargetType.id, ())
+}
+JOIN_ORDER = ['location', 'region', 'country', 'group', 'casualties', 'attack_type', 'target_type']
+
+casualty_value = case(
+    (Casualties.killed.isnot(None), Casualties.killed * 2),
+    else_=0
+) + case(
+    (Casualties.wounded.isnot(None), Casualties.wounded),
+    else_=0
+)
+casualty_score = func.sum(casualty_value)
+total_casualties_value = Casualties.killed * 2 + Casualties.wounded
+
+# name: (column, join it needs)
+DIMENSIONS = {
+    'event_id': (Event.id, None),
+    'year': (Event.year, None),
+    'month': (Event.month, None),
+    'day': (Event.day, None),
+    'summary': (Event.summary, None),
+    'success': (Event.success, None),
+    'suicide': (Event.suicide, None),
+    'killed': (Casualties.killed, 'casualties'),
+    'wounded': (Casualties.wounded, 'casualties'),
+    'latitude': (Location.latitude, 'location'),
+    'longitude': (Location.longitude, 'location'),
+    'region': (Region.name, 'region'),
+    'country': (Country.name, 'country'),
+    'group_name': (TerroristGroup.group_name, 'group'),
+    'attack_type': (AttackType.name, 'attack_type'),
+    'target_type': (TargetType.name, 'target_type')
+}
+
+MEASURES = {
+    'event_count': (func.count(Event.id), None),
+    'casualty_score': (casualty_score, 'casualties'),
+    'total_casualties': (func.sum(total_casualties_value), 'casualties'),
+    'first_year': (func.min(Event.year), None),
+    'last_year': (func.max(Event.year), None),
+    'avg_lat': (func.avg(Location.latitude), 'location'),
+    'avg_lon': (func.avg(Location.longitude), 'location'),
+    # averaged over mappable locations only, without dropping the other events' rows;
+    # typed so a region without any reads as NaN like the other float measures
+    'valid_avg_lat': (type_coerce(func.avg(case((Location.valid_coordinates, Location.latitude))), Float), 'location'),
+    'valid_avg_lon': (type_coerce(func.avg(case((Location.valid_coordinates, Location.longitude))), Float), 'location'),
+    'perpetrator_count': (func.count(TerroristGroup.id), 'group'),
+    'unique_groups': (func.count(distinct(TerroristGroup.id)), 'group'),
+    'group_list': (func.array_agg(distinct(TerroristGroup.group_name)), 'group')
+}
+
+# Measures an event sample estimates by scaling. Counts bound their error by the sampled
+# count, sums by the sum of squares of the summed per-event values, selected next to them
+# under SQUARES_SUFFIX and removed from the result once observed.
+SCALED_MEASURES = {'event_count', 'casualty_score', 'total_casualties', 'perpetrator_count'}
+COUNT_MEASURES = {'event_count', 'perpetrator_count'}
+SUMMED_VALUES = {'casualty_score': casualty_value, 'total_casualties': total_casualties_value}
+
+STATEMENT_CACHE = os.getenv("STATEMENT_CACHE", "true").lower() == "true"
+
+# Name filters (NAME_FILTERS) receive the ids the dimension cache resolved the name to,
+# so they compare foreign keys and never join a dimension table just to filter
+FILTERS = {
+    'region': (lambda region_ids: Location.region_id.in_(region_ids), 'location'),
+    'country': (lambda country_ids: Location.country_id.in_(country_ids), 'location'),
+    'group': (lambda group_id: Event.group_id == group_id, None),
+    'year_from': (lambda value: Event.year >= value, None),
+    'year_to': (lambda value: Event.year <= value, None),
+    'attack_type': (lambda type_id: Event.attack_type_id == type_id, None),
+    'target_type': (lambda type_id: Event.target_type_id == type_id, None)
+}
+# filters whose value is a list of ids
+EXPANDING_FILTERS = {'region', 'country'}
+
+# Per-batch pre-aggregate of events over every name dimension that is cheap to group by.
+# joined_<name> records whether the inner join <name> would have matched, so a query
+# served from it keeps exactly the rows event_query would have kept.
+FACT_DIMENSIONS = ['year', 'month', 'region', 'country', 'group_name', 'attack_type', 'target_type']
+FACT_MEASURES = {
+    'event_count': lambda facts: cast(func.sum(facts.c.event_count), BigInteger),
+    'casualty_score': lambda facts: cast(func.sum(facts.c.casualty_score), BigInteger),
+    'total_casualties': lambda facts: cast(func.sum(facts.c.total_casualties), BigInteger),
+    'first_year': lambda facts: func.min(facts.c.year),
+    'last_year': lambda facts: func.max(facts.c.year)
+}
+FACT_FILTERS = {
+    'region': lambda facts, value: facts.c.region == value,
+    'country': lambda facts, value: facts.c.country == value,
+    'group': lambda facts, value: facts.c.group_name == value,
+    'year_from': lambda facts, value: facts.c.year >= value,
+    'year_to': lambda facts, value: facts.c.year <= value,
+    'attack_type': lambda facts, value: facts.c.attack_type == value,
+    'target_type': lambda facts, value: facts.c.target_type == value
+}
+
+FACTS_TABLE = Table(
+    'batch_event_facts', MetaData(),
+    *(Column(name, DIMENSIONS[name][0].type) for name in FACT_DIMENSIONS),
+    *(Column(f'joined_{name}', Boolean) for name in JOIN_ORDER),
+    Column('event_count', BigInteger),
+    Column('casualty_score', BigInteger),
+    Column('total_casualties', BigInteger)
+)
+
+
+def facts_select():
+    joined = [JOINS[name][0].id.isnot(None) for name in JOIN_ORDER]
+    query = select(
+        *(DIMENSIONS[name][0].label(name) for name in FACT_DIMENSIONS),
+        *(matched.label(f'joined_{name}') for name, matched in zip(JOIN_ORDER, joined)),
+        func.count(Event.id).label('event_count'),
+        casualty_score.label('casualty_score'),
+        MEASURES['total_casualties'][0].label('total_casualties')
+    ).select_from(Event)
+    for name in JOIN_ORDER:
+        table, onclause, _ = JOINS[name]
+        query = query.outerjoin(table, onclause)
+    # grouping by the matched flags rather than the joined ids, which are unique per event
+    # for locations and casualties and would leave one row per event
+    return query.group_by(*(DIMENSIONS[name][0] for name in FACT_DIMENSIONS), *joined)
+
+
+class FactsScope:
+    # Materialises FACTS_TABLE on first use as a temp table dropped with the transaction
+    def __init__(self):
+        self.created = False
+
+    def table(self, session) -> Table:
+        if not self.created:
+            compiled = facts_select().compile(dialect=session.get_bind().dialect,
+                                              compile_kwargs={'literal_binds': True})
+            session.execute(text(
+                f"CREATE TEMP TABLE IF NOT EXISTS {FACTS_TABLE.name} ON COMMIT DROP AS {compiled}"
+            ))
+            self.created = True
+        return FACTS_TABLE
+
+    def reset(self):
+        # after a rollback to a savepoint the table may be gone; IF NOT EXISTS makes re-creation safe
+        self.created = False
+
+
+facts_scope: ContextVar = ContextVar('facts_scope', default=None)
+
+Columns = Union[Iterable[str], Dict[str, str]]
+
+
+def _labeled(names: Columns) -> Dict[str, str]:
+    return dict(names) if isinstance(names, dict) else {name: name for name in names}
+
+
+def _required_joins(names) -> set:
+    required = set(names)
+    required.discard(None)
+    for name in list(required):
+        required.update(JOINS[name][2])
+    return required
+
+
+def facts_query(session, facts: Table, dimensions: Dict[str, str], measures: Dict[str, str],
+                filters: EventFilters, group_by: Iterable[str]):
+    required = _required_joins(
+        [DIMENSIONS[name][1] for name in [*dimensions.values(), *group_by]] +
+        [MEASURES[name][1] for name in measures.values()] +
+        [FILTERS[name][1] for name in filters.active()]
+    )
+    columns = [facts.c[name].label(label) for label, name in dimensions.items()]
+    columns += [FACT_MEASURES[name](facts).label(label) for label, name in measures.items()]
+    conditions = [facts.c[f'joined_{name}'] for name in JOIN_ORDER if name in required]
+    conditions += [FACT_FILTERS[name](facts, value) for name, value in filters.active().items()]
+    query = session.query(*columns).select_from(facts)
+    if conditions:
+        query = query.filter(*conditions)
+    return query.group_by(*(facts.c[name] for name in [*dimensions.values(), *group_by]))
+
+
+def _select_columns(dimensions: Dict[str, str], measures: Dict[str, str], group_by: Iterable[str],
+                    sample=None):
+    required, columns, grouping = set(), [], []
+    for label, name in dimensions.items():
+        column, join = DIMENSIONS[name]
+        columns.append(column.label(label))
+        grouping.append(column)
+        required.add(join)
+    squares = []
+    for label, name in measures.items():
+        column, join = MEASURES[name]
+        if sample is not None and name in SCALED_MEASURES:
+            column = cast(func.round(column * sample.scale), BigInteger)
+            if name in COUNT_MEASURES:
+                sample.count_labels.add(label)
+            else:
+                squares.append(func.sum(SUMMED_VALUES[name] * SUMMED_VALUES[name]).label(label + SQUARES_SUFFIX))
+                sample.sum_labels.add(label)
+        columns.append(column.label(label))
+        required.add(join)
+    columns += squares
+    for name in group_by:
+        column, join = DIMENSIONS[name]
+        grouping.append(column)
+        required.add(join)
+    return columns, grouping, required
+
+
+def filter_params(filters: Optional[EventFilters]) -> Dict[str, object]:
+    # The active filters with names resolved to ids, as FILTERS conditions and the bind
+    # parameters of event_select expect them
+    active = (filters or EventFilters()).active()
+    cache = get_dimension_cache() if set(active) & set(NAME_FILTERS) else None
+    return {name: cache.resolve(name, value) if name in NAME_FILTERS else value for name, value in active.items()}
+
+
+def event_query(session, dimensions: Columns = (), measures: Columns = (),
+                filters: Optional[EventFilters] = None, group_by: Iterable[str] = (),
+                joins: Iterable[str] = (), from_facts: bool = False):
+    # Builds a query rooted at Event that selects the requested dimensions and measures
+    # (a list of names, or a {label: name} dict), applies the filters and joins only the
+    # tables those need. Measures group by every dimension plus any extra group_by names.
+    # from_facts lets a batch serve it from the shared pre-aggregate; callers that set it
+    # must only refine the query through labels, not Event columns. In an approximate
+    # request aggregates over events run on a Bernoulli sample of them, except per-event ones.
+    scope = facts_scope.get()
+    if from_facts and scope is not None and not joins and measures:
+        dimension_names, measure_names = _labeled(dimensions), _labeled(measures)
+        if (set(dimension_names.values()) | set(group_by)) <= set(FACT_DIMENSIONS) and \
+                set(measure_names.values()) <= set(FACT_MEASURES):
+            return facts_query(session, scope.table(session), dimension_names, measure_names,
+                               filters or EventFilters(), group_by)
+
+    sample = approximation.get()
+    if not measures or 'event_id' in {*_labeled(dimensions).values(), *group_by}:
+        sample = None
+    columns, grouping, required = _select_columns(_labeled(dimensions), _labeled(measures), group_by, sample)
+    required.update(joins)
+    conditions = []
+    for name, value in filter_params(filters).items():
+        condition, join = FILTERS[name]
+        conditions.append(condition(value))
+        required.add(join)
+
+    required = _required_joins(required)
+
+    query = session.query(*columns).select_from(Event)
+    for name in JOIN_ORDER:
+        if name in required:
+            table, onclause, _ = JOINS[name]
+            query = query.join(table, onclause)
+    if conditions:
+        query = query.filter(*conditions)
+    if measures:
+        query = query.group_by(*grouping)
+    if sample is not None:
+        query = query.filter(backend.sample_condition(Event.id, sample.percent, sample.seed))
+        sample.used = True
+    return query
+
+
+def statement_cache_usable() -> bool:
+    # sampled and batch pre-aggregated queries differ per request and go through event_query
+    return STATEMENT_CACHE and approximation.get() is None and facts_scope.get() is None
+
+
+def event_select(dimensions: Columns = (), measures: Columns = (), filter_names: Iterable[str] = (),
+                 group_by: Iterable[str] = (), outer: bool = False) -> Select:
+    # Core counterpart of event_query for hot queries. It is built once per shape (the
+    # columns and which filters are set) with every filter a bind parameter named after it,
+    # so a repeated request skips building and compiling the statement and, with psycopg 3,
+    # runs the server-side prepared statement. Execute it with filter_params(filters).
+    # outer keeps events whose optional references (group, location, ...) are missing.
+    return _event_select(tuple(_labeled(dimensions).items()), tuple(_labeled(measures).items()),
+                         frozenset(filter_names), tuple(group_by), outer)
+
+
+@lru_cache(maxsize=None)
+def _event_select(dimensions, measures, filter_names, group_by, outer) -> Select:
+    columns, grouping, required = _select_columns(dict(dimensions), dict(measures), group_by)
+    conditions = []
+    for name in sorted(filter_names):
+        condition, join = FILTERS[name]
+        conditions.append(condition(bindparam(name, expanding=name in EXPANDING_FILTERS)))
+        required.add(join)
+    required = _required_joins(required)
+
+    source = Event.__table__
+    for name in JOIN_ORDER:
+        if name in required:
+            table, onclause, _ = JOINS[name]
+            source = source.join(table.__table__, onclause, isouter=outer)
+    statement = select(*columns).select_from(source)
+    if conditions:
+        statement = statement.where(*conditions)
+    if measures:
+        statement = statement.group_by(*grouping)
+    return statement
+
+
+def hot_statement(session, refine: Callable, dimensions: Columns = (), measures: Columns = (),
+                  filters: Optional[EventFilters] = None, from_facts: bool = False,
+                  **values) -> Tuple[Select, Optional[Dict[str, object]]]:
+    # One definition of a hot repo query for both ways it runs. refine(statement, **values)
+    # adds what the repo needs beyond the columns and filters (conditions on Event columns
+    # or labels, order, limit) and gets a cached event_select, with values as bind
+    # parameters, when statement_cache_usable(), else an event_query with plain values.
+    # Returns the statement and the parameters to execute it with; None parameters mean it
+    # was built for this request only (sampled or from the batch pre-aggregate).
+    if statement_cache_usable():
+        params = filter_params(filters)
+        statement = _hot_statement(refine, tuple(_labeled(dimensions).items()), tuple(_labeled(measures).items()),
+                                   frozenset(params), tuple(sorted(values)))
+        return statement, {**params, **values}
+    query = event_query(session, dimensions, measures, filters, from_facts=from_facts)
+    return refine(query, **values).statement, None
+
+
+@lru_cache(maxsize=None)
+def _hot_statement(refine, dimensions, measures, filter_names, value_names) -> Select:
+    return refine(event_select(dict(dimensions), dict(measures), filter_names),
+                  **{name: bindparam(name) for name in value_names})
+
+
+def hot_columns(session, statement: Select, params: Optional[Dict[str, object]]) -> Dict[str, object]:
+    # Small results of cached statements are read as rows: COPY cannot be prepared and
+    # re-renders its SQL. Per-request statements go through the backend's columnar fetch.
+    if params is None:
+        return backend.fetch_columns(session, statement)
+    return columns_from_rows(statement, session.execute(statement, params).all())
@@ -0,0 +1,121 @@
+import hashlib
+import math
+import os
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, Iterable, Optional, Tuple
+from app.db.psql.data_version import get_data_version
+from app.db.psql.database import session_maker
+from app.db.psql.models import Location
+from app.repository.approximation import exactly
+from app.repository.query_builder import event_query
+
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "12"))
+
+
+class HyperLogLog:
+    # Distinct-count sketch with 2**precision one-byte registers over a 64-bit hash.
+    # Sketches of the same precision merge by taking the register-wise maximum, so a
+    # count over any union of precomputed parts needs no access to the rows.
+    def __init__(self, precision: int = HLL_PRECISION, registers: Optional[bytearray] = None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    @staticmethod
+    def _hash(value) -> int:
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+    def add(self, value):
+        h = self._hash(value)
+        width = 64 - self.precision
+        index, rest = h >> width, h & ((1 << width) - 1)
+        rank = width - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values: Iterable):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small cardinalities: linear counting over the empty registers
+            return m * math.log(m / zeros)
+        return estimate
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def to_bytes(self) -> bytes:
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HyperLogLog':
+        return cls(data[0], bytearray(data[1:]))
+
+
+@dataclass
+class AreaSketches:
+    # Distinct groups per (region, country) and year over events with valid coordinates,
+    # the rows intergroup_activity_repo aggregates; a year range merges its years
+    data_version: str
+    areas: Dict[Tuple[str, str], Dict[Optional[int], HyperLogLog]]
+
+    @classmethod
+    def build(cls, data_version: str) -> 'AreaSketches':
+        with exactly(), session_maker() as session:
+            rows = event_query(
+                session,
+                dimensions=['region', 'country', 'year'],
+                measures=['group_list']
+            ).filter(
+                Location.valid_coordinates
+            ).all()
+        areas = {}
+        for region, country, year, groups in rows:
+            areas.setdefault((region, country), {})[year] = HyperLogLog().update(groups)
+        return cls(data_version, areas)
+
+    def unique_groups(self, region: str, country: str, year_from: Optional[int] = None,
+                      year_to: Optional[int] = None) -> HyperLogLog:
+        merged = HyperLogLog()
+        for year, sketch in self.areas.get((region, country), {}).items():
+            if year_from is not None and (year is None or year < year_from):
+                continue
+            if year_to is not None and (year is None or year > year_to):
+                continue
+            merged.merge(sketch)
+        return merged
+
+
+# Filters the precomputed sketches can answer; others need the exact distinct count
+SKETCH_FILTERS = {'region', 'country', 'year_from', 'year_to'}
+
+_lock = Lock()
+_sketches: Dict[str, AreaSketches] = {}
+
+
+def get_area_sketches() -> AreaSketches:
+    current = get_data_version()
+    sketches = _sketches.get('current')
+    if sketches is not None and sketches.data_version == current:
+        return sketches
+    with _lock:
+        sketches = _sketches.get('current')
+        if sketches is None or sketches.data_version != current:
+            sketches = AreaSketches.build(current)
+            _sketches['current'] = sketches
+        return sketches
+
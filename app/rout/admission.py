@@ -0,0 +1,97 @@
+import os
+import threading
+from dataclasses import dataclass
+from functools import wraps
+from flask import jsonify, request
+from app.rout.deadlines import outside_request_budget
+from app.rout.metrics import metrics
+
+
+@dataclass(frozen=True)
+class CostClass:
+    name: str
+    max_concurrent: int
+    max_queue: int
+    queue_timeout: float
+    retry_after: int
+
+
+def cost_class_from_env(name, max_concurrent, max_queue, queue_timeout, retry_after) -> CostClass:
+    prefix = f"ADMISSION_{name.upper()}"
+    return CostClass(
+        name,
+        int(os.getenv(f"{prefix}_CONCURRENCY", max_concurrent)),
+        int(os.getenv(f"{prefix}_QUEUE", max_queue)),
+        float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", queue_timeout)),
+        int(os.getenv(f"{prefix}_RETRY_AFTER", retry_after))
+    )
+
+
+COST_CLASSES = {
+    'cheap': cost_class_from_env('cheap', 16, 64, 2, 1),
+    'moderate': cost_class_from_env('moderate', 6, 24, 5, 5),
+    'expensive': cost_class_from_env('expensive', 2, 4, 10, 30),
+    # bulk exports stream for minutes, so they are rejected rather than queued
+    'export': cost_class_from_env('export', 2, 0, 0, 60)
+}
+
+
+class AdmissionGate:
+    # At most max_concurrent requests of a class compute at once, at most max_queue wait
+    # for a slot (each for up to queue_timeout); anything beyond that is rejected at once
+    def __init__(self, cost_class: CostClass):
+        self.cost_class = cost_class
+        self._slots = threading.BoundedSemaphore(cost_class.max_concurrent)
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        if self._slots.acquire(blocking=False):
+            return True
+        with self._lock:
+            if self._waiting >= self.cost_class.max_queue:
+                return False
+            self._waiting += 1
+        try:
+            return self._slots.acquire(timeout=self.cost_class.queue_timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def release(self):
+        self._slots.release()
+
+
+gates = {name: AdmissionGate(cost_class) for name, cost_class in COST_CLASSES.items()}
+
+
+def admission(cost_class: str):
+    # Sits below the cache and coalescing layers, so cache hits and requests that join
+    # an in-flight computation never take a slot. A streamed response keeps its slot
+    # until the body has been sent.
+    gate = gates[cost_class]
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if outside_request_budget():
+                return view(*args, **kwargs)
+            if not gate.try_acquire():
+                metrics.increment(f'admission_rejected_{cost_class}', request.endpoint)
+                response = jsonify(error='Server busy, retry later', cost_class=cost_class)
+                response.status_code = 503
+                response.headers['Retry-After'] = str(gate.cost_class.retry_after)
+                return response
+            metrics.increment(f'admission_admitted_{cost_class}', request.endpoint)
+            try:
+                response = view(*args, **kwargs)
+            except BaseException:
+                gate.release()
+                raise
+            if getattr(response, 'is_streamed', False):
+                response.call_on_close(gate.release)
+            else:
+                gate.release()
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,34 @@
+from functools import wraps
+from flask import abort, request
+from app.repository.approximation import APPROX_SAMPLE_PERCENT, Approximation, approximation
+
+APPROXIMATE_HEADER = 'X-Approximate'
+ERROR_BOUND_HEADER = 'X-Error-Bound'
+MIN_SAMPLE_PERCENT = 0.1
+
+
+def approximate():
+    # approx=true runs the view's aggregations over a sample of events (sample=<percent>,
+    # default APPROX_SAMPLE_PERCENT). When any query was actually estimated the response
+    # says so and carries the 95% relative error bound of its least certain figure.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.args.get('approx', 'false').lower() != 'true':
+                return view(*args, **kwargs)
+            percent = request.args.get('sample', type=float, default=APPROX_SAMPLE_PERCENT)
+            if not MIN_SAMPLE_PERCENT <= percent <= 100:
+                abort(400, f"sample must be between {MIN_SAMPLE_PERCENT} and 100 percent")
+            sample = Approximation(percent)
+            token = approximation.set(sample)
+            try:
+                response = view(*args, **kwargs)
+            finally:
+                approximation.reset(token)
+            if sample.used:
+                response.headers[APPROXIMATE_HEADER] = f"sample={percent:g}%"
+                bound = sample.error_bound()
+                response.headers[ERROR_BOUND_HEADER] = 'unknown' if bound is None else f"{bound:.4f}"
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,122 @@
+import base64
+import os
+import time
+from flask import Blueprint, current_app, jsonify, request
+from sqlalchemy.exc import OperationalError
+from werkzeug.exceptions import HTTPException
+from app.db.psql.data_version import get_data_version
+from app.db.psql.database import engine, session_maker, shared_session, statement_deadline
+from app.memory_budget import MemoryBudgetExceeded
+from app.repository.backends import backend
+from app.repository.query_builder import FactsScope, facts_scope
+from app.rout.admission import admission
+from app.rout.deadlines import BATCH_ENVIRON_KEY, DEFAULT_DEADLINE, deadline_for, is_query_canceled
+from app.rout.metrics import metrics
+from app.rout.memory_profiling import install_memory_accounting
+
+batch_blueprint = Blueprint('batch', __name__)
+install_memory_accounting(batch_blueprint)
+
+BATCH_MAX_SPECS = int(os.getenv("BATCH_MAX_SPECS", "12"))
+BATCH_DEADLINE = deadline_for('batch', 2 * DEFAULT_DEADLINE)
+
+
+def spec_result(spec, status, body=b'', mimetype='application/json'):
+    return {
+        'endpoint': spec['endpoint'],
+        'params': spec['params'],
+        'status': status,
+        'mimetype': mimetype,
+        'body': base64.b64encode(body).decode('ascii')
+    }
+
+
+def rollback_spec(savepoint, scope):
+    if savepoint is not None:
+        savepoint.rollback()
+    if scope is not None:
+        scope.reset()
+
+
+def run_spec(app, session, scope, spec):
+    # Each spec runs under its own savepoint so one failing endpoint does not abort the
+    # snapshot for the rest
+    savepoint = session.begin_nested() if backend.writable else None
+    try:
+        with app.test_request_context(query_string=spec['params'], environ_overrides={BATCH_ENVIRON_KEY: True}):
+            response = app.view_functions[f"stats.{spec['endpoint']}"]()
+            if savepoint is not None:
+                savepoint.commit()
+            return spec_result(spec, response.status_code, response.get_data(), response.mimetype)
+    except HTTPException as e:
+        rollback_spec(savepoint, scope)
+        return spec_result(spec, e.code)
+    except (MemoryBudgetExceeded, MemoryError):
+        rollback_spec(savepoint, scope)
+        return spec_result(spec, 503)
+    except OperationalError as e:
+        rollback_spec(savepoint, scope)
+        if is_query_canceled(e):
+            return spec_result(spec, 504)
+        app.logger.exception("Batch spec %s failed", spec['endpoint'])
+        return spec_result(spec, 500)
+    except Exception:
+        rollback_spec(savepoint, scope)
+        app.logger.exception("Batch spec %s failed", spec['endpoint'])
+        return spec_result(spec, 500)
+
+
+def run_batch(app, specs):
+    # All specs read one REPEATABLE READ snapshot on the primary (the shared pre-aggregate
+    # is a temp table, which replicas and read-only transactions cannot create). Nothing
+    # is written outside temp tables and the transaction is rolled back at the end.
+    # A read-only backend cannot change underneath the batch and gets neither.
+    deadline = time.monotonic() + BATCH_DEADLINE
+    deadline_token = statement_deadline.set(deadline)
+    with session_maker() as session:
+        session._read_engine = engine
+        scope = None
+        if backend.writable:
+            session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+            scope = FactsScope()
+        session_token, scope_token = shared_session.set(session), facts_scope.set(scope)
+        try:
+            results = []
+            for spec in specs:
+                if time.monotonic() >= deadline:
+                    results.append(spec_result(spec, 504))
+                    continue
+                results.append(run_spec(app, session, scope, spec))
+                metrics.increment('batch_specs', spec['endpoint'])
+            return results
+        finally:
+            facts_scope.reset(scope_token)
+            shared_session.reset(session_token)
+            statement_deadline.reset(deadline_token)
+            session.rollback()
+
+
+def parse_specs(payload):
+    specs = payload.get('requests') if isinstance(payload, dict) else payload
+    if not isinstance(specs, list) or not specs:
+        return None, 'Expected a non-empty list of {"endpoint": ..., "params": {...}} specs'
+    if len(specs) > BATCH_MAX_SPECS:
+        return None, f'At most {BATCH_MAX_SPECS} specs per batch'
+    parsed = []
+    for spec in specs:
+        if not isinstance(spec, dict) or f"stats.{spec.get('endpoint')}" not in current_app.view_functions:
+            return None, f'Unknown endpoint in spec {spec!r}'
+        params = spec.get('params') or {}
+        parsed.append({'endpoint': spec['endpoint'], 'params': {k: str(v) for k, v in params.items()}})
+    return parsed, None
+
+
+@batch_blueprint.route('', methods=['POST'])
+@admission('expensive')
+def run_batch_request():
+    specs, error = parse_specs(request.get_json(silent=True))
+    if error:
+        return jsonify(error=error), 400
+    data_version = get_data_version()
+    results = run_batch(current_app._get_current_object(), specs)
+    return jsonify(data_version=data_version, results=results)
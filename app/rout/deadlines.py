@@ -0,0 +1,79 @@
+import os
+import time
+from functools import wraps
+from typing import Callable, Optional
+from flask import Response, abort, request
+from sqlalchemy.exc import OperationalError
+from app.db.psql.database import statement_deadline
+from app.rout.http_cache import STALE_HEADER, artifact_cache, request_key
+from app.rout.metrics import metrics
+
+DEFAULT_DEADLINE = float(os.getenv("QUERY_DEADLINE", "30"))
+FALLBACK_DEADLINE = float(os.getenv("QUERY_FALLBACK_DEADLINE", "5"))
+QUERY_CANCELED = '57014'
+# Set by the job runner, background analyses are not bound by the interactive budgets
+BACKGROUND_ENVIRON_KEY = 'stats.background_job'
+# Set for the endpoints of a batch request, which is admitted and bounded as a whole
+BATCH_ENVIRON_KEY = 'stats.batch'
+
+
+def outside_request_budget() -> bool:
+    return bool(request.environ.get(BACKGROUND_ENVIRON_KEY) or request.environ.get(BATCH_ENVIRON_KEY))
+
+
+def deadline_for(endpoint: str, default: float) -> float:
+    return float(os.getenv(f"QUERY_DEADLINE_{endpoint.upper()}", default))
+
+
+def is_query_canceled(error: OperationalError) -> bool:
+    return (getattr(error.orig, 'pgcode', None) or getattr(error.orig, 'sqlstate', None)) == QUERY_CANCELED
+
+
+def run_with_deadline(seconds: float, fn: Callable[[], Response]) -> Response:
+    token = statement_deadline.set(time.monotonic() + seconds)
+    try:
+        return fn()
+    finally:
+        statement_deadline.reset(token)
+
+
+def with_deadline(seconds: Optional[float] = None, fallback: Optional[Callable[[], Response]] = None,
+                  variant: Optional[Callable[[], str]] = None):
+    # Every statement of the view runs with statement_timeout set to what is left of the
+    # endpoint's budget. When Postgres cancels one, the latest cached artifact for the
+    # same request is served marked stale, else the coarser fallback view, else a 504.
+    def decorator(view):
+        budget = deadline_for(view.__name__, seconds or DEFAULT_DEADLINE)
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if outside_request_budget():
+                return view(*args, **kwargs)
+            try:
+                return run_with_deadline(budget, lambda: view(*args, **kwargs))
+            except OperationalError as e:
+                if not is_query_canceled(e):
+                    raise
+            metrics.increment('deadline_hits', request.endpoint)
+
+            stale = artifact_cache.latest(request_key(variant))
+            if stale is not None:
+                metrics.increment('deadline_stale_served', request.endpoint)
+                response = Response(stale.body, mimetype=stale.mimetype, headers=stale.headers)
+                response.headers[STALE_HEADER] = 'stale'
+                response.headers['Warning'] = '110 - "Response is Stale"'
+                return response
+            if fallback is not None:
+                try:
+                    response = run_with_deadline(FALLBACK_DEADLINE, fallback)
+                except OperationalError as e:
+                    if not is_query_canceled(e):
+                        raise
+                    metrics.increment('deadline_fallback_timeouts', request.endpoint)
+                else:
+                    metrics.increment('deadline_degraded_served', request.endpoint)
+                    response.headers[STALE_HEADER] = 'degraded'
+                    return response
+            abort(504)
+        return wrapper
+    return decorator
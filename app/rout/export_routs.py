@@ -0,0 +1,22 @@
+from flask import Blueprint, Response, abort, request, stream_with_context
+from app.repository.export_repository import EXPORT_FORMATS, PARQUET_AVAILABLE, export_events_repo
+from app.rout.admission import admission
+from app.rout.psql_routs import event_filters_from_request
+
+export_blueprint = Blueprint('export', __name__)
+
+
+# Streams every event matching the stats filters with chunked transfer; no deadline or
+# artifact cache applies, the body is produced while the client reads it
+@export_blueprint.route('')
+@admission('export')
+def export_events():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400, f"Unsupported format '{export_format}'")
+    if export_format == 'parquet' and not PARQUET_AVAILABLE:
+        abort(501, "Parquet export requires pyarrow")
+    chunks = export_events_repo(export_format, event_filters_from_request())
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format], headers={
+        'Content-Disposition': f'attachment; filename="events.{export_format}"'
+    })
@@ -0,0 +1,175 @@
+import gzip
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import wraps
+from threading import Lock
+from typing import Callable, Dict, Optional
+from flask import Response, request
+from app.db.psql.data_version import get_data_version
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "60"))
+ARTIFACT_CACHE_MAX_BYTES = int(os.getenv("ARTIFACT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+ARTIFACT_MAX_BYTES = int(os.getenv("ARTIFACT_MAX_BYTES", str(32 * 1024 * 1024)))
+COMPRESSIBLE_MIMETYPES = {'text/html', 'image/svg+xml', 'application/json'}
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 9
+STALE_HEADER = 'X-Artifact-Stale'
+# headers describing the body itself, kept with the artifact and replayed on every hit
+ARTIFACT_HEADERS = ('X-Approximate', 'X-Error-Bound')
+
+
+@dataclass
+class Artifact:
+    body: bytes
+    mimetype: str
+    encoded: Dict[str, bytes] = field(default_factory=dict)
+    headers: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(body) for body in self.encoded.values())
+
+    def encode(self, encoding: str) -> bytes:
+        if encoding not in self.encoded:
+            if encoding == 'br':
+                self.encoded[encoding] = brotli.compress(self.body, quality=BROTLI_QUALITY)
+            else:
+                self.encoded[encoding] = gzip.compress(self.body, compresslevel=GZIP_LEVEL)
+        return self.encoded[encoding]
+
+
+class ArtifactCache:
+    # Bounded by total bytes rather than entry count, so many small thumbnails can stay
+    # cached next to a few large maps; artifacts bigger than max_artifact_bytes are not kept
+    def __init__(self, max_bytes: int, max_artifact_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_artifact_bytes = max_artifact_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._latest = {}
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[Artifact]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, artifact: Artifact, request_key: Optional[str] = None):
+        size = artifact.size
+        with self._lock:
+            if request_key is not None:
+                self._latest[request_key] = key
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_artifact_bytes:
+                return
+            self._entries[key] = (artifact, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def latest(self, request_key: str) -> Optional[Artifact]:
+        # Most recent artifact for a request regardless of data version, used as a stale
+        # fallback when a fresh render cannot finish in time
+        with self._lock:
+            entry = self._entries.get(self._latest.get(request_key))
+            return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._latest.clear()
+            self.size = 0
+
+
+artifact_cache = ArtifactCache(ARTIFACT_CACHE_MAX_BYTES, ARTIFACT_MAX_BYTES)
+
+
+# endpoint: the parameters its view fills in from the clock when the request leaves them
+# out. They are part of the request key, so cached artifacts and ETags roll over with them.
+CLOCK_DEFAULTS: Dict[str, Callable[[], Dict[str, str]]] = {}
+
+
+def request_key(variant: Optional[Callable[[], str]] = None) -> str:
+    params = list(request.args.items(multi=True))
+    if request.endpoint in CLOCK_DEFAULTS:
+        params += [(k, v) for k, v in CLOCK_DEFAULTS[request.endpoint]().items() if k not in request.args]
+    args = '&'.join(f"{k}={v}" for k, v in sorted(params))
+    key = f"{request.endpoint}?{args}"
+    return f"{key}#{variant()}" if variant else key
+
+
+def make_etag(key: str, data_version: str) -> str:
+    return hashlib.sha256(f"{data_version}|{key}".encode()).hexdigest()[:32]
+
+
+def preferred_encoding() -> str:
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return 'identity'
+
+
+def conditional_response(max_age: int = CACHE_MAX_AGE, variant: Optional[Callable[[], str]] = None):
+    # Strong ETags are derived from the data version and the request parameters, so a
+    # revalidation is answered with 304 before any query runs. Every representation
+    # (content-encoding) gets its own ETag and compressed bodies are cached with the artifact.
+    # `variant` distinguishes representations negotiated from headers (e.g. Accept) rather
+    # than from the query string.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request_key(variant)
+            base_etag = make_etag(key, get_data_version())
+            encoding = preferred_encoding()
+            etag = f"{base_etag}-{encoding}"
+
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                artifact = artifact_cache.get(base_etag)
+                if artifact is None:
+                    result = view(*args, **kwargs)
+                    if result.status_code != 200 or STALE_HEADER in result.headers:
+                        result.cache_control.no_store = True
+                        return result
+                    artifact = Artifact(result.get_data(), result.mimetype, headers={
+                        name: result.headers[name] for name in ARTIFACT_HEADERS if name in result.headers
+                    })
+                    artifact_cache.put(base_etag, artifact, key)
+
+                body = artifact.body
+                response = Response(mimetype=artifact.mimetype, headers=artifact.headers)
+                if (encoding != 'identity' and artifact.mimetype in COMPRESSIBLE_MIMETYPES
+                        and len(body) >= MIN_COMPRESS_SIZE):
+                    if encoding not in artifact.encoded:
+                        artifact.encode(encoding)
+                        artifact_cache.put(base_etag, artifact)
+                    body = artifact.encoded[encoding]
+                    response.content_encoding = encoding
+                response.set_data(body)
+
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            response.vary.add('Accept-Encoding')
+            if variant:
+                response.vary.add('Accept')
+            return response
+        return wrapper
+    return decorator
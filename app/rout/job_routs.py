@@ -0,0 +1,60 @@
+from flask import Blueprint, Response, abort, current_app, jsonify, request, url_for
+from app.db.psql.data_version import get_data_version
+from app.rout.deadlines import BACKGROUND_ENVIRON_KEY
+from app.service.job_service import job_manager
+
+jobs_blueprint = Blueprint('jobs', __name__)
+
+JOB_ANALYSES = {'group_activity_expansion', 'groups_coparticipation', 'common_attack_strategies'}
+MAX_WAIT_SECONDS = 60
+
+
+def run_stats_view(app, endpoint, params):
+    # Runs the regular stats route (argument parsing, repo and service) outside of the
+    # original request so the job produces exactly the artifact the sync endpoint would
+    with app.test_request_context(query_string=params, environ_overrides={BACKGROUND_ENVIRON_KEY: True}):
+        response = app.view_functions[f'stats.{endpoint}']()
+        if response.status_code != 200:
+            raise RuntimeError(f"{endpoint} returned {response.status}")
+        return response.get_data(), response.mimetype
+
+
+def job_status(job):
+    return {
+        **job.to_dict(),
+        'status_url': url_for('jobs.get_job', job_id=job.id),
+        'result_url': url_for('jobs.get_job_result', job_id=job.id)
+    }
+
+
+@jobs_blueprint.route('/<analysis>', methods=['POST'])
+def submit_job(analysis):
+    if analysis not in JOB_ANALYSES:
+        abort(404)
+    params = request.get_json(silent=True) or request.form.to_dict() or request.args.to_dict()
+    params = {k: str(v) for k, v in params.items()}
+    app = current_app._get_current_object()
+    job = job_manager.submit(analysis, params, get_data_version(),
+                             lambda: run_stats_view(app, analysis, params))
+    return jsonify(job_status(job)), 200 if job.finished else 202
+
+
+@jobs_blueprint.route('/<job_id>')
+def get_job(job_id):
+    wait = min(request.args.get('wait', type=float, default=0), MAX_WAIT_SECONDS)
+    job = job_manager.wait(job_id, wait) if wait > 0 else job_manager.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job_status(job))
+
+
+@jobs_blueprint.route('/<job_id>/result')
+def get_job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        abort(404)
+    if job.status == 'failed':
+        return jsonify(job_status(job)), 500
+    if job.status != 'done':
+        return jsonify(job_status(job)), 202
+    return Response(job_manager.result(job), mimetype=job.mimetype)
@@ -0,0 +1,127 @@
+import gc
+import os
+import time
+import tracemalloc
+from threading import Lock
+from flask import jsonify, request
+from app.memory_budget import MEMORY_BUDGET_MB, MemoryBudgetExceeded, max_rss_bytes, request_rss, rss_bytes
+from app.rout.metrics import metrics
+
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "false").lower() == "true"
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "1"))
+MEMORY_TOP_SITES = int(os.getenv("MEMORY_TOP_SITES", "10"))
+MB = 2 ** 20
+
+
+def top_sites(snapshot, baseline=None, limit=MEMORY_TOP_SITES):
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    if baseline is None:
+        stats = snapshot.statistics('lineno')[:limit]
+        return [{'site': str(stat.traceback), 'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+                for stat in stats]
+    stats = [stat for stat in snapshot.compare_to(baseline, 'lineno') if stat.size_diff > 0][:limit]
+    return [{'site': str(stat.traceback), 'size_diff_kb': round(stat.size_diff / 1024, 1),
+             'count_diff': stat.count_diff} for stat in stats]
+
+
+class MemoryProfiles:
+    # Latest and worst (largest RSS growth) request per endpoint, with their top allocation
+    # sites. tracemalloc snapshots are process-wide, so under concurrency a request's sites
+    # include what other requests allocated meanwhile.
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = Lock()
+
+    def record(self, endpoint, profile):
+        with self._lock:
+            entry = self._endpoints.setdefault(endpoint, {'latest': None, 'worst': None})
+            entry['latest'] = profile
+            if entry['worst'] is None or profile['rss_delta_mb'] >= entry['worst']['rss_delta_mb']:
+                entry['worst'] = profile
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: dict(entry) for endpoint, entry in self._endpoints.items()}
+
+
+profiles = MemoryProfiles()
+
+
+def start_accounting():
+    if not (MEMORY_PROFILING or MEMORY_BUDGET_MB):
+        return
+    request_rss.set(rss_bytes())
+    if MEMORY_PROFILING:
+        request.environ['memory.max_rss'] = max_rss_bytes()
+        request.environ['memory.snapshot'] = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+
+
+def finish_accounting(response):
+    start = request_rss.get()
+    if not MEMORY_PROFILING or start is None or request.endpoint is None:
+        return response
+    endpoint = request.endpoint
+    rss_delta = (rss_bytes() - start) / MB
+    max_rss_growth = (max_rss_bytes() - request.environ['memory.max_rss']) / MB
+    current, peak = tracemalloc.get_traced_memory()
+    metrics.observe('memory_rss_delta_mb', endpoint, rss_delta)
+    metrics.observe('memory_max_rss_growth_mb', endpoint, max_rss_growth)
+    metrics.observe('memory_traced_peak_mb', endpoint, peak / MB)
+    profiles.record(endpoint, {
+        'at': time.time(),
+        'path': request.full_path,
+        'status': response.status_code,
+        'rss_delta_mb': round(rss_delta, 1),
+        'max_rss_growth_mb': round(max_rss_growth, 1),
+        'traced_peak_mb': round(peak / MB, 1),
+        'top_sites': top_sites(tracemalloc.take_snapshot(), request.environ['memory.snapshot'])
+    })
+    return response
+
+
+def end_accounting(_error=None):
+    request_rss.set(None)
+
+
+def memory_error_response(error):
+    # Budget overruns are raised at checkpoints; a MemoryError means an allocation already
+    # failed. Either way the request's objects are released and the worker carries on.
+    gc.collect()
+    if isinstance(error, MemoryBudgetExceeded):
+        metrics.increment('memory_budget_exceeded', request.endpoint)
+        message = str(error)
+    else:
+        metrics.increment('memory_errors', request.endpoint)
+        message = 'Out of memory while processing the request'
+    response = jsonify(error=message)
+    response.status_code = 503
+    return response
+
+
+def install_memory_accounting(blueprint):
+    if MEMORY_PROFILING and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+    blueprint.before_request(start_accounting)
+    blueprint.after_request(finish_accounting)
+    blueprint.teardown_request(end_accounting)
+    blueprint.register_error_handler(MemoryBudgetExceeded, memory_error_response)
+    blueprint.register_error_handler(MemoryError, memory_error_response)
+
+
+def memory_report():
+    report = {
+        'rss_mb': round(rss_bytes() / MB, 1),
+        'max_rss_mb': round(max_rss_bytes() / MB, 1),
+        'budget_mb': MEMORY_BUDGET_MB or None,
+        'profiling': MEMORY_PROFILING,
+        'endpoints': profiles.snapshot()
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report['traced'] = {
+            'current_mb': round(current / MB, 1),
+            'peak_mb': round(peak / MB, 1),
+            'top_sites': top_sites(tracemalloc.take_snapshot())
+        }
+    return report
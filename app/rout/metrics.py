@@ -0,0 +1,33 @@
+from collections import defaultdict
+from threading import Lock
+
+
+class Metrics:
+    def __init__(self):
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._observations = defaultdict(dict)
+        self._lock = Lock()
+
+    def increment(self, name: str, endpoint: str, value: int = 1):
+        with self._lock:
+            self._counters[name][endpoint] += value
+
+    def observe(self, name: str, endpoint: str, value: float):
+        with self._lock:
+            stats = self._observations[name].setdefault(endpoint, {'count': 0, 'sum': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['sum'] += value
+            stats['max'] = max(stats['max'], value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': {name: dict(values) for name, values in self._counters.items()},
+                'observations': {
+                    name: {endpoint: dict(stats) for endpoint, stats in values.items()}
+                    for name, values in self._observations.items()
+                }
+            }
+
+
+metrics = Metrics()
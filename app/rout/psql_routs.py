@@ -1,134 +1,385 @@
+from collections import OrderedDict
 from datetime import datetime
-from flask import Blueprint, Response, request
+from threading import Lock
+from flask import Blueprint, Response, request, abort, jsonify, url_for
 from app.repository.psql_repository import deadliest_attacks_repo, casualties_by_region_repo, top_casualty_groups_repo, \
     attack_target_correlation_repo, attack_trends_repo, attack_change_by_region_repo, terror_heatmap_repo, \
     active_groups_heatmap_repo, perpetrators_casualties_correlation_repo, events_casualties_correlation_repo, \
     groups_common_goals_repo, group_activity_expansion_repo, groups_coparticipation_repo, common_attack_strategies_repo, \
-    intergroup_activity_repo
+    intergroup_activity_repo, perpetrators_casualties_stats_repo, perpetrators_casualties_density_repo
 from app.service.psql_service import top_casualty_groups_service, casualties_by_region_service, \
     deadliest_attacks_service, attack_target_correlation_service, attack_trends_service, \
     attack_change_by_region_service, terror_heatmap_service, active_groups_heatmap_service, \
     perpetrators_casualties_correlation_service, events_casualties_correlation_service, groups_common_goals_service, \
     group_activity_expansion_service, groups_coparticipation_service, common_attack_strategies_service, \
-    intergroup_activity_service
+    intergroup_activity_service, perpetrators_casualties_density_service, ChartOptions, CHART_MIMETYPES, \
+    groups_common_goals_points, intergroup_activity_points
+from app.service.map_renderer import encode_payload, point_id
+from app.db.psql.data_version import get_data_version
+from app.repository.query_builder import EventFilters
+from app.repository.coparticipation_index import get_coparticipation_index
+from app.repository.dimension_cache import UnknownDimensionValue, check_filter_names
+from app.rout.http_cache import CLOCK_DEFAULTS, conditional_response
+from app.rout.single_flight import coalesce
+from app.rout.admission import admission
+from app.rout.deadlines import with_deadline
+from app.rout.metrics import metrics
+from app.rout.memory_profiling import install_memory_accounting, memory_report
+from app.rout.approximate import approximate
 
 stats_blueprint = Blueprint('stats', __name__)
+install_memory_accounting(stats_blueprint)
+
+MAX_CHART_DPI = 300
+MAX_CHART_PIXELS = 4000
+
+def chart_options_from_request() -> ChartOptions:
+    chart_format = request.args.get('format', type=str)
+    if chart_format is None:
+        mimetype = request.accept_mimetypes.best_match(list(CHART_MIMETYPES.values()), default='image/png')
+        chart_format = next(f for f, m in CHART_MIMETYPES.items() if m == mimetype)
+    if chart_format not in CHART_MIMETYPES:
+        abort(400, f"Unsupported format '{chart_format}'")
+    dpi = request.args.get('dpi', type=int)
+    width = request.args.get('width', type=int)
+    height = request.args.get('height', type=int)
+    if dpi is not None and not 10 <= dpi <= MAX_CHART_DPI:
+        abort(400, f"dpi must be between 10 and {MAX_CHART_DPI}")
+    for size in (width, height):
+        if size is not None and not 16 <= size <= MAX_CHART_PIXELS:
+            abort(400, f"width and height must be between 16 and {MAX_CHART_PIXELS} pixels")
+    return ChartOptions(chart_format, dpi, width, height)
+
+def event_filters_from_request() -> EventFilters:
+    filters = EventFilters(
+        region=request.args.get('region', type=str),
+        country=request.args.get('country', type=str),
+        group=request.args.get('group', type=str),
+        year_from=request.args.get('year_from', type=int),
+        year_to=request.args.get('year_to', type=int),
+        attack_type=request.args.get('attack_type', type=str),
+        target_type=request.args.get('target_type', type=str)
+    )
+    try:
+        check_filter_names(filters)
+    except UnknownDimensionValue as error:
+        abort(404, str(error))
+    return filters
+
+def chart_variant() -> str:
+    return chart_options_from_request().format
+
+def map_details_url(endpoint):
+    # cluster=true renders a clustered map whose popups load from the details endpoint
+    # for the same parameters (approx and sample included, the details are estimated from
+    # the same sample); None renders the full map
+    if request.args.get('cluster', 'false').lower() != 'true':
+        return None
+    params = {k: v for k, v in request.args.items() if k != 'cluster'}
+    return url_for('stats.map_details', map_name=endpoint, **params)
 
 #1
 @stats_blueprint.route('/deadliest_attacks')
+@conditional_response(variant=chart_variant)
+@coalesce(variant=chart_variant)
+@admission('cheap')
+@approximate()
+@with_deadline(variant=chart_variant)
 def deadliest_attacks():
+    options = chart_options_from_request()
     top_n = request.args.get('top_n', type=int, default=5)
-    results = deadliest_attacks_repo(top_n)
-    buf = deadliest_attacks_service(results)
-    return Response(buf.getvalue(), mimetype='image/png')
+    results = deadliest_attacks_repo(top_n, event_filters_from_request())
+    buf = deadliest_attacks_service(results, options)
+    return Response(buf.getvalue(), mimetype=options.mimetype)
 
 #2
 @stats_blueprint.route('/casualties_by_region')
+@conditional_response()
+@coalesce()
+@admission('moderate')
+@approximate()
+@with_deadline()
 def casualties_by_region():
     top_n = request.args.get('top_n', type=int)
-    results = casualties_by_region_repo(top_n)
+    results = casualties_by_region_repo(top_n, event_filters_from_request())
     buf = casualties_by_region_service(results)
     return Response(buf.getvalue(), mimetype='text/html')
 
 #3
 @stats_blueprint.route('/top_casualty_groups')
+@conditional_response(variant=chart_variant)
+@coalesce(variant=chart_variant)
+@admission('cheap')
+@approximate()
+@with_deadline(variant=chart_variant)
 def top_casualty_groups():
-    results = top_casualty_groups_repo()
-    buf = top_casualty_groups_service(results)
-    return Response(buf.getvalue(), mimetype='image/png')
+    options = chart_options_from_request()
+    results = top_casualty_groups_repo(event_filters_from_request())
+    buf = top_casualty_groups_service(results, options)
+    return Response(buf.getvalue(), mimetype=options.mimetype)
 
 #4
 @stats_blueprint.route('/attack_target_correlation')
+@conditional_response(variant=chart_variant)
+@coalesce(variant=chart_variant)
+@admission('cheap')
+@approximate()
+@with_deadline(variant=chart_variant)
 def attack_target_correlation():
-    results = attack_target_correlation_repo()
-    buf = attack_target_correlation_service(results)
-    return Response(buf.getvalue(), mimetype='image/png')
+    options = chart_options_from_request()
+    results = attack_target_correlation_repo(event_filters_from_request())
+    buf = attack_target_correlation_service(results, options)
+    return Response(buf.getvalue(), mimetype=options.mimetype)
 
 #5
+CLOCK_DEFAULTS['stats.attack_trends'] = lambda: {'year': str(datetime.now().year)}
+
 @stats_blueprint.route('/attack_trends')
+@conditional_response(variant=chart_variant)
+@coalesce(variant=chart_variant)
+@admission('cheap')
+@approximate()
+@with_deadline(variant=chart_variant)
 def attack_trends():
+    options = chart_options_from_request()
     year = request.args.get('year', type=int, default=datetime.now().year)
-    annual_trends, monthly_trends = attack_trends_repo(year)
-    buf = attack_trends_service(annual_trends, monthly_trends,year)
-    return Response(buf.getvalue(), mimetype='image/png')
+    annual_trends, monthly_trends = attack_trends_repo(year, event_filters_from_request())
+    buf = attack_trends_service(annual_trends, monthly_trends,year, options)
+    return Response(buf.getvalue(), mimetype=options.mimetype)
 
 #6
 @stats_blueprint.route('/attack_change_by_region')
+@conditional_response(variant=chart_variant)
+@coalesce(variant=chart_variant)
+@admission('moderate')
+@approximate()
+@with_deadline(variant=chart_variant)
 def attack_change_by_region():
+    options = chart_options_from_request()
     top_n = request.args.get('top_n', type=int, default=5)
-    df = attack_change_by_region_repo()
-    buf = attack_change_by_region_service(df, top_n)
-    return Response(buf.getvalue(), mimetype='image/png')
+    df = attack_change_by_region_repo(event_filters_from_request())
+    buf = attack_change_by_region_service(df, top_n, options)
+    return Response(buf.getvalue(), mimetype=options.mimetype)
 
 #7
+# period=month shows the current month (see terror_heatmap_repo)
+CLOCK_DEFAULTS['stats.terror_heatmap'] = lambda: \
+    {'current_month': str(datetime.now().month)} if request.args.get('period') == 'month' else {}
+
 @stats_blueprint.route('/terror_heatmap')
+@conditional_response()
+@coalesce()
+@admission('moderate')
+@approximate()
+@with_deadline()
 def terror_heatmap():
     time_period = request.args.get('period', default='year', type=str)
-    region_filter = request.args.get('region', type=str)
-    locations, current_year = terror_heatmap_repo(time_period,region_filter)
-    buf = terror_heatmap_service(locations, current_year, time_period, region_filter)
+    filters = event_filters_from_request()
+    locations, current_year = terror_heatmap_repo(time_period, filters)
+    buf = terror_heatmap_service(locations, current_year, time_period, filters.region)
     return Response(buf.getvalue(), mimetype='text/html')
 
 #8
 @stats_blueprint.route('/active_groups_heatmap')
+@conditional_response()
+@coalesce()
+@admission('moderate')
+@approximate()
+@with_deadline()
 def active_groups_heatmap():
-    region_filter = request.args.get('region', type=str)
-    results = active_groups_heatmap_repo(region_filter)
-    buf = active_groups_heatmap_service(results,region_filter)
+    filters = event_filters_from_request()
+    results = active_groups_heatmap_repo(filters)
+    buf = active_groups_heatmap_service(results, filters.region)
     return Response(buf.getvalue(), mimetype='text/html')
 
 #9
 @stats_blueprint.route('/perpetrators_casualties_correlation')
+@conditional_response(variant=chart_variant)
+@coalesce(variant=chart_variant)
+@admission('expensive')
+@with_deadline(variant=chart_variant)
 def perpetrators_casualties_correlation():
-    results = perpetrators_casualties_correlation_repo()
-    buf = perpetrators_casualties_correlation_service(results)
-    return Response(buf.getvalue(), mimetype='image/png')
+    options = chart_options_from_request()
+    filters = event_filters_from_request()
+    mode = request.args.get('mode', default='scatter', type=str)
+    if mode == 'density':
+        bins = min(max(request.args.get('bins', type=int, default=50), 5), 200)
+        stats = perpetrators_casualties_stats_repo(filters)
+        grid = perpetrators_casualties_density_repo(stats, bins, filters) if stats.data_points else []
+        buf = perpetrators_casualties_density_service(stats, grid, bins, options)
+    else:
+        results = perpetrators_casualties_correlation_repo(filters)
+        buf = perpetrators_casualties_correlation_service(results, options)
+    return Response(buf.getvalue(), mimetype=options.mimetype)
 
 #10
 @stats_blueprint.route('/events_casualties_correlation')
+@conditional_response(variant=chart_variant)
+@coalesce(variant=chart_variant)
+@admission('cheap')
+@approximate()
+@with_deadline(variant=chart_variant)
 def events_casualties_correlation():
-    region_name = request.args.get('region', type=str)
-    results = events_casualties_correlation_repo(region_name)
-    buf = events_casualties_correlation_service(results, region_name)
-    return Response(buf.getvalue(), mimetype='image/png')
+    options = chart_options_from_request()
+    filters = event_filters_from_request()
+    results = events_casualties_correlation_repo(filters)
+    buf = events_casualties_correlation_service(results, filters.region, options)
+    return Response(buf.getvalue(), mimetype=options.mimetype)
 
 # 11
+def groups_common_goals_coarse():
+    filters = event_filters_from_request()
+    results = groups_common_goals_repo(filters, coarse=True)
+    buf = groups_common_goals_service(results, filters.region, filters.country)
+    return Response(buf.getvalue(), mimetype='text/html')
+
 @stats_blueprint.route('/groups_common_goals')
+@conditional_response()
+@coalesce()
+@admission('expensive')
+@approximate()
+@with_deadline(20, fallback=groups_common_goals_coarse)
 def groups_common_goals():
-    region_filter = request.args.get('region', type=str)
-    country_filter = request.args.get('country', type=str)
-    results = groups_common_goals_repo(region_filter, country_filter)
-    buf = groups_common_goals_service(results, region_filter, country_filter)
+    filters = event_filters_from_request()
+    results = groups_common_goals_repo(filters)
+    details_url = map_details_url('groups_common_goals')
+    if details_url:
+        remember_map_details('groups_common_goals', groups_common_goals_points(results)[0])
+    buf = groups_common_goals_service(results, filters.region, filters.country, details_url)
     return Response(buf.getvalue(), mimetype='text/html')
 
 # 12
 @stats_blueprint.route('/group_activity_expansion')
+@conditional_response()
+@coalesce(timeout=120)
+@admission('expensive')
+@approximate()
+@with_deadline(90)
 def group_activity_expansion():
-    results = group_activity_expansion_repo()
-    buf = group_activity_expansion_service(results)
+    results = group_activity_expansion_repo(event_filters_from_request())
+    buf = group_activity_expansion_service(results, request.args.get('cluster', 'false').lower() == 'true')
     return Response(buf.getvalue(), mimetype='text/html')
 
 # 13
 @stats_blueprint.route('/groups_coparticipation')
+@conditional_response(variant=chart_variant)
+@coalesce(timeout=120, variant=chart_variant)
+@admission('expensive')
+@with_deadline(90, variant=chart_variant)
 def groups_coparticipation():
-    connections = groups_coparticipation_repo()
-    buf = groups_coparticipation_service(connections)
-    return Response(buf.getvalue(), mimetype='image/png')
+    options = chart_options_from_request()
+    connections = groups_coparticipation_repo(event_filters_from_request())
+    buf = groups_coparticipation_service(connections, options)
+    return Response(buf.getvalue(), mimetype=options.mimetype)
 
 # 14
 @stats_blueprint.route('/common_attack_strategies')
+@conditional_response()
+@coalesce(timeout=120)
+@admission('expensive')
+@approximate()
+@with_deadline(90)
 def common_attack_strategies():
-    region_filter = request.args.get('region', type=str)
-    country_filter = request.args.get('country', type=str)
-    results = common_attack_strategies_repo(region_filter, country_filter)
+    results = common_attack_strategies_repo(event_filters_from_request())
     buf = common_attack_strategies_service(results)
     return Response(buf.getvalue(), mimetype='text/html')
 
 # 16
 @stats_blueprint.route('/intergroup_activity')
+@conditional_response()
+@coalesce()
+@admission('moderate')
+@approximate()
+@with_deadline()
 def intergroup_activity():
-    region_filter = request.args.get('region', type=str)
-    country_filter = request.args.get('country', type=str)
-    results = intergroup_activity_repo(region_filter, country_filter)
-    buf = intergroup_activity_service(results, region_filter, country_filter)
-    return Response(buf.getvalue(), mimetype='text/html')
\ No newline at end of file
+    filters = event_filters_from_request()
+    results = intergroup_activity_repo(filters)
+    details_url = map_details_url('intergroup_activity')
+    if details_url:
+        remember_map_details('intergroup_activity', intergroup_activity_points(results))
+    buf = intergroup_activity_service(results, filters.region, filters.country, details_url)
+    return Response(buf.getvalue(), mimetype='text/html')
+
+# 13 - neighbor queries answered from the persisted co-participation index
+def index_group_id(index, name):
+    group_id = index.group_id(name) if name else None
+    if group_id is None:
+        abort(404, f"Unknown group '{name}'")
+    return group_id
+
+@stats_blueprint.route('/groups_coparticipation/partners')
+def groups_coparticipation_partners():
+    index = get_coparticipation_index()
+    group = request.args.get('group', type=str)
+    k = min(max(request.args.get('k', type=int, default=10), 1), 500)
+    partners = index.top_partners(index_group_id(index, group), k)
+    return jsonify(group=group, partners=[{'group': name, 'shared_events': shared} for name, shared in partners])
+
+@stats_blueprint.route('/groups_coparticipation/shared')
+def groups_coparticipation_shared():
+    index = get_coparticipation_index()
+    group_a = request.args.get('group_a', type=str)
+    group_b = request.args.get('group_b', type=str)
+    shared = index.shared_events(index_group_id(index, group_a), index_group_id(index, group_b))
+    return jsonify(group_a=group_a, group_b=group_b, shared_events=shared)
+
+@stats_blueprint.route('/groups_coparticipation/clusters')
+def groups_coparticipation_clusters():
+    index = get_coparticipation_index()
+    min_shared = max(request.args.get('min_shared', type=int, default=1), 1)
+    min_size = max(request.args.get('min_size', type=int, default=2), 2)
+    clusters = [cluster for cluster in index.clusters(min_shared) if len(cluster) >= min_size]
+    return jsonify(min_shared=min_shared, clusters=[{'size': len(c), 'groups': c} for c in clusters])
+
+# map details - popup content of clustered maps. A clustered page keeps the points it was
+# rendered from, keyed by its parameters and data version, and markers ask for theirs by
+# id; a worker that did not render the page recomputes them from the same parameters.
+MAP_DETAILS_CACHE_SIZE = 32
+MAP_DETAIL_SOURCES = {
+    'intergroup_activity': ('intergroup', lambda filters: intergroup_activity_points(intergroup_activity_repo(filters))),
+    'groups_common_goals': ('common_goals', lambda filters: groups_common_goals_points(groups_common_goals_repo(filters))[0])
+}
+_map_details = OrderedDict()
+_map_details_lock = Lock()
+
+def map_details_key(endpoint):
+    params = sorted((k, v) for k, v in request.args.items(multi=True) if k not in ('cluster', 'item'))
+    return endpoint, tuple(params), get_data_version()
+
+def remember_map_details(endpoint, points):
+    map_type = MAP_DETAIL_SOURCES[endpoint][0]
+    details = {point_id(map_type, point): point for point in points}
+    with _map_details_lock:
+        _map_details[map_details_key(endpoint)] = details
+        while len(_map_details) > MAP_DETAILS_CACHE_SIZE:
+            _map_details.popitem(last=False)
+    return details
+
+def map_details_for(endpoint):
+    key = map_details_key(endpoint)
+    with _map_details_lock:
+        details = _map_details.get(key)
+    if details is None:
+        details = remember_map_details(endpoint, MAP_DETAIL_SOURCES[endpoint][1](event_filters_from_request()))
+    return details
+
+@stats_blueprint.route('/<map_name>/details')
+@conditional_response()
+@admission('moderate')
+@approximate()
+@with_deadline()
+def map_details(map_name):
+    if map_name not in MAP_DETAIL_SOURCES:
+        abort(404)
+    point = map_details_for(map_name).get(request.args.get('item', type=str))
+    if point is None:
+        abort(404, f"Unknown item for {map_name}")
+    return Response(encode_payload(point), mimetype='application/json')
+
+@stats_blueprint.route('/metrics')
+def stats_metrics():
+    return jsonify(metrics.snapshot())
+
+@stats_blueprint.route('/debug/memory')
+def debug_memory():
+    return jsonify(memory_report())
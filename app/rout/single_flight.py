@@ -0,0 +1,77 @@
+import os
+from functools import wraps
+from threading import Event, Lock
+from typing import Callable, Optional
+from flask import Response, abort
+from app.rout.http_cache import request_key
+
+COALESCE_TIMEOUT = float(os.getenv("COALESCE_TIMEOUT", "30"))
+
+
+class SingleFlightTimeout(Exception):
+    pass
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def do(self, key, fn, timeout=None):
+        # The first caller for a key runs fn, concurrent callers with the same key wait
+        # for its result (or exception) instead of starting their own computation
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.done.set()
+        elif not call.done.wait(timeout):
+            raise SingleFlightTimeout(key)
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return list(self._calls)
+
+
+single_flight = SingleFlight()
+
+
+def coalesce(timeout: float = COALESCE_TIMEOUT, variant: Optional[Callable[[], str]] = None):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            def compute():
+                response = view(*args, **kwargs)
+                return response.get_data(), response.mimetype, response.status_code, list(response.headers)
+
+            try:
+                body, mimetype, status, headers = single_flight.do(request_key(variant), compute, timeout)
+            except SingleFlightTimeout:
+                abort(504)
+            response = Response(body, status=status, headers=headers)
+            response.mimetype = mimetype
+            return response
+        return wrapper
+    return decorator
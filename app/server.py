@@ -0,0 +1,176 @@
+import argparse
+import gc
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+from app.db.psql.database import engine, replica_engines
+from app.lazy_modules import FAMILIES, warm_up_imports
+from app.main import app
+from app.repository.fan_out import shutdown_executor
+from app.repository.dimension_cache import get_dimension_cache
+from app.repository.sketches import get_area_sketches
+
+WORKERS = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))
+WORKER_MAX_REQUESTS = int(os.getenv("WORKER_MAX_REQUESTS", "0"))
+WORKER_MAX_REQUESTS_JITTER = int(os.getenv("WORKER_MAX_REQUESTS_JITTER", "0"))
+WARM_ENDPOINTS = [path for path in os.getenv("WARM_ENDPOINTS", "").split(",") if path]
+PRECOMPUTE_SKETCHES = os.getenv("PRECOMPUTE_SKETCHES", "false").lower() == "true"
+WARM_IMPORTS = [family for family in os.getenv("WARM_IMPORTS", ",".join(FAMILIES)).split(",") if family]
+
+
+def warm_up(paths):
+    # Runs in the master before forking, so rendered artifacts, imported modules and
+    # compiled query state are inherited copy-on-write by every worker
+    client = app.test_client()
+    for path in paths:
+        started = time.perf_counter()
+        status = client.get(path).status_code
+        print(f"Warmed {path} ({status}) in {time.perf_counter() - started:.2f}s")
+
+
+def warm_up_dimensions():
+    # Name filters resolve through this cache; loading it here spares every worker the queries
+    started = time.perf_counter()
+    cache = get_dimension_cache()
+    print(f"Loaded {len(cache.regions)} regions, {len(cache.countries)} countries and "
+          f"{len(cache.groups)} groups in {time.perf_counter() - started:.2f}s")
+    if PRECOMPUTE_SKETCHES:
+        # approximate intergroup requests merge these instead of counting distinct groups
+        started = time.perf_counter()
+        sketches = get_area_sketches()
+        print(f"Built distinct group sketches for {len(sketches.areas)} areas "
+              f"in {time.perf_counter() - started:.2f}s")
+
+
+class RecyclingMiddleware:
+    def __init__(self, wsgi_app, max_requests, on_limit):
+        self.wsgi_app = wsgi_app
+        self.max_requests = max_requests
+        self.on_limit = on_limit
+        self.served = 0
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.active += 1
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self._finished()
+            raise
+        # A streamed body (exports) is still being sent after the call returns; the
+        # request only counts as served once the server closes the response
+        return ClosingIterator(response, self._finished)
+
+    def _finished(self):
+        with self._lock:
+            self.active -= 1
+            self.served += 1
+            if self.served == self.max_requests:
+                threading.Thread(target=self.on_limit, daemon=True).start()
+
+    def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self.active and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+
+def run_worker(listener, max_requests):
+    # The engines were created (and possibly used) in the master; drop the inherited pools
+    # without closing the master's connections so this worker opens its own lazily
+    for inherited in [engine, *replica_engines]:
+        inherited.dispose(close=False)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    host, port = listener.getsockname()[:2]
+    if not max_requests:
+        make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+        os._exit(0)
+    recycler = RecyclingMiddleware(app, max_requests, lambda: server.shutdown())
+    server = make_server(host, port, recycler, threaded=True, fd=listener.fileno())
+    server.serve_forever()
+    recycler.drain(timeout=30)
+    os._exit(0)
+
+
+def spawn_worker(listener, max_requests, jitter):
+    limit = max_requests + random.randint(0, jitter) if max_requests else 0
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(listener, limit)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def serve(host, port, workers, max_requests, jitter, warm_paths, warm_imports):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(1024)
+    listener.set_inheritable(True)
+
+    warm_up_imports(warm_imports)
+    warm_up_dimensions()
+    warm_up(warm_paths)
+    shutdown_executor()
+    # Keep the warmed objects out of the collector so gc passes in the workers do not
+    # touch (and un-share) their pages
+    gc.collect()
+    gc.freeze()
+
+    children = {spawn_worker(listener, max_requests, jitter) for _ in range(workers)}
+    print(f"Master {os.getpid()} serving on http://{host}:{port} with {workers} workers")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            children.add(spawn_worker(listener, max_requests, jitter))
+    listener.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-forking production server for the SQL stats API")
+    parser.add_argument('--host', default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument('--port', type=int, default=int(os.getenv("PORT", "5001")))
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--max-requests', type=int, default=WORKER_MAX_REQUESTS,
+                        help="recycle a worker after this many requests (0 disables recycling)")
+    parser.add_argument('--max-requests-jitter', type=int, default=WORKER_MAX_REQUESTS_JITTER)
+    parser.add_argument('--warm', action='append', default=list(WARM_ENDPOINTS),
+                        help="path to render in the master before forking, may be repeated")
+    parser.add_argument('--warm-imports', default=",".join(WARM_IMPORTS),
+                        help="comma separated import families (data, charts, maps) loaded before forking")
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.workers, args.max_requests, args.max_requests_jitter, args.warm,
+          [family for family in args.warm_imports.split(",") if family])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
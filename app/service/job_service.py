@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, Optional, Tuple
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", "200"))
+# Shared by every worker process of the server; jobs outlive the worker that ran them
+JOB_DIR = os.getenv("JOB_DIR", os.path.join(tempfile.gettempdir(), 'stats-jobs'))
+JOB_POLL_INTERVAL = 0.1
+JOB_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+@dataclass
+class Job:
+    id: str
+    analysis: str
+    params: Dict[str, str]
+    data_version: str
+    status: str = 'queued'
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    mimetype: Optional[str] = None
+    error: Optional[str] = None
+    # the worker process running the job
+    pid: int = field(default_factory=os.getpid)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    @property
+    def key(self) -> str:
+        params = json.dumps(sorted(self.params.items()))
+        return hashlib.sha256(f"{self.analysis}|{params}|{self.data_version}".encode()).hexdigest()[:32]
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'analysis': self.analysis,
+            'params': self.params,
+            'status': self.status,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'error': self.error
+        }
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobManager:
+    # Jobs are files in a directory shared by the worker processes, so a status poll or a
+    # result download can land on any worker: <id>.json holds the state, <id>.body the
+    # result and key-<digest> the job an identical submission reuses. A job runs in the
+    # worker that accepted it; one whose worker exited before finishing reads as failed.
+    def __init__(self, directory: str, workers: int, retention: int):
+        self.directory = directory
+        self.workers = workers
+        self.retention = retention
+        self._executor = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _write(self, name: str, data: bytes):
+        # readers in other processes only ever see a complete file
+        temporary = self._path(f"{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, self._path(name))
+
+    def _save(self, job: Job):
+        self._write(f"{job.id}.json", json.dumps(asdict(job)).encode())
+
+    def _remove(self, *names: str):
+        for name in names:
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Started by the first submission in each process, never inherited from the master
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='analysis-job')
+            return self._executor
+
+    def _reset_after_fork(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, analysis: str, params: Dict[str, str], data_version: str,
+               runner: Callable[[], Tuple[bytes, str]]) -> Job:
+        # Identical submissions against the same data version reuse the queued, running
+        # or completed job, whichever worker accepted it, instead of scheduling it again
+        job = Job(uuid.uuid4().hex, analysis, params, data_version)
+        existing = self._job_for_key(job.key)
+        if existing is not None and existing.status != 'failed':
+            return existing
+        self._save(job)
+        try:
+            fd = os.open(self._path(f"key-{job.key}"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # another submission got there first, unless what it points at has failed
+            existing = self._job_for_key(job.key)
+            if existing is not None and existing.status != 'failed':
+                self._remove(f"{job.id}.json")
+                return existing
+            self._write(f"key-{job.key}", job.id.encode())
+        else:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(job.id.encode())
+        self._evict()
+        self._get_executor().submit(self._run, job, runner)
+        return job
+
+    def _job_for_key(self, key: str) -> Optional[Job]:
+        try:
+            with open(self._path(f"key-{key}"), 'rb') as f:
+                job_id = f.read().decode()
+        except FileNotFoundError:
+            return None
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        try:
+            with open(self._path(f"{job_id}.json"), 'rb') as f:
+                job = Job(**json.loads(f.read()))
+        except FileNotFoundError:
+            return None
+        if not job.finished and not _process_alive(job.pid):
+            job.status, job.error = 'failed', 'the worker running the job exited'
+        return job
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        deadline = time.monotonic() + timeout
+        job = self.get(job_id)
+        while job is not None and not job.finished and time.monotonic() < deadline:
+            time.sleep(JOB_POLL_INTERVAL)
+            job = self.get(job_id)
+        return job
+
+    def result(self, job: Job) -> bytes:
+        with open(self._path(f"{job.id}.body"), 'rb') as f:
+            return f.read()
+
+    def _run(self, job: Job, runner: Callable[[], Tuple[bytes, str]]):
+        job.status = 'running'
+        self._save(job)
+        try:
+            body, job.mimetype = runner()
+            self._write(f"{job.id}.body", body)
+            job.status = 'done'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+            self._save(job)
+
+    def _evict(self):
+        jobs = [self.get(name[:-len('.json')]) for name in os.listdir(self.directory) if name.endswith('.json')]
+        finished = sorted((job for job in jobs if job is not None and job.finished), key=lambda job: job.finished_at or 0)
+        for job in finished[:max(0, len(jobs) - self.retention)]:
+            current = self._job_for_key(job.key)
+            if current is not None and current.id == job.id:
+                self._remove(f"key-{job.key}")
+            self._remove(f"{job.id}.json", f"{job.id}.body")
+
+
+job_manager = JobManager(JOB_DIR, JOB_WORKERS, JOB_RETENTION)
+os.register_at_fork(after_in_child=job_manager._reset_after_fork)
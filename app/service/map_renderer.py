@@ -0,0 +1,307 @@
+import hashlib
+import io
+import json
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict, Tuple
+from app.memory_budget import check_memory_budget
+
+# Every map type is a static HTML/Leaflet page compiled once per process. A request only
+# serialises its data into the page (var DATA = {...}); markers, popups and panels are
+# built in the browser from that data, with canvas-rendered vector markers.
+LEAFLET_VERSION = '1.9.4'
+LEAFLET_CSS = f'https://unpkg.com/leaflet@{LEAFLET_VERSION}/dist/leaflet.css'
+LEAFLET_JS = f'https://unpkg.com/leaflet@{LEAFLET_VERSION}/dist/leaflet.js'
+LEAFLET_HEAT_JS = 'https://unpkg.com/leaflet.heat@0.2.0/dist/leaflet-heat.js'
+MARKERCLUSTER_URL = 'https://unpkg.com/leaflet.markercluster@1.5.3/dist'
+CLUSTER_STYLESHEETS = [f'{MARKERCLUSTER_URL}/MarkerCluster.css', f'{MARKERCLUSTER_URL}/MarkerCluster.Default.css']
+CLUSTER_SCRIPTS = [f'{MARKERCLUSTER_URL}/leaflet.markercluster.js']
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<link rel="stylesheet" href="%(leaflet_css)s">
+<script src="%(leaflet_js)s"></script>
+%(assets)s
+<style>
+html, body, #map { height: 100%%; margin: 0; }
+.panel { position: fixed; bottom: 50px; left: 50px; z-index: 1000; background-color: white;
+         padding: 10px; border: 2px solid #ccc; border-radius: 5px; font-family: sans-serif; }
+.panel h4 { margin: 0 0 6px 0; }
+.panel p { margin: 4px 0; }
+.panel .note { font-size: 0.8em; color: #666; }
+.legend { left: auto; right: 50px; width: 150px; border-radius: 0; }
+.scroll { max-height: 200px; overflow-y: auto; }
+</style>
+</head>
+<body>
+<div id="map"></div>
+%(static_html)s
+<script>
+var DATA = """
+
+COMMON_JS = """;
+function esc(value) {
+    return String(value).replace(/[&<>"']/g, function (c) {
+        return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c];
+    });
+}
+function list(items) {
+    return '<ul>' + items.map(function (item) { return '<li>' + esc(item) + '</li>'; }).join('') + '</ul>';
+}
+function field(label, value) {
+    return '<p><b>' + esc(label) + ':</b> ' + esc(value) + '</p>';
+}
+function clusterLayer() {
+    return L.markerClusterGroup({chunkedLoading: true});
+}
+// Clustered pages carry compact points and their ids; popup content is fetched from
+// DATA.details_url by id on first open
+function withPopup(marker, item, detail, render, options) {
+    if (!DATA.details_url) {
+        return marker.bindPopup(render(detail), options);
+    }
+    marker.bindPopup('Loading...', options);
+    marker.once('popupopen', function () {
+        var separator = DATA.details_url.indexOf('?') < 0 ? '?' : '&';
+        fetch(DATA.details_url + separator + 'item=' + encodeURIComponent(DATA.ids[item]))
+            .then(function (response) { return response.json(); })
+            .then(function (point) { marker.setPopupContent(render(point)); })
+            .catch(function () { marker.setPopupContent('Details unavailable'); });
+    });
+    return marker;
+}
+var map = L.map('map', {preferCanvas: true}).setView(DATA.center || [0, 0], DATA.zoom || 2);
+var target = DATA.cluster ? clusterLayer().addTo(map) : map;
+L.tileLayer('https://{s}.basemap.cartocdn.com/light_all/{z}/{x}/{y}{r}.png', {
+    attribution: '&copy; OpenStreetMap contributors &copy; CARTO', subdomains: 'abcd', maxZoom: 20
+}).addTo(map);
+if (DATA.summary) {
+    var panel = document.createElement('div');
+    panel.className = 'panel';
+    panel.innerHTML = '<h4>' + esc(DATA.summary.title) + '</h4>' + DATA.summary.lines.map(function (line) {
+        return line[0] ? field(line[0], line[1]) : '<p>' + esc(line[1]) + '</p>';
+    }).join('') + (DATA.summary.note ? '<p class="note">' + esc(DATA.summary.note) + '</p>' : '');
+    document.body.appendChild(panel);
+}
+"""
+
+PAGE_TAIL = """
+</script>
+</body>
+</html>
+"""
+
+MAP_TYPES = {
+    # points: [lat, lon, region, events, avg casualties]
+    'casualty_circles': {
+        'js': """
+DATA.points.forEach(function (p) {
+    L.circle([p[0], p[1]], {radius: p[4] * 100000, color: 'red', fill: true})
+        .bindPopup(esc(p[2]) + '<br>Avg Casualties: ' + p[4].toFixed(2) + '<br>Total Events: ' + p[3])
+        .addTo(map);
+});
+"""
+    },
+    # frames: [{label, points: [[lat, lon, weight]]}], animated when there is more than one;
+    # max is the weight that renders at full intensity
+    'heatmap': {
+        'scripts': [LEAFLET_HEAT_JS],
+        'js': """
+var heat = L.heatLayer([], {radius: 15, minOpacity: 0.3, max: DATA.max || 1}).addTo(map);
+L.control.layers(null, {'Terror Hotspots': heat}).addTo(map);
+function showFrame(i) { heat.setLatLngs(DATA.frames[i].points); if (slider) { slider.value = i; label.textContent = DATA.frames[i].label; } }
+var slider = null, label = null;
+if (DATA.frames.length > 1) {
+    var control = L.control({position: 'bottomright'});
+    control.onAdd = function () {
+        var div = L.DomUtil.create('div', 'panel');
+        div.style.position = 'static';
+        div.innerHTML = '<button>&#9654;</button> <input type="range" min="0" max="' + (DATA.frames.length - 1) + '"> <b></b>';
+        L.DomEvent.disableClickPropagation(div);
+        slider = div.querySelector('input'); label = div.querySelector('b');
+        var timer = null, button = div.querySelector('button');
+        function play() {
+            timer = setInterval(function () { showFrame((+slider.value + 1) % DATA.frames.length); }, 1000);
+            button.innerHTML = '&#10074;&#10074;';
+        }
+        button.onclick = function () {
+            if (timer) { clearInterval(timer); timer = null; button.innerHTML = '&#9654;'; } else { play(); }
+        };
+        slider.oninput = function () { showFrame(+slider.value); };
+        play();
+        return div;
+    };
+    control.addTo(map);
+}
+if (DATA.frames.length) { showFrame(0); }
+"""
+    },
+    # regions: [lat, lon, region, [[group, attacks]]]
+    'region_markers': {
+        'js': """
+DATA.regions.forEach(function (r) {
+    var rows = r[3].map(function (g) { return '<tr><td>' + esc(g[0]) + '</td><td>' + g[1] + '</td></tr>'; }).join('');
+    L.marker([r[0], r[1]])
+        .bindPopup('<div style="min-width: 250px"><h4>Active Groups in ' + esc(r[2]) + '</h4><table style="width:100%">' +
+                   '<tr><th>Group</th><th>Attacks</th></tr>' + rows + '</table></div>', {maxWidth: 300})
+        .bindTooltip('Top groups in ' + esc(r[2]))
+        .addTo(map);
+});
+"""
+    },
+    # points: [lat, lon, target type, region, country, attacks, number of groups, [[group, attacks]]];
+    # clustered pages leave out the group list and carry ids: [point id]
+    'common_goals': {
+        'js': """
+function goalsPopup(p) {
+    var groups = p[7].map(function (g) { return g[0] + ' (' + g[1] + ' attacks)'; });
+    return '<div style="min-width: 200px"><h4>Common Target: ' + esc(p[2]) + '</h4>' +
+           field('Region', p[3]) + field('Country', p[4]) + field('Number of Groups', p[6]) +
+           field('Total Attacks', p[5]) + '<hr><h5>Groups:</h5>' + list(groups) + '</div>';
+}
+DATA.points.forEach(function (p, i) {
+    var marker = L.circleMarker([p[0], p[1]], {radius: Math.min(20, p[6] * 3), color: 'red', fill: true});
+    withPopup(marker, i, p, goalsPopup, {maxWidth: 300})
+        .bindTooltip(p[6] + ' groups targeting ' + esc(p[2]))
+        .addTo(target);
+});
+"""
+    },
+    # groups: [{name, region_count, years_active, stops: [[lat, lon, region, year, attacks]]}];
+    # stops are already compact, so clustered pages only cluster them
+    'expansion': {
+        'js': """
+var overlays = {};
+DATA.groups.forEach(function (group) {
+    var layer = L.layerGroup(), n = group.stops.length;
+    var markers = DATA.cluster ? clusterLayer().addTo(layer) : layer;
+    group.stops.forEach(function (s, i) {
+        var color = 'hsl(' + Math.floor(i * 360 / n) + ', 70%, 50%)';
+        L.circleMarker([s[0], s[1]], {radius: 10, color: color, fill: true})
+            .bindPopup('<div style="min-width: 200px"><h4>' + esc(group.name) + '</h4>' + field('Region', s[2]) +
+                       field('Year', s[3]) + field('Attacks', s[4]) + field('Expansion', (i + 1) + ' of ' + n) +
+                       field('Total Regions', group.region_count) + field('Years Active', group.years_active) +
+                       '</div>', {maxWidth: 300})
+            .bindTooltip(esc(group.name) + ' - ' + s[3])
+            .addTo(markers);
+        if (i > 0) {
+            var prev = group.stops[i - 1];
+            L.polyline([[prev[0], prev[1]], [s[0], s[1]]], {color: color, weight: 2, opacity: 0.8})
+                .bindTooltip(prev[3] + ' → ' + s[3])
+                .addTo(layer);
+        }
+    });
+    layer.addTo(map);
+    overlays[esc(group.name) + ' (' + group.region_count + ' regions)'] = layer;
+});
+L.control.layers(null, overlays).addTo(map);
+"""
+    },
+    # points: [lat, lon, location, strategy, groups using it, attacks, [group], [[strategy, groups, attacks]]]
+    'strategies': {
+        'js': """
+DATA.points.forEach(function (p) {
+    var others = p[7].map(function (o) { return o[0] + ' (' + o[1] + ' groups, ' + o[2] + ' attacks)'; });
+    L.circleMarker([p[0], p[1]], {radius: Math.min(20, p[4] * 3), color: 'red', fill: true})
+        .bindPopup('<div style="min-width: 300px"><h4>' + esc(p[2]) + '</h4>' + field('Most Common Strategy', p[3]) +
+                   field('Groups Using This Strategy', p[4]) + field('Total Attacks', p[5]) +
+                   '<hr><p><b>Groups:</b></p>' + list(p[6]) + '<hr><p><b>Other Common Strategies:</b></p>' +
+                   list(others) + '</div>', {maxWidth: 400})
+        .bindTooltip(esc(p[2]) + ': ' + p[4] + ' groups using ' + esc(p[3]))
+        .addTo(map);
+});
+"""
+    },
+    # points: [lat, lon, region, country, unique groups, events, [group]]; clustered pages
+    # leave out the group list and carry ids: [point id]
+    'intergroup': {
+        'static_html': """<div class="panel legend">
+<p style="margin-bottom: 5px;"><b>Events per Group:</b></p>
+<p style="margin: 2px;"><span style="color: red;">&#9679;</span> &gt; 10 events</p>
+<p style="margin: 2px;"><span style="color: orange;">&#9679;</span> 5-10 events</p>
+<p style="margin: 2px;"><span style="color: yellow;">&#9679;</span> &lt; 5 events</p>
+</div>""",
+        'js': """
+var maxGroups = Math.max.apply(null, DATA.points.map(function (p) { return p[4]; }).concat([1]));
+function intergroupPopup(p) {
+    return '<div style="min-width: 300px"><h4>' + esc(p[2]) + ', ' + esc(p[3]) + '</h4>' +
+           field('Unique Groups', p[4]) + field('Total Events', p[5]) +
+           field('Events per Group', (p[5] / p[4]).toFixed(1)) + '<hr><p><b>Active Groups:</b></p>' +
+           '<div class="scroll">' + list(p[6]) + '</div></div>';
+}
+DATA.points.forEach(function (p, i) {
+    var perGroup = p[5] / p[4];
+    var color = perGroup > 10 ? 'red' : perGroup > 5 ? 'orange' : 'yellow';
+    var marker = L.circleMarker([p[0], p[1]], {radius: Math.min(30, p[4] / maxGroups * 30), color: color, fill: true});
+    withPopup(marker, i, p, intergroupPopup, {maxWidth: 400})
+        .bindTooltip(esc(p[2]) + ', ' + esc(p[3]) + ': ' + p[4] + ' groups')
+        .addTo(target);
+});
+"""
+    }
+}
+
+
+# positions in a point of the fields that identify it within its map
+POINT_KEYS = {
+    'common_goals': (0, 1, 2),
+    'intergroup': (2, 3)
+}
+
+
+def point_id(map_type: str, point) -> str:
+    # Derived from what the point stands for rather than its position, so the details of a
+    # marker are found whatever order the points were recomputed in
+    key = json.dumps([point[i] for i in POINT_KEYS[map_type]], default=_json_default)
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def map_shell(map_type: str, clustered: bool = False) -> Tuple[bytes, bytes]:
+    spec = MAP_TYPES[map_type]
+    stylesheets = CLUSTER_STYLESHEETS if clustered else []
+    scripts = spec.get('scripts', []) + (CLUSTER_SCRIPTS if clustered else [])
+    head = PAGE_HEAD % {
+        'leaflet_css': LEAFLET_CSS,
+        'leaflet_js': LEAFLET_JS,
+        'assets': ''.join(
+            [f'<link rel="stylesheet" href="{href}">\n' for href in stylesheets] +
+            [f'<script src="{src}"></script>\n' for src in scripts]
+        ),
+        'static_html': spec.get('static_html', '')
+    }
+    return head.encode('utf-8'), (COMMON_JS + spec['js'] + PAGE_TAIL).encode('utf-8')
+
+
+def _json_default(value):
+    # Postgres numerics, and numpy scalars and arrays coming from column-wise fetches
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+def encode_payload(payload: Dict) -> bytes:
+    # '</' is escaped so data can never close the surrounding <script> element
+    data = json.dumps(payload, separators=(',', ':'), ensure_ascii=False, default=_json_default)
+    return data.replace('</', '<\\/').encode('utf-8')
+
+
+def summary(title: str, *lines, note: str = None) -> Dict:
+    # lines are (label, value) pairs; a None label renders the value as a plain paragraph
+    return {'title': title, 'lines': [[label, value] for label, value in lines], 'note': note}
+
+
+def render_map(map_type: str, payload: Dict) -> io.BytesIO:
+    head, tail = map_shell(map_type, bool(payload.get('cluster')))
+    data = encode_payload(payload)
+    check_memory_budget('map rendering')
+    buf = io.BytesIO()
+    buf.write(head)
+    buf.write(data)
+    buf.write(tail)
+    return buf
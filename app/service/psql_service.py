@@ -1,60 +1,75 @@
+from __future__ import annotations
 import io
-import json
-from math import isnan
-import numpy as np
-import pandas as pd
-from matplotlib import pyplot as plt
-import folium
-from folium import plugins
-import seaborn as sns
+from app.lazy_modules import lazy_import, use_agg_backend
+from app.memory_budget import MemoryBudgetExceeded, check_memory_budget
 from app.repository.psql_repository import get_locations_for_common_attacks
-from toolz import pipe, curry
-from typing import List, Tuple
-
-def create_map(center=None, zoom=2):
-    if center is None:
-        center = [0, 0]
-    return folium.Map(
-        location=center,
-        zoom_start=zoom,
-        tiles='CartoDB positron'
-    )
-@curry
-def validate_coordinates(lat: float, lon: float) -> bool:
-    return (isinstance(lat, (int, float)) and
-            isinstance(lon, (int, float)) and
-            not (np.isnan(lat) or np.isnan(lon)) and
-            -90 <= lat <= 90 and
-            -180 <= lon <= 180 and
-            lat != 0 and lon != 0)
-@curry
-def filter_valid_results(results: List[Tuple]) -> List[Tuple]:
-    return [
-        (region, count, score, lat, lon)
-        for region, count, score, lat, lon in results
-        if validate_coordinates(lat, lon)
-    ]
-@curry
-def create_circle_marker(m: folium.Map, region: str, count: int,
-                        score: float, lat: float, lon: float) -> folium.Map:
-    avg_casualties = score / count if count > 0 else 0
-    folium.Circle(
-        location=[lat, lon],
-        radius=avg_casualties * 100000,
-        color='red',
-        fill=True,
-        popup=f"{region}<br>Avg Casualties: {avg_casualties:.2f}<br>Total Events: {count}"
-    ).add_to(m)
-    return m
-def create_base_map(center: List[float] = None, zoom: int = 2) -> folium.Map:
-    """Create a base Folium map with consistent settings."""
-    return folium.Map(
-        location=center or [0, 0],
-        zoom_start=zoom,
-        tiles='CartoDB positron'
-    )
+from app.repository.fan_out import fan_out
+from app.service.map_renderer import point_id, render_map, summary
+from typing import List, Tuple, Optional
+from dataclasses import dataclass
+
+np = lazy_import('numpy', 'data')
+pd = lazy_import('pandas', 'data')
+plt = lazy_import('matplotlib.pyplot', 'charts', before=use_agg_backend)
+mcolors = lazy_import('matplotlib.colors', 'charts')
+sns = lazy_import('seaborn', 'charts')
+
+CHART_MIMETYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'svg': 'image/svg+xml'
+}
+CHART_SAVE_KWARGS = {
+    'png': {'pil_kwargs': {'optimize': True}},
+    'webp': {'pil_kwargs': {'lossless': True, 'method': 4}},
+    'svg': {}
+}
+# what a chart says instead when the filters leave nothing to plot
+NO_MATCHING_EVENTS = 'No events match the filters'
+INSUFFICIENT_DATA = 'Insufficient data for correlation analysis'
+@dataclass(frozen=True)
+class ChartOptions:
+    format: str = 'png'
+    dpi: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+    @property
+    def mimetype(self) -> str:
+        return CHART_MIMETYPES[self.format]
+def save_figure(options: Optional[ChartOptions] = None, dpi: Optional[int] = None,
+                bbox_inches: Optional[str] = None) -> io.BytesIO:
+    """Save the current pyplot figure in the requested format, resolution and pixel size."""
+    options = options or ChartOptions()
+    fig = plt.gcf()
+    try:
+        check_memory_budget('figure rendering')
+    except MemoryBudgetExceeded:
+        plt.close()
+        raise
+    dpi = options.dpi or dpi or fig.dpi
+    if options.width or options.height:
+        width, height = fig.get_size_inches()
+        scale_w = options.width / dpi / width if options.width else None
+        scale_h = options.height / dpi / height if options.height else None
+        fig.set_size_inches(width * (scale_w or scale_h), height * (scale_h or scale_w))
+        fig.tight_layout()
+        # an explicit pixel size is only honoured without the tight bounding box
+        bbox_inches = None
+    buf = io.BytesIO()
+    plt.savefig(buf, format=options.format, dpi=dpi, bbox_inches=bbox_inches,
+                **CHART_SAVE_KWARGS[options.format])
+    buf.seek(0)
+    plt.close()
+    return buf
+def message_figure(title: str, message: str, options: Optional[ChartOptions] = None) -> io.BytesIO:
+    """Render a chart that only states why there is nothing to plot, e.g. filters matching no events."""
+    plt.figure(figsize=(10, 6))
+    plt.text(0.5, 0.5, message, horizontalalignment='center', verticalalignment='center')
+    plt.title(title)
+    return save_figure(options)
 # 1
-def deadliest_attacks_service(results):
+def deadliest_attacks_service(results, options=None):
     df = pd.DataFrame(results, columns=['attack_type', 'casualty_score'])
     plt.figure(figsize=(10, 6))
     plt.bar(df['attack_type'], df['casualty_score'])
@@ -63,57 +78,42 @@ def deadliest_attacks_service(results):
     plt.ylabel('Casualty Score (Killed×2 + Wounded)')
     plt.xlabel('Attack Type')
     plt.tight_layout()
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=300, bbox_inches='tight')
-    buf.seek(0)
-    plt.close()
-    return buf
+    return save_figure(options, dpi=300, bbox_inches='tight')
 # 2
 def casualties_by_region_service(results: List[Tuple]) -> io.BytesIO:
-    buf = io.BytesIO()
-    pipe(
-        results,
-        filter_valid_results,
-        lambda data: create_base_map(),
-        lambda m: add_all_markers(m, filter_valid_results(results)),
-        lambda m: m.save(buf, close_file=False)
-    )
-    return buf
-def add_all_markers(m: folium.Map, data: List[Tuple]) -> folium.Map:
-    for result in data:
-        m = create_circle_marker(m, *result)
-    return m
+    points = [
+        [lat, lon, region, count, float(score) / count if count > 0 else 0]
+        for region, count, score, lat, lon in results
+    ]
+    return render_map('casualty_circles', {'points': points})
 # 3
-def top_casualty_groups_service(results):
+def top_casualty_groups_service(results, options=None):
     plt.figure(figsize=(10, 6))
-    plt.bar([r[0] for r in results], [r[1] for r in results])
+    # a group whose events have no casualty records has no total
+    plt.bar([r[0] for r in results], [r[1] or 0 for r in results])
     plt.title('Top 5 Most Lethal Terrorist Groups')
     plt.xlabel('Group Name')
     plt.ylabel('Total Casualties')
     plt.xticks(rotation=45)
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
-    return buf
+    return save_figure(options)
 # 4
-def attack_target_correlation_service(results):
+def attack_target_correlation_service(results, options=None):
     df = pd.DataFrame(results, columns=['attack_type', 'target_type', 'event_count'])
     correlation_matrix = df.pivot_table(
         values='event_count',
         index='attack_type',
         columns='target_type'
     ).corr()
+    # fewer than two attack types leave every correlation undefined
+    if correlation_matrix.isna().all().all():
+        return message_figure('Attack-Target Type Correlation',
+                              NO_MATCHING_EVENTS if df.empty else INSUFFICIENT_DATA, options)
     plt.figure(figsize=(10, 8))
     sns.heatmap(correlation_matrix, annot=True, cmap='coolwarm')
     plt.title('Attack-Target Type Correlation')
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
-    return buf
+    return save_figure(options)
 # 5
-def attack_trends_service(annual_trends,monthly_trends,year):
+def attack_trends_service(annual_trends,monthly_trends,year, options=None):
     plt.figure(figsize=(15, 10))
     plt.subplot(2, 1, 1)
     plt.bar([str(trend.year) for trend in annual_trends],
@@ -133,14 +133,14 @@ def attack_trends_service(annual_trends,monthly_trends,year):
     plt.ylabel('Number of Attacks')
     plt.xticks(rotation=45)
     plt.tight_layout()
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
-    return buf
+    return save_figure(options)
 # 6
-def attack_change_by_region_service(df,top_n):
-    df['percent_change'] = ((df['current_attacks'] - df['previous_attacks']) / df['previous_attacks'] * 100).fillna(0)
+def attack_change_by_region_service(df,top_n, options=None):
+    if df.empty:
+        return message_figure(f'Top {top_n} Regions - Attack Percentage Change', NO_MATCHING_EVENTS, options)
+    # a column of only NULLs (one year per region) arrives as objects
+    previous_attacks = df['previous_attacks'].astype(float)
+    df['percent_change'] = ((df['current_attacks'] - previous_attacks) / previous_attacks * 100).fillna(0)
     top_regions = df.groupby('region')['percent_change'].mean().abs().nlargest(top_n)
     plt.figure(figsize=(12, 6))
     plt.bar(top_regions.index, top_regions.values)
@@ -151,130 +151,47 @@ def attack_change_by_region_service(df,top_n):
     for i, v in enumerate(top_regions.values):
         plt.text(i, v, f'{v:.2f}%', ha='center', va='bottom')
     plt.tight_layout()
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
-    return buf
+    return save_figure(options)
 # 7
 def terror_heatmap_service(locations, current_year, time_period, region_filter):
-    m = create_map()
-
-    # Debug: Print incoming data
-    print(f"Received {len(locations)} locations for processing")
-
-    def is_valid_coord(lat, lon):
-        try:
-            lat, lon = float(lat), float(lon)
-            return (not isnan(lat) and not isnan(lon) and
-                    -90 <= lat <= 90 and -180 <= lon <= 180 and
-                    lat != 0 and lon != 0)  # Exclude 0,0 coordinates
-        except (ValueError, TypeError):
-            return False
-
+    # the repo only returns locations with valid coordinates
     if time_period in ['3_years', '5_years']:
-        years_data = {}
+        # one animation frame per year that has data
         years_range = range(current_year - (3 if time_period == '3_years' else 5), current_year + 1)
-
-        for year in years_range:
-            year_locations = [
-                [float(loc.latitude), float(loc.longitude), float(loc.event_count)]
-                for loc in locations
-                if loc.year == year and is_valid_coord(loc.latitude, loc.longitude)
-            ]
-            if year_locations:
-                years_data[year] = year_locations
-                print(f"Year {year}: Found {len(year_locations)} valid locations")
-
-        if years_data:
-            try:
-                plugins.HeatMapWithTime(
-                    list(years_data.values()),
-                    index=list(years_data.keys()),
-                    auto_play=True,
-                    max_opacity=0.8,
-                    radius=15
-                ).add_to(m)
-                print("Successfully added HeatMapWithTime")
-            except Exception as e:
-                print(f"Error creating time heatmap: {str(e)}")
-                # Fallback to regular heatmap
-                all_heat_data = [
-                    [float(loc.latitude), float(loc.longitude), float(loc.event_count)]
-                    for loc in locations
-                    if is_valid_coord(loc.latitude, loc.longitude)
-                ]
-                if all_heat_data:
-                    plugins.HeatMap(
-                        all_heat_data,
-                        name='Terror Hotspots',
-                        max_opacity=0.8,
-                        radius=15
-                    ).add_to(m)
-                    print("Added fallback HeatMap")
+        by_year = {year: [] for year in years_range}
+        for loc in locations:
+            if loc.year in by_year:
+                by_year[loc.year].append([float(loc.latitude), float(loc.longitude), float(loc.event_count)])
+        frames = [{'label': year, 'points': points} for year, points in by_year.items() if points]
     else:
-        heat_data = [
-            [float(loc.latitude), float(loc.longitude), float(loc.event_count)]
-            for loc in locations
-            if is_valid_coord(loc.latitude, loc.longitude)
-        ]
-        print(f"Regular heatmap: Found {len(heat_data)} valid locations")
-
-        if heat_data:
-            plugins.HeatMap(
-                heat_data,
-                name='Terror Hotspots',
-                max_opacity=0.8,
-                radius=15
-            ).add_to(m)
-            print("Added regular HeatMap")
+        points = [[float(loc.latitude), float(loc.longitude), float(loc.event_count)] for loc in locations]
+        frames = [{'label': time_period, 'points': points}] if points else []
 
-    # Add layer control
-    folium.LayerControl().add_to(m)
-
-    # Calculate stats
     total_events = sum(loc.event_count for loc in locations)
-    valid_locations = len([loc for loc in locations if is_valid_coord(loc.latitude, loc.longitude)])
-
-    stats_html = f"""
-        <div style='position: fixed; 
-                    bottom: 50px; 
-                    left: 50px; 
-                    z-index: 1000;
-                    background-color: white;
-                    padding: 10px;
-                    border: 2px solid #ccc;
-                    border-radius: 5px;'>
-            <h4>Terror Hotspots Analysis</h4>
-            <p><b>Total Events:</b> {total_events}</p>
-            <p><b>Unique Locations:</b> {valid_locations}</p>
-            <p><b>Time Period:</b> {time_period.replace('_', ' ').title()}</p>
-            {'<p><b>Region:</b> ' + region_filter + '</p>' if region_filter else ''}
-            <p style='font-size: 0.8em; color: #666;'>
-                Heatmap intensity indicates number of events
-            </p>
-        </div>
-    """
-
-    m.get_root().html.add_child(folium.Element(stats_html))
-
-    buf = io.BytesIO()
-    m.save(buf, close_file=False)
-    return buf
+    lines = [
+        ('Total Events', total_events),
+        ('Unique Locations', len(locations)),
+        ('Time Period', time_period.replace('_', ' ').title())
+    ]
+    if region_filter:
+        lines.append(('Region', region_filter))
+    return render_map('heatmap', {
+        'frames': frames,
+        'max': max((point[2] for frame in frames for point in frame['points']), default=1),
+        'summary': summary('Terror Hotspots Analysis', *lines, note='Heatmap intensity indicates number of events')
+    })
 # 8
 def active_groups_heatmap_service(results, region_filter):
-    m = create_map()
-
     regions_data = {}
     for r in results:
         if isinstance(r, dict):
             region = r['region_name']
             coords = {'lat': r['avg_lat'], 'lon': r['avg_lon']}
-            group_data = {'name': r['group_name'], 'count': r['attack_count']}
+            group_data = [r['group_name'], r['attack_count']]
         else:
             region = region_filter
             coords = {'lat': r.avg_lat, 'lon': r.avg_lon}
-            group_data = {'name': r.group_name, 'count': r.attack_count}
+            group_data = [r.group_name, r.attack_count]
 
         if region not in regions_data:
             regions_data[region] = {
@@ -283,50 +200,22 @@ def active_groups_heatmap_service(results, region_filter):
             }
         regions_data[region]['groups'].append(group_data)
 
-    for region, data in regions_data.items():
-        if data['coords']['lat'] and data['coords']['lon']:
-            popup_content = f"""
-                <div style='min-width: 250px'>
-                    <h4>Active Groups in {region}</h4>
-                    <table style='width:100%'>
-                        <tr><th>Group</th><th>Attacks</th></tr>
-                        {''.join(f"<tr><td>{g['name']}</td><td>{g['count']}</td></tr>"
-                                 for g in data['groups'])}
-                    </table>
-                </div>
-            """
-
-            folium.Marker(
-                location=[data['coords']['lat'], data['coords']['lon']],
-                popup=folium.Popup(popup_content, max_width=300),
-                tooltip=f"Top groups in {region}",
-                icon=folium.Icon(color='red', icon='info-sign')
-            ).add_to(m)
-
-    summary = f"<div style='position:fixed;bottom:50px;left:50px;background:white;padding:10px;border:2px solid #ccc;border-radius:5px;z-index:1000'>"
-    summary += f"<h4>Active Groups Analysis</h4>"
-    summary += f"<p>Showing top 5 active groups {'in ' + region_filter if region_filter else 'per region'}</p>"
-    summary += "</div>"
-
-    m.get_root().html.add_child(folium.Element(summary))
-
-    buf = io.BytesIO()
-    m.save(buf, close_file=False)
-    return buf
+    regions = [
+        [data['coords']['lat'], data['coords']['lon'], region, data['groups']]
+        for region, data in regions_data.items()
+    ]
+    scope = 'in ' + region_filter if region_filter else 'per region'
+    return render_map('region_markers', {
+        'regions': regions,
+        'summary': summary('Active Groups Analysis', (None, f"Showing top 5 active groups {scope}"))
+    })
 # 9
-def perpetrators_casualties_correlation_service(results):
+def perpetrators_casualties_correlation_service(results, options=None):
     df = pd.DataFrame(results, columns=['event_id', 'perpetrator_count', 'total_casualties'])
+    check_memory_budget('perpetrators frame')
     df = df[(df['perpetrator_count'] > 0) & (df['total_casualties'] > 0)]
     if len(df) < 2:
-        plt.figure(figsize=(10, 6))
-        plt.text(0.5, 0.5, 'Insufficient data for correlation analysis',
-                 horizontalalignment='center', verticalalignment='center')
-        plt.title('Perpetrators vs Casualties Correlation')
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        plt.close()
-        return buf
+        return message_figure('Perpetrators vs Casualties Correlation', INSUFFICIENT_DATA, options)
     try:
         correlation = df['perpetrator_count'].corr(df['total_casualties'])
     except Exception:
@@ -358,14 +247,48 @@ def perpetrators_casualties_correlation_service(results):
                  xycoords='axes fraction',
                  bbox=dict(boxstyle="round,pad=0.3", fc="white", ec="gray", alpha=0.8),
                  verticalalignment='top')
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=300, bbox_inches='tight')
-    buf.seek(0)
-    plt.close()
-    return buf
+    return save_figure(options, dpi=300, bbox_inches='tight')
+def perpetrators_casualties_density_service(stats, grid, bins, options=None):
+    if not stats.data_points or stats.data_points < 2:
+        return message_figure('Perpetrators vs Casualties Correlation', INSUFFICIENT_DATA, options)
+    correlation = float(stats.correlation or 0)
+    x_min, x_max = float(stats.min_perpetrators), float(stats.max_perpetrators)
+    y_min, y_max = float(stats.min_casualties), float(stats.max_casualties)
+    x_edges = np.linspace(x_min, x_max if x_max > x_min else x_min + 1, bins + 1)
+    y_edges = np.linspace(y_min, y_max if y_max > y_min else y_min + 1, bins + 1)
+    counts = np.zeros((bins, bins))
+    for x_bin, y_bin, event_count in grid:
+        counts[y_bin - 1, x_bin - 1] = event_count
+    plt.figure(figsize=(12, 6))
+    mesh = plt.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts, 0),
+                          cmap='viridis', norm=mcolors.LogNorm())
+    plt.colorbar(mesh, label='Events')
+    if stats.slope is not None:
+        x_line = np.linspace(x_min, x_max, 100)
+        plt.plot(x_line, float(stats.slope) * x_line + float(stats.intercept),
+                 color='red', linestyle='--', label='Trend Line')
+        plt.legend()
+    plt.title(f'Perpetrators vs Casualties Correlation\nCorrelation Coefficient: {correlation:.4f}')
+    plt.xlabel('Number of Perpetrators')
+    plt.ylabel('Total Casualties')
+    stats_text = f"""
+        Correlation: {correlation:.4f}
+        Data Points: {stats.data_points}
+        Perpetrators (Avg): {float(stats.avg_perpetrators):.2f}
+        Casualties (Avg): {float(stats.avg_casualties):.2f}
+        """
+    plt.annotate(stats_text,
+                 xy=(0.05, 0.95),
+                 xycoords='axes fraction',
+                 bbox=dict(boxstyle="round,pad=0.3", fc="white", ec="gray", alpha=0.8),
+                 verticalalignment='top')
+    return save_figure(options, dpi=300, bbox_inches='tight')
 # 10
-def events_casualties_correlation_service(results,region_name):
+def events_casualties_correlation_service(results,region_name, options=None):
     df = pd.DataFrame(results, columns=['region', 'event_count', 'total_casualties'])
+    if len(df) < 2:
+        return message_figure('Event Count vs Casualties Correlation',
+                              NO_MATCHING_EVENTS if df.empty else INSUFFICIENT_DATA, options)
     correlation = df['event_count'].corr(df['total_casualties'])
     plt.figure(figsize=(12, 8))
     scatter = plt.scatter(
@@ -392,177 +315,87 @@ def events_casualties_correlation_service(results,region_name):
                  xy=(0.05, 0.95),
                  xycoords='axes fraction',
                  bbox=dict(boxstyle="round,pad=0.3", fc="white", ec="gray", alpha=0.8))
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
-    return buf
+    return save_figure(options)
 # 11
-def groups_common_goals_service(results, region_filter=None, country_filter=None):
-    m = create_map()
+def groups_common_goals_points(results):
     location_groups = {}
     for result in results:
         group_name, target_type, region, country, count, lat, lon = result
-        if lat and lon:
-            key = (lat, lon, target_type)
-            if key not in location_groups:
-                location_groups[key] = {
-                    'groups': [],
-                    'count': 0,
-                    'region': region,
-                    'country': country,
-                    'target_type': target_type
-                }
-            location_groups[key]['groups'].append({
-                'name': group_name,
-                'attack_count': count
-            })
-            location_groups[key]['count'] += count
-    for (lat, lon, target_type), data in location_groups.items():
-        if len(data['groups']) > 1:
-            popup_html = f"""
-                <div style='min-width: 200px'>
-                    <h4>Common Target: {target_type}</h4>
-                    <p><b>Region:</b> {data['region']}</p>
-                    <p><b>Country:</b> {data['country']}</p>
-                    <p><b>Number of Groups:</b> {len(data['groups'])}</p>
-                    <p><b>Total Attacks:</b> {data['count']}</p>
-                    <hr>
-                    <h5>Groups:</h5>
-                    <ul>
-            """
-            for group in sorted(data['groups'], key=lambda x: x['attack_count'], reverse=True):
-                popup_html += f"<li>{group['name']} ({group['attack_count']} attacks)</li>"
-            popup_html += "</ul></div>"
-            folium.CircleMarker(
-                location=[lat, lon],
-                radius=min(20, len(data['groups']) * 3),
-                color='red',
-                fill=True,
-                popup=folium.Popup(popup_html, max_width=300),
-                tooltip=f"{len(data['groups'])} groups targeting {target_type}"
-            ).add_to(m)
-    summary_html = f"""
-    <div style='position: fixed; 
-                bottom: 50px; 
-                left: 50px; 
-                z-index: 1000;
-                background-color: white;
-                padding: 10px;
-                border: 2px solid #ccc;
-                border-radius: 5px;'>
-        <h4>Groups with Common Goals Analysis</h4>
-        <p>Filter: {region_filter or country_filter or 'None'}</p>
-        <p>Total locations: {len(location_groups)}</p>
-    </div>
-    """
-    m.get_root().html.add_child(folium.Element(summary_html))
-    buf = io.BytesIO()
-    m.save(buf, close_file=False)
-    return buf
+        key = (lat, lon, target_type)
+        if key not in location_groups:
+            location_groups[key] = {
+                'groups': [],
+                'count': 0,
+                'region': region,
+                'country': country
+            }
+        location_groups[key]['groups'].append([group_name, count])
+        location_groups[key]['count'] += count
+    points = [
+        [lat, lon, target_type, data['region'], data['country'], data['count'], len(data['groups']),
+         sorted(data['groups'], key=lambda group: group[1], reverse=True)]
+        for (lat, lon, target_type), data in location_groups.items()
+        if len(data['groups']) > 1
+    ]
+    return points, len(location_groups)
+def groups_common_goals_service(results, region_filter=None, country_filter=None, details_url=None):
+    # with details_url the map is clustered and group lists are fetched per marker
+    points, location_count = groups_common_goals_points(results)
+    ids = None
+    if details_url:
+        ids = [point_id('common_goals', point) for point in points]
+        points = [point[:7] for point in points]
+    return render_map('common_goals', {
+        'points': points,
+        'cluster': bool(details_url),
+        'details_url': details_url,
+        'ids': ids,
+        'summary': summary(
+            'Groups with Common Goals Analysis',
+            ('Filter', region_filter or country_filter or 'None'),
+            ('Total locations', location_count)
+        )
+    })
 # 12
-def group_activity_expansion_service(results):
-    m = create_map()
-    for group_name, expansions_json, region_count in results:
-        # Parse and validate expansions data
-        expansions = []
-        for exp_json in expansions_json:
-            try:
-                exp = json.loads(exp_json)
-                if exp['lat'] and exp['lon']:  # Only include valid coordinates
-                    expansions.append(exp)
-            except (json.JSONDecodeError, KeyError):
-                continue
-
-        if not expansions:  # Skip if no valid expansions
-            continue
-
-        # Sort by year
-        expansions.sort(key=lambda x: x['year'])
+def group_activity_expansion_service(results, cluster=False):
+    expanding_groups = []
+    groups = zip(results['group_name'], results['regions'], results['years'],
+                 results['lats'], results['lons'], results['attacks'], results['region_count'])
+    for group_name, regions, years, lats, lons, attacks, region_count in groups:
+        # Columns arrive already ordered by first year; coordinates are averaged over valid
+        # ones only and are NaN for a region with none, which counts but gets no marker
+        expansions = [
+            {'region': region, 'year': int(year), 'lat': lat, 'lon': lon, 'attacks': int(attack_count)}
+            for region, year, lat, lon, attack_count in zip(regions, years, lats, lons, attacks)
+        ]
 
         # Calculate expansion years
         expansion_years = max(exp['year'] for exp in expansions) - min(exp['year'] for exp in expansions)
 
-        # Create a feature group for this terrorist group
-        fg = folium.FeatureGroup(name=f"{group_name} ({region_count} regions)")
-
-        # Track valid coordinates for drawing lines
-        valid_coords = []
-
-        # Add markers for each location
-        for i, exp in enumerate(expansions):
-            lat, lon = exp['lat'], exp['lon']
-
-            # Create marker
-            color = f'hsl({(i * 360) // len(expansions)}, 70%, 50%)'
-            popup_html = f"""
-                <div style='min-width: 200px'>
-                    <h4>{group_name}</h4>
-                    <p><b>Region:</b> {exp['region']}</p>
-                    <p><b>Year:</b> {exp['year']}</p>
-                    <p><b>Attacks:</b> {exp['attacks']}</p>
-                    <p><b>Expansion:</b> {i + 1} of {len(expansions)}</p>
-                    <p><b>Total Regions:</b> {region_count}</p>
-                    <p><b>Years Active:</b> {expansion_years}</p>
-                </div>
-            """
-
-            folium.CircleMarker(
-                location=[lat, lon],
-                radius=10,
-                color=color,
-                fill=True,
-                popup=folium.Popup(popup_html, max_width=300),
-                tooltip=f"{group_name} - {exp['year']}",
-            ).add_to(fg)
-
-            valid_coords.append([lat, lon])
-
-            # Draw lines connecting consecutive valid points
-            if len(valid_coords) > 1:
-                # Get previous valid coordinates
-                prev_lat, prev_lon = valid_coords[-2]
-                # Draw line
-                folium.PolyLine(
-                    locations=[[prev_lat, prev_lon], [lat, lon]],
-                    color=color,
-                    weight=2,
-                    opacity=0.8,
-                    tooltip=f"{expansions[i - 1]['year']} → {exp['year']}"
-                ).add_to(fg)
-
-        fg.add_to(m)
-
-    # Add layer control
-    folium.LayerControl().add_to(m)
-
-    # Add summary information
-    summary_html = f"""
-    <div style='position: fixed; 
-                bottom: 50px; 
-                left: 50px; 
-                z-index: 1000;
-                background-color: white;
-                padding: 10px;
-                border: 2px solid #ccc;
-                border-radius: 5px;'>
-        <h4>Group Expansion Analysis</h4>
-        <p>Number of expanding groups: {len(results)}</p>
-        <p>Toggle groups using the layer control ↗</p>
-        <ul style='list-style-type: none; padding-left: 0;'>
-            <li>🔴 Marker = Activity start in region</li>
-            <li>➡️ Line = Expansion direction</li>
-            <li>🎨 Color indicates chronological order</li>
-        </ul>
-    </div>
-    """
-    m.get_root().html.add_child(folium.Element(summary_html))
-
-    buf = io.BytesIO()
-    m.save(buf, close_file=False)
-    return buf
+        expanding_groups.append({
+            'name': group_name,
+            'region_count': int(region_count),
+            'years_active': expansion_years,
+            'stops': [[exp['lat'], exp['lon'], exp['region'], exp['year'], exp['attacks']]
+                      for exp in expansions if not np.isnan(exp['lat'])]
+        })
+
+    return render_map('expansion', {
+        'groups': expanding_groups,
+        'cluster': cluster,
+        'summary': summary(
+            'Group Expansion Analysis',
+            (None, f"Number of expanding groups: {len(results['group_name'])}"),
+            (None, 'Toggle groups using the layer control ↗'),
+            (None, '🔴 Marker = Activity start in region'),
+            (None, '➡️ Line = Expansion direction'),
+            (None, '🎨 Color indicates chronological order')
+        )
+    })
 # 13
-def groups_coparticipation_service(connections):
+def groups_coparticipation_service(connections, options=None):
+    if not connections:
+        return message_figure('Top 15 Group Co-participation in Attacks', 'No groups shared an attack date', options)
     df = pd.DataFrame(connections, columns=['groups', 'count'])
     df[['group1', 'group2']] = pd.DataFrame(df['groups'].tolist(), index=df.index)
     df = df.sort_values('count', ascending=False).head(15)
@@ -577,14 +410,9 @@ def groups_coparticipation_service(connections):
         plt.text(i, v + 0.5, str(v), ha='center')
     plt.grid(axis='y', linestyle='--', alpha=0.7)
     plt.tight_layout()
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=300, bbox_inches='tight')
-    buf.seek(0)
-    plt.close()
-    return buf
+    return save_figure(options, dpi=300, bbox_inches='tight')
 # 14
 def common_attack_strategies_service(results):
-    m = create_map()
     location_data = {}
     for result in results:
         key = (result['region'], result['country'])
@@ -599,172 +427,64 @@ def common_attack_strategies_service(results):
             'total_attacks': result['total_attacks'],
             'groups': result['groups']
         }
-    valid_locations = 0
+    points = []
     skipped_locations = []
-    for (region, country), data in location_data.items():
-        location = get_locations_for_common_attacks(region, country)
-        valid_coords = (
-                location and
-                location.latitude is not None and
-                location.longitude is not None and
-                isinstance(location.latitude, (int, float)) and
-                isinstance(location.longitude, (int, float)) and
-                not isnan(location.latitude) and
-                not isnan(location.longitude)
-        )
-        if valid_coords:
-            valid_locations += 1
-            main_attack_type = max(
-                data['attack_types'].items(),
-                key=lambda x: (x[1]['num_groups'], x[1]['total_attacks'])
-            )
-            popup_content = f"""
-                <div style='min-width: 300px'>
-                    <h4>{data['location']}</h4>
-                    <p><b>Most Common Strategy:</b> {main_attack_type[0]}</p>
-                    <p><b>Groups Using This Strategy:</b> {main_attack_type[1]['num_groups']}</p>
-                    <p><b>Total Attacks:</b> {main_attack_type[1]['total_attacks']}</p>
-                    <hr>
-                    <p><b>Groups:</b></p>
-                    <ul>
-                        {''.join(f'<li>{group}</li>' for group in main_attack_type[1]['groups'])}
-                    </ul>
-                    <hr>
-                    <p><b>Other Common Strategies:</b></p>
-                    <ul>
-            """
-
-            other_attacks = sorted(
-                data['attack_types'].items(),
-                key=lambda x: (x[1]['num_groups'], x[1]['total_attacks']),
-                reverse=True
-            )[1:4]
-
-            for attack_type, attack_data in other_attacks:
-                popup_content += f"""
-                    <li>{attack_type} 
-                        ({attack_data['num_groups']} groups, 
-                        {attack_data['total_attacks']} attacks)</li>
-                """
-
-            popup_content += "</ul></div>"
-
-            radius = min(20, main_attack_type[1]['num_groups'] * 3)
-
-            try:
-                folium.CircleMarker(
-                    location=[float(location.latitude), float(location.longitude)],
-                    radius=radius,
-                    color='red',
-                    fill=True,
-                    popup=folium.Popup(popup_content, max_width=400),
-                    tooltip=f"{data['location']}: {main_attack_type[1]['num_groups']} groups using {main_attack_type[0]}"
-                ).add_to(m)
-            except (ValueError, TypeError) as e:
-                print(f"Error creating marker for {data['location']}: {str(e)}")
-                skipped_locations.append(f"{data['location']} (invalid coordinates)")
-        else:
+    locations = fan_out(*(
+        lambda key=key: get_locations_for_common_attacks(*key) for key in location_data
+    ))
+    for data, location in zip(location_data.values(), locations):
+        # get_locations_for_common_attacks only returns locations with valid coordinates
+        if location is None:
             skipped_locations.append(data['location'])
-
-    summary_html = f"""
-    <div style='position: fixed; 
-                bottom: 50px; 
-                left: 50px; 
-                z-index: 1000;
-                background-color: white;
-                padding: 10px;
-                border: 2px solid #ccc;
-                border-radius: 5px;'>
-        <h4>Common Attack Strategies Analysis</h4>
-        <p>Displayed Locations: {valid_locations} / {len(location_data)}</p>
-        <p>🔴 Marker size indicates number of groups</p>
-        <p>Click markers for detailed information</p>
-    </div>
-    """
-
-    if skipped_locations:
-        summary_html = summary_html.replace('</div>', f"""
-        <p style='font-size: 0.8em; color: #666;'>
-            Unable to map {len(skipped_locations)} location(s)
-        </p>
-        </div>
-        """)
-
-    m.get_root().html.add_child(folium.Element(summary_html))
-
-    buf = io.BytesIO()
-    m.save(buf, close_file=False)
-    return buf
+            continue
+        ranked = sorted(
+            data['attack_types'].items(),
+            key=lambda x: (x[1]['num_groups'], x[1]['total_attacks']),
+            reverse=True
+        )
+        main_type, main = ranked[0]
+        points.append([
+            float(location.latitude), float(location.longitude), data['location'],
+            main_type, main['num_groups'], main['total_attacks'], list(main['groups']),
+            [[attack_type, other['num_groups'], other['total_attacks']] for attack_type, other in ranked[1:4]]
+        ])
+
+    note = f"Unable to map {len(skipped_locations)} location(s)" if skipped_locations else None
+    return render_map('strategies', {
+        'points': points,
+        'summary': summary(
+            'Common Attack Strategies Analysis',
+            ('Displayed Locations', f"{len(points)} / {len(location_data)}"),
+            (None, '🔴 Marker size indicates number of groups'),
+            (None, 'Click markers for detailed information'),
+            note=note
+        )
+    })
 # 16
-def intergroup_activity_service(results, region_filter=None, country_filter=None):
-    m = create_map()
-    max_groups = max(result.unique_groups for result in results) if results else 1
-    for result in results:
-        if result.lat and result.lon:
-            radius = min(30, (result.unique_groups / max_groups) * 30)
-            events_per_group = result.total_events / result.unique_groups
-            color = 'red' if events_per_group > 10 else 'orange' if events_per_group > 5 else 'yellow'
-            group_list = sorted(group.strip(' "') for group in result.group_list)
-            popup_html = f"""
-                <div style='min-width: 300px'>
-                    <h4>{result.region}, {result.country}</h4>
-                    <p><b>Unique Groups:</b> {result.unique_groups}</p>
-                    <p><b>Total Events:</b> {result.total_events}</p>
-                    <p><b>Events per Group:</b> {events_per_group:.1f}</p>
-                    <hr>
-                    <p><b>Active Groups:</b></p>
-                    <div style='max-height: 200px; overflow-y: auto;'>
-                        <ul>
-                            {''.join(f'<li>{group}</li>' for group in group_list)}
-                        </ul>
-                    </div>
-                </div>
-            """
-            folium.CircleMarker(
-                location=[result.lat, result.lon],
-                radius=radius,
-                color=color,
-                fill=True,
-                popup=folium.Popup(popup_html, max_width=400),
-                tooltip=f"{result.region}, {result.country}: {result.unique_groups} groups"
-            ).add_to(m)
-    legend_html = """
-    <div style="position: fixed; 
-                bottom: 50px; 
-                right: 50px; 
-                width: 150px;
-                height: 90px; 
-                z-index: 1000;
-                background-color: white;
-                padding: 10px;
-                border: 2px solid #ccc;">
-        <p style="margin-bottom: 5px;"><b>Events per Group:</b></p>
-        <p style="margin: 2px;">
-            <span style="color: red;">●</span> > 10 events</p>
-        <p style="margin: 2px;">
-            <span style="color: orange;">●</span> 5-10 events</p>
-        <p style="margin: 2px;">
-            <span style="color: yellow;">●</span> < 5 events</p>
-    </div>
-    """
-    summary_html = f"""
-    <div style='position: fixed; 
-                bottom: 50px; 
-                left: 50px; 
-                z-index: 1000;
-                background-color: white;
-                padding: 10px;
-                border: 2px solid #ccc;
-                border-radius: 5px;'>
-        <h4>Inter-group Activity Analysis</h4>
-        <p>Total Areas: {len(results)}</p>
-        <p>⭕ Marker size = Number of unique groups</p>
-        <p>🎨 Color = Events per group ratio</p>
-        {f'<p>Filter: {region_filter or country_filter}</p>' if region_filter or country_filter else ''}
-    </div>
-    """
-    m.get_root().html.add_child(folium.Element(legend_html))
-    m.get_root().html.add_child(folium.Element(summary_html))
-    buf = io.BytesIO()
-    m.save(buf, close_file=False)
-    return buf
\ No newline at end of file
+def intergroup_activity_points(results):
+    return [
+        [result.lat, result.lon, result.region, result.country, result.unique_groups, result.total_events,
+         sorted(group.strip(' "') for group in result.group_list)]
+        for result in results
+    ]
+def intergroup_activity_service(results, region_filter=None, country_filter=None, details_url=None):
+    # with details_url the map is clustered and group lists are fetched per marker
+    points = intergroup_activity_points(results)
+    ids = None
+    if details_url:
+        ids = [point_id('intergroup', point) for point in points]
+        points = [point[:6] for point in points]
+    lines = [
+        ('Total Areas', len(results)),
+        (None, '⭕ Marker size = Number of unique groups'),
+        (None, '🎨 Color = Events per group ratio')
+    ]
+    if region_filter or country_filter:
+        lines.append(('Filter', region_filter or country_filter))
+    return render_map('intergroup', {
+        'points': points,
+        'cluster': bool(details_url),
+        'details_url': details_url,
+        'ids': ids,
+        'summary': summary('Inter-group Activity Analysis', *lines)
+    })
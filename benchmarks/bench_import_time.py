@@ -0,0 +1,74 @@
+"""Startup budget for the server process.
+
+    python -m benchmarks.bench_import_time --budget-ms 800
+
+Imports app.main in fresh interpreters, reports the median wall time and the slowest
+modules from `-X importtime`, and exits non-zero when the median exceeds the budget
+or when a heavy library is imported eagerly.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "1000"))
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'folium', 'pandas', 'numpy']
+PROBE = (
+    "import sys, app.main; "
+    f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+)
+
+
+def time_import():
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', PROBE], check=True,
+                            capture_output=True, text=True).stdout.strip()
+    return (time.perf_counter() - started) * 1000, [m for m in output.split(',') if m]
+
+
+def slowest_modules(limit):
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app.main'],
+                            check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((len(name) - len(name.lstrip()), int(cumulative), name.strip()))
+    # nested imports are indented further, keep only modules imported at the top level
+    top_level = min(indent for indent, _, _ in rows)
+    return sorted(((c, n) for indent, c, n in rows if indent == top_level), reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    timings, eager = [], set()
+    for _ in range(args.runs):
+        elapsed, loaded = time_import()
+        timings.append(elapsed)
+        eager.update(loaded)
+    median = statistics.median(timings)
+
+    print(f"import app.main: median {median:.0f} ms over {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+    for cumulative, name in slowest_modules(args.top):
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if eager:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(sorted(eager))}")
+        failed = True
+    if median > args.budget_ms:
+        print("FAIL: startup budget exceeded")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Per-call Python overhead of the hot repo queries, with and without cached statements.
+
+    python -m benchmarks.bench_query_overhead --calls 200
+
+Runs each repo in-process against PSQL_URL (seed it with benchmarks.seed_database),
+first building every query through event_query and then through the cached Core
+statements. CPU time of this process per call is the Python side of a request (query
+building, compilation, result handling); wall time also includes the database.
+Use a postgresql+psycopg:// URL to include server-side prepared statements.
+"""
+import argparse
+import statistics
+import time
+from app.repository import psql_repository, query_builder
+from app.repository.query_builder import EventFilters
+
+FILTERS = EventFilters(year_from=1990, year_to=2010)
+CALLS = {
+    'deadliest_attacks': lambda: psql_repository.deadliest_attacks_repo(5, FILTERS),
+    'top_casualty_groups': lambda: psql_repository.top_casualty_groups_repo(FILTERS),
+    'attack_target_correlation': lambda: psql_repository.attack_target_correlation_repo(FILTERS),
+    'attack_trends': lambda: psql_repository.attack_trends_repo(2000, FILTERS),
+    'events_casualties_correlation': lambda: psql_repository.events_casualties_correlation_repo(FILTERS)
+}
+
+
+def measure(call, calls, warmup):
+    for _ in range(warmup):
+        call()
+    walls = []
+    cpu_started = time.process_time()
+    for _ in range(calls):
+        started = time.perf_counter()
+        call()
+        walls.append((time.perf_counter() - started) * 1000)
+    cpu_ms = (time.process_time() - cpu_started) * 1000 / calls
+    return cpu_ms, statistics.median(walls)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--repo', choices=sorted(CALLS), nargs='*')
+    args = parser.parse_args()
+
+    print(f"{'repo':<30} {'cpu ms before':>14} {'cpu ms after':>13} {'p50 before':>11} {'p50 after':>10}")
+    for name in args.repo or CALLS:
+        results = []
+        for cached in (False, True):
+            query_builder.STATEMENT_CACHE = cached
+            results.append(measure(CALLS[name], args.calls, args.warmup))
+        (cpu_before, wall_before), (cpu_after, wall_after) = results
+        print(f"{name:<30} {cpu_before:>14.3f} {cpu_after:>13.3f} {wall_before:>11.2f} {wall_after:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Throughput of app.server for an increasing number of pre-forked workers.
+
+    python -m benchmarks.bench_workers --path /sql_stats/attack_trends --duration 10
+
+Each run starts a fresh server, warms the path in the master, then drives it with
+concurrent keep-alive-less clients and reports requests per second.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=5).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server did not come up at {url}")
+
+
+def drive(url, clients, duration):
+    deadline = time.monotonic() + duration
+
+    def client():
+        done = errors = 0
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(url, timeout=30).read()
+                done += 1
+            except OSError:
+                errors += 1
+        return done, errors
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda _: client(), range(clients)))
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def run(workers, path, clients, duration):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}{path}"
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'app.server', '--host', '127.0.0.1', '--port', str(port),
+         '--workers', str(workers), '--warm', path],
+        stdout=subprocess.DEVNULL
+    )
+    try:
+        wait_until_up(url)
+        done, errors = drive(url, clients, duration)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return done / duration, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default='/sql_stats/attack_trends')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--workers', type=int, nargs='*')
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, 2, 4, cores} & set(range(1, cores + 1)))
+    baseline = None
+    print(f"{'workers':>8} {'req/s':>10} {'speedup':>8} {'errors':>7}")
+    for workers in worker_counts:
+        throughput, errors = run(workers, args.path, args.clients, args.duration)
+        baseline = baseline or throughput
+        print(f"{workers:>8} {throughput:>10.1f} {throughput / baseline:>8.2f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Replay a weighted mix of /sql_stats requests and compare latencies with a baseline.
+
+    python -m benchmarks.seed_database --url $PSQL_URL --events 200000
+    python -m benchmarks.load_test --duration 60 --save-baseline benchmarks/baseline.json
+    python -m benchmarks.load_test --duration 60 --baseline benchmarks/baseline.json
+
+Starts app.server (or targets --url) and drives it with concurrent clients, each picking
+an endpoint by weight and drawing its parameters from distributions close to what the
+dashboards send: mostly unfiltered or single-region views, recent years, small top_n, PNG
+charts. Reports throughput and p50/p95/p99 per endpoint. With --baseline, endpoints whose
+p95 (or error rate) grew past --threshold and the overall throughput are checked, and the
+exit status is 1 when anything regressed.
+"""
+import argparse
+import json
+import math
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.bench_workers import free_port, wait_until_up
+from benchmarks.seed_database import ATTACK_TYPES, FIRST_YEAR, LAST_YEAR, REGIONS, TARGET_TYPES
+
+REGION_NAMES = list(REGIONS)
+# ignore p95 growth below this many milliseconds, fast endpoints are noisy
+MIN_REGRESSION_MS = 5.0
+
+
+def pick(rng, weighted):
+    values, weights = zip(*weighted.items())
+    return rng.choices(values, weights=weights)[0]
+
+
+def filters(rng):
+    params = {}
+    if rng.random() < 0.35:
+        params['region'] = rng.choice(REGION_NAMES)
+    if rng.random() < 0.2:
+        params['year_from'] = rng.randint(LAST_YEAR - 20, LAST_YEAR - 1)
+        params['year_to'] = rng.randint(params['year_from'], LAST_YEAR)
+    if rng.random() < 0.08:
+        params['attack_type'] = rng.choice(ATTACK_TYPES[:4])
+    if rng.random() < 0.05:
+        params['target_type'] = rng.choice(TARGET_TYPES[:5])
+    return params
+
+
+def chart(rng):
+    params = filters(rng)
+    params['format'] = pick(rng, {'png': 0.75, 'webp': 0.2, 'svg': 0.05})
+    return params
+
+
+def top_n(rng, params):
+    if rng.random() < 0.7:
+        params['top_n'] = pick(rng, {5: 0.6, 10: 0.3, 20: 0.1})
+    return params
+
+
+def a_map(rng):
+    params = filters(rng)
+    if rng.random() < 0.2:
+        params['cluster'] = 'true'
+    return params
+
+
+# name: (weight, path, params)
+MIX = {
+    'deadliest_attacks': (10, '/sql_stats/deadliest_attacks', lambda rng: top_n(rng, chart(rng))),
+    'casualties_by_region': (8, '/sql_stats/casualties_by_region', lambda rng: top_n(rng, a_map(rng))),
+    'top_casualty_groups': (8, '/sql_stats/top_casualty_groups', chart),
+    'attack_target_correlation': (5, '/sql_stats/attack_target_correlation', chart),
+    'attack_trends': (10, '/sql_stats/attack_trends',
+                      lambda rng: dict(chart(rng), year=rng.randint(LAST_YEAR - 10, LAST_YEAR))),
+    'attack_change_by_region': (5, '/sql_stats/attack_change_by_region', lambda rng: top_n(rng, chart(rng))),
+    'terror_heatmap': (8, '/sql_stats/terror_heatmap',
+                       lambda rng: dict(filters(rng), period=pick(rng, {'year': 0.5, 'month': 0.2,
+                                                                       '3_years': 0.2, '5_years': 0.1}))),
+    'active_groups_heatmap': (5, '/sql_stats/active_groups_heatmap', filters),
+    'perpetrators_casualties_correlation': (
+        4, '/sql_stats/perpetrators_casualties_correlation',
+        lambda rng: dict(chart(rng), **({'mode': 'density', 'bins': pick(rng, {50: 0.7, 100: 0.3})}
+                                        if rng.random() < 0.4 else {}))
+    ),
+    'events_casualties_correlation': (4, '/sql_stats/events_casualties_correlation', chart),
+    'groups_common_goals': (4, '/sql_stats/groups_common_goals', a_map),
+    'group_activity_expansion': (3, '/sql_stats/group_activity_expansion', a_map),
+    'groups_coparticipation': (2, '/sql_stats/groups_coparticipation', chart),
+    'common_attack_strategies': (3, '/sql_stats/common_attack_strategies', filters),
+    'intergroup_activity': (4, '/sql_stats/intergroup_activity', a_map)
+}
+
+
+def percentile(sorted_values, q):
+    # nearest rank
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def drive(base_url, clients, duration, seed, warmup):
+    names = list(MIX)
+    weights = [MIX[name][0] for name in names]
+    start = time.monotonic()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+
+    def client(index):
+        rng = random.Random(seed * 1000 + index)
+        samples = []
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights=weights)[0]
+            _, path, params = MIX[name]
+            url = f"{base_url}{path}?{urllib.parse.urlencode(params(rng))}"
+            began = time.monotonic()
+            try:
+                with urllib.request.urlopen(url, timeout=120) as response:
+                    size = len(response.read())
+                status = response.status
+            except urllib.error.HTTPError as error:
+                size, status = 0, error.code
+            except OSError:
+                size, status = 0, None
+            if began >= measure_from:
+                samples.append((name, (time.monotonic() - began) * 1000, status, size))
+        return samples
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        samples = [s for result in pool.map(client, range(clients)) for s in result]
+
+    by_endpoint = defaultdict(list)
+    for sample in samples:
+        by_endpoint[sample[0]].append(sample)
+    endpoints = {}
+    for name, rows in sorted(by_endpoint.items()):
+        latencies = sorted(latency for _, latency, _, _ in rows)
+        errors = sum(1 for _, _, status, _ in rows if status is None or status >= 500)
+        endpoints[name] = {
+            'requests': len(rows),
+            'errors': errors,
+            'error_rate': errors / len(rows),
+            'rps': len(rows) / duration,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'mean_bytes': sum(size for _, _, _, size in rows) / len(rows)
+        }
+    latencies = sorted(latency for _, latency, _, _ in samples)
+    return {
+        'duration': duration,
+        'clients': clients,
+        'seed': seed,
+        'requests': len(samples),
+        'throughput': len(samples) / duration,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'endpoints': endpoints
+    }
+
+
+def compare(result, baseline, threshold):
+    regressions = []
+    if result['throughput'] < baseline['throughput'] * (1 - threshold):
+        regressions.append(f"throughput {baseline['throughput']:.1f} -> {result['throughput']:.1f} req/s")
+    for name, current in result['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if before is None:
+            continue
+        if (current['p95_ms'] > before['p95_ms'] * (1 + threshold)
+                and current['p95_ms'] - before['p95_ms'] > MIN_REGRESSION_MS):
+            regressions.append(f"{name} p95 {before['p95_ms']:.1f} -> {current['p95_ms']:.1f} ms")
+        if current['error_rate'] > before['error_rate'] + 0.01:
+            regressions.append(f"{name} errors {before['error_rate']:.1%} -> {current['error_rate']:.1%}")
+    return regressions
+
+
+def report(result, baseline=None):
+    print(f"{'endpoint':<38} {'reqs':>6} {'err':>5} {'req/s':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'Δp95':>7}")
+    for name, stats in result['endpoints'].items():
+        before = (baseline or {}).get('endpoints', {}).get(name)
+        change = f"{stats['p95_ms'] / before['p95_ms'] - 1:+.0%}" if before and before['p95_ms'] else ''
+        print(f"{name:<38} {stats['requests']:>6} {stats['errors']:>5} {stats['rps']:>7.1f} "
+              f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f} {change:>7}")
+    if result['requests']:
+        print(f"{'total':<38} {result['requests']:>6} {'':>5} {result['throughput']:>7.1f} "
+              f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f}")
+
+
+def run(args):
+    if args.url:
+        return drive(args.url.rstrip('/'), args.clients, args.duration, args.seed, args.warmup)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'app.server', '--host', '127.0.0.1', '--port', str(port),
+         '--workers', str(args.workers)],
+        stdout=subprocess.DEVNULL
+    )
+    try:
+        wait_until_up(f"{base_url}/sql_stats/metrics")
+        return drive(base_url, args.clients, args.duration, args.seed, args.warmup)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help="target a running server instead of starting app.server")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=8200)
+    parser.add_argument('--baseline', help="compare against this baseline JSON")
+    parser.add_argument('--save-baseline', help="write this run as a baseline JSON")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative p95 growth or throughput drop counted as a regression")
+    args = parser.parse_args()
+
+    result = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+    if baseline:
+        regressions = compare(result, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
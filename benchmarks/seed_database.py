@@ -0,0 +1,165 @@
+"""Seed a local database with synthetic, GTD-shaped data for load tests.
+
+    python -m benchmarks.seed_database --url postgresql://localhost/stats_bench --events 200000
+
+Creates the schema and fills every table with deterministic data (same --seed, same
+rows): events grow over the years, a few groups and countries dominate, casualties have
+a heavy tail, and a small share of locations have missing or zero coordinates like the
+real dataset. Existing rows are removed first.
+"""
+import argparse
+import os
+import random
+
+# name: (latitude, longitude) of a rough center used to scatter locations
+REGIONS = {
+    'North America': (40.0, -100.0),
+    'Central America & Caribbean': (15.0, -85.0),
+    'South America': (-15.0, -60.0),
+    'East Asia': (35.0, 115.0),
+    'Southeast Asia': (10.0, 110.0),
+    'South Asia': (25.0, 78.0),
+    'Central Asia': (45.0, 65.0),
+    'Western Europe': (48.0, 5.0),
+    'Eastern Europe': (50.0, 30.0),
+    'Middle East & North Africa': (30.0, 35.0),
+    'Sub-Saharan Africa': (0.0, 20.0),
+    'Australasia & Oceania': (-25.0, 135.0)
+}
+ATTACK_TYPES = [
+    'Bombing/Explosion', 'Armed Assault', 'Assassination', 'Hostage Taking (Kidnapping)',
+    'Facility/Infrastructure Attack', 'Unknown', 'Unarmed Assault', 'Hostage Taking (Barricade Incident)',
+    'Hijacking'
+]
+TARGET_TYPES = [
+    'Private Citizens & Property', 'Military', 'Police', 'Government (General)', 'Business',
+    'Transportation', 'Utilities', 'Religious Figures/Institutions', 'Educational Institution',
+    'Journalists & Media', 'Unknown', 'Telecommunication', 'Airports & Aircraft', 'NGO', 'Tourists',
+    'Maritime', 'Food or Water Supply', 'Violent Political Party', 'Terrorists/Non-State Militia', 'Other'
+]
+FIRST_YEAR, LAST_YEAR = 1970, 2017
+COUNTRIES_PER_REGION = 8
+CITIES_PER_COUNTRY = 5
+CHUNK = 10_000
+
+
+def zipf_weights(n, exponent=1.1):
+    return [1 / (rank ** exponent) for rank in range(1, n + 1)]
+
+
+def insert_chunked(connection, table, rows):
+    for start in range(0, len(rows), CHUNK):
+        connection.execute(table.insert(), rows[start:start + CHUNK])
+
+
+def seed(url, events, groups, seed_value):
+    # imported here so load_test can share the value lists without the database stack
+    from sqlalchemy import create_engine, text
+    from app.db.psql.models import (AttackType, Base, Casualties, City, Country, Event, Location, Region,
+                                    TargetType, TerroristGroup)
+    rng = random.Random(seed_value)
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+
+    regions = [{'id': i, 'name': name} for i, name in enumerate(REGIONS, 1)]
+    countries, cities = [], []
+    for region in regions:
+        for n in range(COUNTRIES_PER_REGION):
+            country_id = len(countries) + 1
+            countries.append({'id': country_id, 'name': f"{region['name']} Country {n + 1}",
+                              'region_id': region['id']})
+            for c in range(CITIES_PER_COUNTRY):
+                cities.append({'id': len(cities) + 1, 'name': f"City {country_id}-{c + 1}",
+                               'province': None, 'country_id': country_id})
+    attack_types = [{'id': i, 'name': name} for i, name in enumerate(ATTACK_TYPES, 1)]
+    target_types = [{'id': i, 'name': name} for i, name in enumerate(TARGET_TYPES, 1)]
+    group_rows = [{'id': 1, 'group_name': 'Unknown'}] + [
+        {'id': i, 'group_name': f"Group {i - 1:04d}"} for i in range(2, groups + 2)
+    ]
+
+    # Each group is mostly active in one home region and one span of years
+    homes = {g['id']: rng.choice(regions)['id'] for g in group_rows}
+    spans = {}
+    for g in group_rows:
+        start = rng.randint(FIRST_YEAR, LAST_YEAR - 1)
+        spans[g['id']] = (start, min(LAST_YEAR, start + rng.randint(1, 25)))
+    countries_by_region = {r['id']: [c for c in countries if c['region_id'] == r['id']] for r in regions}
+    country_centers = {
+        c['id']: (REGIONS[regions[c['region_id'] - 1]['name']][0] + rng.uniform(-8, 8),
+                  REGIONS[regions[c['region_id'] - 1]['name']][1] + rng.uniform(-8, 8))
+        for c in countries
+    }
+    year_weights = [1 + (year - FIRST_YEAR) ** 1.5 for year in range(FIRST_YEAR, LAST_YEAR + 1)]
+    group_weights = [0.4 * sum(zipf_weights(groups))] + zipf_weights(groups)
+    attack_weights = zipf_weights(len(attack_types), 1.5)
+    target_weights = zipf_weights(len(target_types), 1.2)
+
+    locations, casualties, event_rows = [], [], []
+    for event_id in range(1, events + 1):
+        group_id = rng.choices(group_rows, weights=group_weights)[0]['id']
+        if group_id != 1 and rng.random() < 0.8:
+            region_id = homes[group_id]
+            year = rng.randint(*spans[group_id])
+        else:
+            region_id = rng.choice(regions)['id']
+            year = rng.choices(range(FIRST_YEAR, LAST_YEAR + 1), weights=year_weights)[0]
+        country = rng.choice(countries_by_region[region_id])
+        lat, lon = country_centers[country['id']]
+        coordinates = rng.random()
+        if coordinates < 0.02:
+            lat = lon = None
+        elif coordinates < 0.03:
+            lat = lon = 0.0
+        else:
+            lat, lon = round(lat + rng.gauss(0, 1.5), 6), round(lon + rng.gauss(0, 1.5), 6)
+        locations.append({
+            'id': event_id, 'latitude': lat, 'longitude': lon, 'country_id': country['id'],
+            'city_id': (country['id'] - 1) * CITIES_PER_COUNTRY + rng.randint(1, CITIES_PER_COUNTRY),
+            'region_id': region_id
+        })
+        killed = int(rng.paretovariate(1.3)) - 1 if rng.random() < 0.55 else 0
+        wounded = int(rng.paretovariate(1.2)) - 1 if rng.random() < 0.45 else 0
+        casualties.append({
+            'id': event_id,
+            'killed': None if rng.random() < 0.05 else killed,
+            'wounded': None if rng.random() < 0.08 else wounded,
+            'property_damage': rng.random() < 0.4,
+            'property_value': None
+        })
+        event_rows.append({
+            'id': event_id, 'year': year, 'month': rng.randint(1, 12), 'day': rng.randint(1, 28),
+            'summary': None, 'success': rng.random() < 0.9, 'suicide': rng.random() < 0.04,
+            'attack_type_id': rng.choices(attack_types, weights=attack_weights)[0]['id'],
+            'target_type_id': rng.choices(target_types, weights=target_weights)[0]['id'],
+            'casualties_id': event_id, 'location_id': event_id, 'group_id': group_id
+        })
+
+    tables = [(Region, regions), (Country, countries), (City, cities), (AttackType, attack_types),
+              (TargetType, target_types), (TerroristGroup, group_rows), (Location, locations),
+              (Casualties, casualties), (Event, event_rows)]
+    with engine.begin() as connection:
+        # every mapped table at once, so derived data such as the co-participation index is
+        # cleared with the rows it references (row by row deletes re-check each foreign key)
+        names = ', '.join(connection.dialect.identifier_preparer.format_table(table)
+                          for table in Base.metadata.sorted_tables)
+        connection.execute(text(f"TRUNCATE {names}"))
+        for model, rows in tables:
+            insert_chunked(connection, model.__table__, rows)
+    engine.dispose()
+    return {model.__tablename__: len(rows) for model, rows in tables}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=os.getenv("PSQL_URL"))
+    parser.add_argument('--events', type=int, default=100_000)
+    parser.add_argument('--groups', type=int, default=400)
+    parser.add_argument('--seed', type=int, default=8200)
+    args = parser.parse_args()
+    counts = seed(args.url, args.events, args.groups, args.seed)
+    for table, count in counts.items():
+        print(f"{table:>16} {count:>9}")
+
+
+if __name__ == "__main__":
+    main()
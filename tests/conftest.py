@@ -0,0 +1,46 @@
+import os
+import tempfile
+import pytest
+
+
+def _database_url():
+    # TEST_PSQL_URL points the tests at an existing (disposable) database; otherwise
+    # pgserver runs a private PostgreSQL for the session
+    url = os.getenv("TEST_PSQL_URL")
+    if url:
+        return url
+    try:
+        import pgserver
+    except ImportError:
+        return None
+    server = pgserver.get_server(tempfile.mkdtemp(prefix='stats-test-pg-'), cleanup_mode='delete')
+    return server.get_uri().replace('postgresql://', 'postgresql+psycopg://', 1)
+
+
+DATABASE_URL = _database_url()
+# app.db.psql.database creates its engines from the environment on import, so this must
+# run before any test module imports the app
+os.environ['PSQL_URL'] = DATABASE_URL or 'postgresql+psycopg://tests@localhost/unavailable'
+os.environ.setdefault('PSQL_REPLICA_URLS', '')
+os.environ.setdefault('REPOSITORY_BACKEND', 'postgres')
+os.environ.setdefault('JOB_DIR', tempfile.mkdtemp(prefix='stats-test-jobs-'))
+
+SEED_EVENTS = 3000
+SEED_GROUPS = 40
+
+
+@pytest.fixture(scope='session')
+def database():
+    if DATABASE_URL is None:
+        pytest.skip("needs TEST_PSQL_URL or pgserver")
+    from benchmarks.seed_database import seed
+    seed(DATABASE_URL, SEED_EVENTS, SEED_GROUPS, 8200)
+    return DATABASE_URL
+
+
+@pytest.fixture
+def client(database):
+    from app.main import app
+    from app.rout.http_cache import artifact_cache
+    artifact_cache.clear()
+    return app.test_client()
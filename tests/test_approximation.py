@@ -0,0 +1,51 @@
+import math
+import pytest
+from sqlalchemy import func, select
+from app.db.psql.database import session_maker
+from app.db.psql.models import Event
+from app.repository.approximation import Approximation, approximation, exactly
+from app.repository.backends import backend
+from app.repository.query_builder import event_query
+from tests.conftest import SEED_EVENTS
+from tests.test_smoke import STATS_PATHS
+
+
+@pytest.mark.parametrize('path', STATS_PATHS)
+def test_stats_route_renders_approximately(client, path):
+    response = client.get(f'{path}?approx=true&sample=20')
+    assert response.status_code == 200
+
+
+def test_events_are_sampled_independently(database):
+    with session_maker() as session:
+        sampled = session.execute(
+            select(func.count()).where(backend.sample_condition(Event.id, 20, 8200))
+        ).scalar()
+    # binomial(SEED_EVENTS, 0.2) within four standard deviations
+    assert abs(sampled - 0.2 * SEED_EVENTS) < 4 * math.sqrt(SEED_EVENTS * 0.2 * 0.8)
+
+
+def estimate_total(percent, seed):
+    sample = Approximation(percent, seed)
+    token = approximation.set(sample)
+    try:
+        with session_maker() as session:
+            row = event_query(session, measures=['casualty_score']).one()
+    finally:
+        approximation.reset(token)
+    return row, sample
+
+
+def test_sums_report_an_error_bound_that_covers_the_total(database):
+    with exactly(), session_maker() as session:
+        total = event_query(session, measures=['casualty_score']).one().casualty_score
+    covered = 0
+    for seed in range(20):
+        row, sample = estimate_total(20, seed)
+        # the sum of squares used for the bound is not part of the result
+        assert row._fields == ('casualty_score',)
+        bound = sample.error_bound()
+        assert bound is not None and bound > 0
+        covered += abs(row.casualty_score - total) <= bound * row.casualty_score
+    # a 95% bound should hold for nearly every seed
+    assert covered >= 16
@@ -0,0 +1,38 @@
+from sqlalchemy import func, select, text
+from app.db.psql.database import session_maker
+from app.db.psql.models import Event
+from app.repository.query_builder import FACT_DIMENSIONS, JOIN_ORDER, EventFilters, FactsScope, event_query, \
+    facts_scope
+
+QUERIES = [
+    (['attack_type'], ['casualty_score', 'event_count'], EventFilters()),
+    (['region'], ['event_count', 'total_casualties'], EventFilters(year_from=1990)),
+    (['group_name'], ['first_year', 'last_year', 'event_count'], EventFilters(region='South Asia'))
+]
+
+
+def test_facts_table_has_one_row_per_grouping_key(database):
+    # grouping by joined ids instead of the joined flags left one row per event, so
+    # events sharing every dimension came out as separate rows
+    key = ', '.join([*FACT_DIMENSIONS, *(f'joined_{name}' for name in JOIN_ORDER)])
+    with session_maker() as session:
+        events = session.execute(select(func.count(Event.id))).scalar()
+        facts = FactsScope().table(session)
+        rows = session.execute(text(f"SELECT count(*) FROM {facts.name}")).scalar()
+        keys = session.execute(text(f"SELECT count(*) FROM (SELECT DISTINCT {key} FROM {facts.name}) k")).scalar()
+        total = session.execute(text(f"SELECT sum(event_count) FROM {facts.name}")).scalar()
+    assert total == events
+    assert rows == keys < events
+
+
+def test_facts_queries_match_event_queries(database):
+    for dimensions, measures, filters in QUERIES:
+        with session_maker() as session:
+            expected = sorted(event_query(session, dimensions, measures, filters).all())
+        with session_maker() as session:
+            token = facts_scope.set(FactsScope())
+            try:
+                actual = sorted(event_query(session, dimensions, measures, filters, from_facts=True).all())
+            finally:
+                facts_scope.reset(token)
+        assert actual == expected
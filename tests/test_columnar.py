@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+from sqlalchemy import Float, Integer, func, literal, select, text, type_coerce
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.postgresql import ARRAY
+from app.db.psql.database import session_maker
+from app.db.psql.models import Casualties, Event
+from app.repository.columnar import FixedWidthDecoder, copy_to, fetch_columns, fixed_width_statement
+from app.repository.query_builder import event_query
+from app.rout.deadlines import is_query_canceled
+
+
+def assert_same(columns, rows, names):
+    assert list(columns) == names
+    for i, name in enumerate(names):
+        expected = [row[i] for row in rows]
+        actual = columns[name]
+        assert len(actual) == len(expected)
+        for a, e in zip(actual, expected):
+            if e is None:
+                assert a is None or (isinstance(a, float) and np.isnan(a))
+            elif isinstance(a, np.ndarray):
+                assert np.allclose(a, np.array(e, dtype=np.float64), equal_nan=True)
+            else:
+                assert a == pytest.approx(e) if isinstance(e, float) else a == e
+
+
+def test_fixed_width_columns_match_rows(database):
+    with session_maker() as session:
+        query = event_query(session, dimensions=['event_id'],
+                            measures={'perpetrator_count': 'perpetrator_count', 'total_casualties': 'casualty_score'})
+        statement = query.statement.order_by(text('event_id'))
+        columns = fetch_columns(session, statement)
+        rows = session.execute(statement).all()
+    assert isinstance(columns['event_id'], np.ndarray) and columns['event_id'].dtype == np.int64
+    assert_same(columns, rows, ['event_id', 'perpetrator_count', 'total_casualties'])
+
+
+def test_nulls_and_bools(database):
+    statement = select(
+        Event.id.label('id'),
+        Casualties.killed.label('killed'),
+        Casualties.property_value.label('value'),
+        Casualties.property_damage.label('damage'),
+        Event.success.label('success')
+    ).select_from(Event).outerjoin(Casualties, Event.casualties_id == Casualties.id).order_by(Event.id).limit(500)
+    statement = statement.union_all(select(literal(-1), literal(None, Integer), literal(None, Float),
+                                           literal(None), literal(None))).subquery()
+    statement = select(*statement.c)
+    with session_maker() as session:
+        columns = fetch_columns(session, statement)
+        rows = session.execute(statement).all()
+    assert columns['killed'].dtype == object and columns['killed'][-1] is None
+    assert np.isnan(columns['value'][-1])
+    assert_same(columns, rows, ['id', 'killed', 'value', 'damage', 'success'])
+
+
+def test_text_and_array_columns_are_fetched_as_rows(database):
+    with session_maker() as session:
+        query = event_query(session, dimensions=['region'], measures=['group_list', 'event_count'])
+        statement = query.statement.add_columns(
+            func.array_agg(Event.year).cast(ARRAY(Float)).label('years')
+        ).order_by(text('region'))
+        columns = fetch_columns(session, statement)
+        rows = session.execute(statement).all()
+    assert isinstance(columns['region'], list)
+    assert isinstance(columns['years'][0], np.ndarray)
+    assert_same(columns, rows, ['region', 'group_list', 'event_count', 'years'])
+
+
+def test_integer_arrays_keep_integer_elements(database):
+    with session_maker() as session:
+        statement = select(
+            Event.year.label('year'),
+            func.array_agg(Event.month).label('months'),
+            func.array_agg(type_coerce(func.nullif(Event.month, 1), Integer)).label('later_months'),
+            func.array_agg(Event.year).cast(ARRAY(Float)).label('years')
+        ).group_by(Event.year).order_by(Event.year)
+        columns = fetch_columns(session, statement)
+        rows = session.execute(statement).all()
+    assert all(months.dtype == np.int64 for months in columns['months'])
+    assert columns['years'][0].dtype == np.float64
+    # a NULL element keeps the integers as an object array instead of turning them into floats
+    with_null = [(months, row.later_months) for months, row in zip(columns['later_months'], rows)
+                 if None in row.later_months]
+    assert with_null
+    for months, expected in with_null:
+        assert months.dtype == object and list(months) == expected
+
+
+def test_empty_result(database):
+    with session_maker() as session:
+        columns = fetch_columns(session, select(Event.id.label('id')).where(Event.id < 0))
+    assert columns['id'].dtype == np.int64 and len(columns['id']) == 0
+
+
+def test_decoder_handles_any_chunking(database):
+    statement = select(Event.id.label('id'), Event.year.label('year')).order_by(Event.id).limit(200)
+    fixed, kinds = fixed_width_statement(statement)
+
+    class Collect:
+        payload = bytearray()
+
+        def write(self, data):
+            self.payload += data
+
+    sink = Collect()
+    with session_maker() as session:
+        copy_to(session, fixed, sink)
+        expected = fetch_columns(session, statement)
+    for size in (1, 7, 4096):
+        decoder = FixedWidthDecoder(kinds)
+        for offset in range(0, len(sink.payload), size):
+            decoder.write(bytes(sink.payload[offset:offset + size]))
+        columns = decoder.columns(['id', 'year'])
+        assert np.array_equal(columns['id'], expected['id'])
+        assert list(columns['year']) == list(expected['year'])
+
+
+def test_canceled_copy_raises_sqlalchemy_operational_error(database):
+    with session_maker() as session:
+        session.execute(text("SET LOCAL statement_timeout = 1"))
+        with pytest.raises(OperationalError) as error:
+            fetch_columns(session, select(func.pg_sleep(0.2).is_(None).label('slept'), literal(1).label('one')))
+    assert is_query_canceled(error.value)
@@ -0,0 +1,69 @@
+from itertools import combinations
+from sqlalchemy import delete, func, insert, select
+from app.db.psql.data_version import get_data_version, invalidate_data_version
+from app.db.psql.database import engine
+from app.db.psql.models import Event, TerroristGroup
+from app.repository import coparticipation_index
+from app.repository.coparticipation_index import get_coparticipation_index, refresh_coparticipation_index
+from app.repository.psql_repository import groups_coparticipation_repo
+from app.repository.query_builder import EventFilters
+
+
+def insert_undated_pair():
+    # two groups with an event each in the same month, day unknown
+    with engine.begin() as connection:
+        groups = connection.execute(
+            select(TerroristGroup.id).where(TerroristGroup.group_name != 'Unknown').order_by(TerroristGroup.id).limit(2)
+        ).scalars().all()
+        first_id = connection.execute(select(func.max(Event.id))).scalar() + 1
+        ids = [first_id, first_id + 1]
+        connection.execute(insert(Event), [
+            {'id': event_id, 'year': 2000, 'month': 1, 'day': None, 'group_id': group}
+            for event_id, group in zip(ids, groups)
+        ])
+    invalidate_data_version()
+    return ids
+
+
+def test_stale_index_is_served_while_it_is_rebuilt_in_the_background(database):
+    built = refresh_coparticipation_index()
+    ids = insert_undated_pair()
+    try:
+        assert get_coparticipation_index() is built
+        coparticipation_index._refreshing['thread'].join(30)
+        fresh = get_coparticipation_index()
+        assert fresh is not built
+        assert fresh.data_version == get_data_version()
+
+        # the filtered path applies the same complete-date rule as the index
+        filtered = groups_coparticipation_repo(EventFilters(year_from=0))
+        assert dict(filtered) == dict(fresh.top_pairs())
+    finally:
+        with engine.begin() as connection:
+            connection.execute(delete(Event).where(Event.id.in_(ids)))
+        invalidate_data_version()
+        refresh_coparticipation_index()
+
+
+def test_group_filter_counts_everyone_active_on_the_groups_dates(database, client):
+    with engine.connect() as connection:
+        rows = connection.execute(
+            select(Event.year, Event.month, Event.day, TerroristGroup.group_name).join(Event.group)
+            .where(TerroristGroup.group_name != 'Unknown', Event.year.isnot(None),
+                   Event.month.isnot(None), Event.day.isnot(None))
+        ).all()
+    dates = {}
+    for year, month, day, name in rows:
+        dates.setdefault((year, month, day), set()).add(name)
+    shared = [names for names in dates.values() if len(names) > 1]
+    group = max({name for names in shared for name in names},
+                key=lambda name: (sum(name in names for names in shared), name))
+    expected = {}
+    for names in shared:
+        if group in names:
+            for pair in combinations(sorted(names), 2):
+                expected[pair] = expected.get(pair, 0) + 1
+    assert expected
+
+    assert dict(groups_coparticipation_repo(EventFilters(group=group))) == expected
+    assert client.get('/sql_stats/groups_coparticipation', query_string={'group': group}).status_code == 200
@@ -0,0 +1,50 @@
+import pytest
+from sqlalchemy import delete, func, insert, select
+from app.db.psql.data_version import invalidate_data_version
+from app.db.psql.database import engine
+from app.db.psql.models import AttackType, Event, Location, Region, TargetType
+from app.repository import query_builder
+from app.repository.dimension_cache import get_dimension_cache
+from app.repository.psql_repository import attack_target_correlation_repo
+from app.repository.query_builder import EventFilters
+
+
+@pytest.fixture
+def duplicate_region(database):
+    # a second region with the name of an existing one, holding one event
+    with engine.begin() as connection:
+        name = connection.execute(select(Region.name).order_by(Region.id).limit(1)).scalar()
+        region_id = connection.execute(select(func.max(Region.id))).scalar() + 1
+        location_id = connection.execute(select(func.max(Location.id))).scalar() + 1
+        event_id = connection.execute(select(func.max(Event.id))).scalar() + 1
+        connection.execute(insert(Region).values(id=region_id, name=name))
+        connection.execute(insert(Location).values(id=location_id, latitude=10.0, longitude=20.0,
+                                                   region_id=region_id))
+        connection.execute(insert(Event).values(
+            id=event_id, year=2000, location_id=location_id,
+            attack_type_id=connection.execute(select(func.min(AttackType.id))).scalar(),
+            target_type_id=connection.execute(select(func.min(TargetType.id))).scalar()
+        ))
+    invalidate_data_version()
+    yield name, region_id
+    with engine.begin() as connection:
+        connection.execute(delete(Event).where(Event.id == event_id))
+        connection.execute(delete(Location).where(Location.id == location_id))
+        connection.execute(delete(Region).where(Region.id == region_id))
+    invalidate_data_version()
+
+
+@pytest.mark.parametrize('cached', [True, False])
+def test_region_filter_covers_every_region_with_the_name(duplicate_region, monkeypatch, cached):
+    name, region_id = duplicate_region
+    region_ids = get_dimension_cache().resolve('region', name)
+    assert len(region_ids) == 2 and region_id in region_ids
+    with engine.connect() as connection:
+        expected = connection.execute(
+            select(func.count(Event.id)).join(Event.location).join(Location.region)
+            .join(Event.attack_type).join(Event.target_type).where(Region.name == name)
+        ).scalar()
+
+    monkeypatch.setattr(query_builder, 'STATEMENT_CACHE', cached)
+    columns = attack_target_correlation_repo(EventFilters(region=name))
+    assert int(sum(columns['event_count'])) == expected
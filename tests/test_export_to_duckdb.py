@@ -0,0 +1,94 @@
+import os
+import pickle
+import subprocess
+import sys
+import numpy as np
+import pytest
+from sqlalchemy import select
+from app.db.psql.database import engine
+from app.db.psql.models import Base
+
+duckdb = pytest.importorskip('duckdb')
+pytest.importorskip('duckdb_engine')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def exported_path(database, tmp_path_factory):
+    from app.repository.backends import export_to_duckdb
+    path = str(tmp_path_factory.mktemp('export') / 'stats.duckdb')
+    export_to_duckdb(path, database, chunk_size=1000)
+    return path
+
+
+@pytest.fixture(scope='module')
+def exported(exported_path):
+    connection = duckdb.connect(exported_path, read_only=True)
+    yield connection
+    connection.close()
+
+
+def test_columns_keep_their_declared_types(exported):
+    types = dict(exported.execute(
+        "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = 'events'"
+    ).fetchall())
+    assert types['year'] == 'INTEGER' and types['group_id'] == 'INTEGER'
+    assert types['success'] == 'BOOLEAN'
+    latitude, = exported.execute(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = 'locations' AND column_name = 'latitude'"
+    ).fetchone()
+    assert latitude == 'DOUBLE'
+
+
+@pytest.mark.parametrize('table', ['events', 'casualties', 'locations'])
+def test_rows_match_the_source(exported, table):
+    table = Base.metadata.tables[table]
+    names = ', '.join(f'"{column.name}"' for column in table.columns)
+    with engine.connect() as connection:
+        expected = [tuple(row) for row in connection.execute(select(table).order_by(*table.primary_key.columns))]
+    actual = exported.execute(f'SELECT {names} FROM "{table.name}" ORDER BY 1').fetchall()
+    assert actual == expected
+
+
+DUCKDB_REPOS = """
+import pickle, sys
+from app.repository import psql_repository
+pickle.dump({name: getattr(psql_repository, name)() for name in sys.argv[2:]}, open(sys.argv[1], 'wb'))
+"""
+
+
+def duckdb_results(path, tmp_path, *names):
+    # the backend is chosen when the app is imported, so the DuckDB side runs in its own process
+    output = tmp_path / 'results.pickle'
+    environment = {**os.environ, 'REPOSITORY_BACKEND': 'duckdb', 'DUCKDB_PATH': path}
+    subprocess.run([sys.executable, '-c', DUCKDB_REPOS, str(output), *names],
+                   env=environment, cwd=ROOT, check=True, timeout=120)
+    with open(output, 'rb') as f:
+        return pickle.load(f)
+
+
+def test_group_expansion_matches_the_postgres_backend(exported_path, tmp_path):
+    from app.repository.psql_repository import group_activity_expansion_repo
+    expected = group_activity_expansion_repo()
+    actual = duckdb_results(exported_path, tmp_path, 'group_activity_expansion_repo')['group_activity_expansion_repo']
+    assert list(actual['group_name']) == list(expected['group_name'])
+    assert list(actual['region_count']) == list(expected['region_count'])
+    assert actual['regions'] == expected['regions']
+    for column in ('years', 'attacks'):
+        assert [row.dtype for row in actual[column]] == [row.dtype for row in expected[column]] == \
+               [np.dtype(np.int64)] * len(expected[column])
+        assert [list(row) for row in actual[column]] == [list(row) for row in expected[column]]
+
+
+def test_duckdb_list_rows_are_typed_like_postgres_arrays():
+    from app.repository.backends import DuckDBBackend
+    columns = duckdb.connect().execute(
+        "SELECT [1, 2]::INTEGER[] AS ints, [1, NULL]::INTEGER[] AS nullable, [1.5, NULL]::DOUBLE[] AS floats, "
+        "['a', NULL] AS names"
+    ).fetchnumpy()
+    ints, nullable, floats, names = (DuckDBBackend._normalize(columns[name])[0]
+                                     for name in ('ints', 'nullable', 'floats', 'names'))
+    assert ints.dtype == np.int64 and list(ints) == [1, 2]
+    assert nullable.dtype == object and list(nullable) == [1, None]
+    assert floats.dtype == np.float64 and floats[0] == 1.5 and np.isnan(floats[1])
+    assert names == ['a', None]
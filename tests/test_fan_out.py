@@ -0,0 +1,36 @@
+import os
+import signal
+import threading
+from app.repository import fan_out as fan_out_module
+from app.repository.fan_out import fan_out, shutdown_executor
+
+
+def test_fan_out_runs_calls_concurrently_in_order():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def call(value):
+        barrier.wait()
+        return value
+
+    assert fan_out(lambda: call('a'), lambda: call('b')) == ['a', 'b']
+
+
+def test_fan_out_works_in_a_forked_child():
+    # the parent's executor threads do not exist in the child
+    assert fan_out(lambda: 1, lambda: 2) == [1, 2]
+    pid = os.fork()
+    if pid == 0:
+        signal.alarm(10)
+        try:
+            os._exit(0 if fan_out(lambda: 1, lambda: 2) == [1, 2] else 1)
+        finally:
+            os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_shutdown_executor_recreates_on_next_use():
+    fan_out(lambda: 1, lambda: 2)
+    shutdown_executor()
+    assert fan_out_module._executor is None
+    assert fan_out(lambda: 1, lambda: 2) == [1, 2]
@@ -0,0 +1,71 @@
+import json
+import re
+import numpy as np
+from sqlalchemy import delete, distinct, func, insert, select
+from app.db.psql.data_version import invalidate_data_version
+from app.db.psql.database import engine, session_maker
+from app.db.psql.models import Event, Location, Region, TerroristGroup
+from app.repository.psql_repository import group_activity_expansion_repo
+from app.repository.query_builder import EventFilters
+from app.service.psql_service import group_activity_expansion_service
+
+
+def test_events_without_valid_coordinates_still_count(database):
+    with session_maker() as session:
+        # the seed data must have events the old coordinate filter dropped
+        assert session.execute(
+            select(func.count(Event.id)).join(Location).where(~Location.valid_coordinates)
+        ).scalar() > 0
+        expected = {
+            name: (regions, attacks) for name, regions, attacks in session.execute(
+                select(TerroristGroup.group_name, func.count(distinct(Region.id)), func.count(Event.id))
+                .join(Event.group).join(Event.location).join(Location.region)
+                .where(Event.year.isnot(None))
+                .group_by(TerroristGroup.group_name)
+            )
+        }
+    results = group_activity_expansion_repo()
+    assert len(results['group_name'])
+    for name, region_count, attacks, lats in zip(results['group_name'], results['region_count'],
+                                                 results['attacks'], results['lats']):
+        assert (region_count, int(sum(attacks))) == expected[name]
+        assert all(np.isnan(lat) or -90 <= lat <= 90 for lat in lats)
+
+
+def test_region_with_only_invalid_locations_counts_without_a_stop(database):
+    # a group active in two regions, mappable in the first only
+    with engine.begin() as connection:
+        regions = connection.execute(select(Region.id).order_by(Region.id).limit(2)).scalars().all()
+        # the seeded tables hold explicit ids, so new rows take the next ones by hand
+        group_id = connection.execute(select(func.max(TerroristGroup.id))).scalar() + 1
+        connection.execute(insert(TerroristGroup).values(id=group_id, group_name='Expansion Test Group'))
+        first_location = connection.execute(select(func.max(Location.id))).scalar() + 1
+        locations = [first_location, first_location + 1]
+        connection.execute(insert(Location), [
+            {'id': locations[0], 'latitude': 31.5, 'longitude': 35.0, 'region_id': regions[0]},
+            {'id': locations[1], 'latitude': 0.0, 'longitude': 0.0, 'region_id': regions[1]}
+        ])
+        first_id = connection.execute(select(func.max(Event.id))).scalar() + 1
+        ids = [first_id, first_id + 1]
+        connection.execute(insert(Event), [
+            {'id': event_id, 'year': year, 'group_id': group_id, 'location_id': location_id}
+            for event_id, year, location_id in zip(ids, (2001, 2003), locations)
+        ])
+    invalidate_data_version()
+    try:
+        results = group_activity_expansion_repo(EventFilters(group='Expansion Test Group'))
+        assert list(results['region_count']) == [2]
+        assert results['lats'][0][0] == 31.5 and np.isnan(results['lats'][0][1])
+        assert np.isnan(results['lons'][0][1])
+
+        html = group_activity_expansion_service(results).getvalue()
+        data = json.loads(re.search(rb'var DATA = (.*?);\n', html, re.S).group(1))
+        [group] = data['groups']
+        assert group['region_count'] == 2
+        assert [stop[:2] for stop in group['stops']] == [[31.5, 35.0]]
+    finally:
+        with engine.begin() as connection:
+            connection.execute(delete(Event).where(Event.id.in_(ids)))
+            connection.execute(delete(Location).where(Location.id.in_(locations)))
+            connection.execute(delete(TerroristGroup).where(TerroristGroup.id == group_id))
+        invalidate_data_version()
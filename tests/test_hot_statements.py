@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from app.repository import query_builder
+from app.repository.psql_repository import attack_target_correlation_repo, attack_trends_repo, \
+    deadliest_attacks_repo, events_casualties_correlation_repo, top_casualty_groups_repo
+from app.repository.query_builder import EventFilters
+
+FILTERS = EventFilters(year_from=1990, year_to=2015)
+HOT_CALLS = {
+    'deadliest_attacks': lambda: deadliest_attacks_repo(5, FILTERS),
+    'deadliest_attacks_unlimited': lambda: deadliest_attacks_repo(None, FILTERS),
+    'top_casualty_groups': lambda: top_casualty_groups_repo(FILTERS),
+    'attack_target_correlation': lambda: attack_target_correlation_repo(FILTERS),
+    'attack_trends': lambda: attack_trends_repo(2000, FILTERS),
+    'events_casualties_correlation': lambda: events_casualties_correlation_repo(),
+}
+
+
+def comparable(result):
+    if isinstance(result, dict):
+        return {name: [None if value is None or value != value else float(value) if isinstance(value, float)
+                       else value for value in np.asarray(values, dtype=object).tolist()]
+                for name, values in result.items()}
+    if isinstance(result, tuple):
+        return tuple(comparable(part) for part in result)
+    return [tuple(row) for row in result]
+
+
+@pytest.mark.parametrize('name', sorted(HOT_CALLS))
+def test_cached_and_per_request_statements_agree(database, monkeypatch, name):
+    monkeypatch.setattr(query_builder, 'STATEMENT_CACHE', True)
+    cached = HOT_CALLS[name]()
+    monkeypatch.setattr(query_builder, 'STATEMENT_CACHE', False)
+    per_request = HOT_CALLS[name]()
+    assert comparable(cached) == comparable(per_request)
+    # the seed data gives every query something to agree on
+    assert any(comparable(cached).values()) if isinstance(cached, dict) else all(cached)
@@ -0,0 +1,37 @@
+from datetime import datetime
+import pytest
+from app.repository import psql_repository
+from app.rout import psql_routs
+
+
+def frozen_clock(monkeypatch, year, month):
+    class Clock(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime(year, month, 15)
+    monkeypatch.setattr(psql_routs, 'datetime', Clock)
+    monkeypatch.setattr(psql_repository, 'datetime', Clock)
+
+
+@pytest.mark.parametrize('path, ticks', [
+    ('/sql_stats/attack_trends?format=svg', [(2016, 6), (2017, 6)]),
+    ('/sql_stats/terror_heatmap?period=month', [(2017, 5), (2017, 6)])
+])
+def test_defaults_from_the_clock_are_part_of_the_etag(client, monkeypatch, path, ticks):
+    etags = []
+    for year, month in ticks:
+        frozen_clock(monkeypatch, year, month)
+        response = client.get(path)
+        assert response.status_code == 200
+        etags.append(response.headers['ETag'])
+        # revalidation answers 304 only within the same period
+        assert client.get(path, headers={'If-None-Match': etags[0]}).status_code == (304 if len(etags) == 1 else 200)
+    assert etags[0] != etags[1]
+
+
+def test_an_explicit_year_shares_the_default_years_artifact(client, monkeypatch):
+    frozen_clock(monkeypatch, 2017, 6)
+    default = client.get('/sql_stats/attack_trends?format=svg')
+    explicit = client.get('/sql_stats/attack_trends?format=svg&year=2017')
+    assert default.headers['ETag'] == explicit.headers['ETag']
+    assert default.get_data() == explicit.get_data()
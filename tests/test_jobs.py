@@ -0,0 +1,30 @@
+import os
+from app.service.job_service import JOB_DIR, Job, JobManager, job_manager
+
+
+def test_a_job_is_visible_to_every_worker(client):
+    submitted = client.post('/sql_stats/jobs/groups_coparticipation', json={'format': 'svg'}).get_json()
+    status = client.get(f"{submitted['status_url']}?wait=30").get_json()
+    assert status['status'] == 'done'
+
+    # another worker process shares nothing with this one but the job directory
+    other = JobManager(JOB_DIR, 1, 200)
+    job = other.get(submitted['job_id'])
+    assert job.status == 'done' and job.mimetype == 'image/svg+xml'
+    assert other.result(job) == client.get(submitted['result_url']).get_data()
+    assert other.submit('groups_coparticipation', {'format': 'svg'}, job.data_version, None).id == job.id
+
+
+def test_a_job_whose_worker_exited_reads_as_failed_and_is_resubmitted(client):
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    orphan = Job('0' * 32, 'groups_coparticipation', {'format': 'png'}, 'orphaned', status='running', pid=pid)
+    job_manager._save(orphan)
+    job_manager._write(f"key-{orphan.key}", orphan.id.encode())
+
+    assert job_manager.get(orphan.id).status == 'failed'
+    resubmitted = job_manager.submit(orphan.analysis, orphan.params, orphan.data_version, lambda: (b'png', 'image/png'))
+    assert resubmitted.id != orphan.id
+    assert job_manager.wait(resubmitted.id, 10).status == 'done'
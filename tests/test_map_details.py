@@ -0,0 +1,35 @@
+import json
+import re
+import pytest
+from app.rout import psql_routs
+
+MAP_ENDPOINTS = ['groups_common_goals', 'intergroup_activity']
+
+
+def page_data(response):
+    return json.loads(re.search(rb'var DATA = (.*?);\n', response.get_data(), re.S).group(1))
+
+
+@pytest.mark.parametrize('endpoint', MAP_ENDPOINTS)
+def test_every_marker_finds_its_details(client, endpoint):
+    data = page_data(client.get(f'/sql_stats/{endpoint}?cluster=true'))
+    if not data['points']:
+        pytest.skip(f"the seed data has no {endpoint} markers")
+    assert len(data['ids']) == len(set(data['ids'])) == len(data['points'])
+    for item, point in zip(data['ids'], data['points']):
+        detail = client.get(f'/sql_stats/{endpoint}/details?item={item}').get_json()
+        assert detail[:len(point)] == point
+
+
+@pytest.mark.parametrize('endpoint', MAP_ENDPOINTS)
+def test_recomputed_details_keep_their_ids(client, endpoint):
+    data = page_data(client.get(f'/sql_stats/{endpoint}?cluster=true'))
+    # as in a worker that did not render the page
+    psql_routs._map_details.clear()
+    for item, point in zip(data['ids'], data['points']):
+        detail = client.get(f'/sql_stats/{endpoint}/details?item={item}').get_json()
+        assert detail[:len(point)] == point
+
+
+def test_unknown_item_is_404(client):
+    assert client.get('/sql_stats/intergroup_activity/details?item=0').status_code == 404
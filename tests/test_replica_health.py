@@ -0,0 +1,43 @@
+import socket
+import time
+from sqlalchemy import create_engine
+from app.db.psql.database import ReplicaSet, engine, replica_engine_options
+
+
+def wait_for_probes(replicas, timeout=10):
+    deadline = time.monotonic() + timeout
+    while replicas._probing and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert not replicas._probing
+
+
+def test_a_replica_that_does_not_answer_never_delays_a_read(database):
+    # accepts TCP connections but never speaks the protocol, like a hung server
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    url = f"postgresql+psycopg://postgres@127.0.0.1:{listener.getsockname()[1]}/postgres"
+    hung = create_engine(url, **replica_engine_options(url))
+    replicas = ReplicaSet(engine, [hung], interval=0)
+    try:
+        started = time.monotonic()
+        for _ in range(20):
+            assert replicas.choose() is engine
+        assert time.monotonic() - started < 0.5
+        assert len(replicas._probing) == 1
+        wait_for_probes(replicas)
+        assert replicas.status()[0]['healthy'] is False
+    finally:
+        listener.close()
+        hung.dispose()
+
+
+def test_a_replica_is_used_once_a_probe_found_it_healthy(database):
+    replica = create_engine(database, **replica_engine_options(database))
+    replicas = ReplicaSet(engine, [replica], interval=60)
+    try:
+        assert replicas.choose() is engine
+        wait_for_probes(replicas)
+        assert replicas.choose() is replica
+    finally:
+        replica.dispose()
@@ -0,0 +1,17 @@
+from sqlalchemy import func, select
+from app.db.psql.database import session_maker
+from app.db.psql.models import Event, GroupCoparticipation
+from app.repository.coparticipation_index import get_coparticipation_index
+from benchmarks.seed_database import seed
+from tests.conftest import SEED_EVENTS, SEED_GROUPS
+
+
+def test_reseeding_after_the_coparticipation_index_was_built(database):
+    get_coparticipation_index()
+    with session_maker() as session:
+        assert session.execute(select(func.count()).select_from(GroupCoparticipation)).scalar() > 0
+    counts = seed(database, SEED_EVENTS, SEED_GROUPS, 8200)
+    assert counts['events'] == SEED_EVENTS
+    with session_maker() as session:
+        assert session.execute(select(func.count(Event.id))).scalar() == SEED_EVENTS
+        assert session.execute(select(func.count()).select_from(GroupCoparticipation)).scalar() == 0
@@ -0,0 +1,44 @@
+import threading
+from app.server import RecyclingMiddleware
+
+
+def streaming_app(chunks):
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/csv')])
+        return iter(chunks)
+    return wsgi_app
+
+
+def test_streamed_response_is_active_until_closed():
+    limit_reached = threading.Event()
+    recycler = RecyclingMiddleware(streaming_app([b'a,b\n', b'1,2\n']), 1, limit_reached.set)
+    response = recycler({}, lambda status, headers: None)
+
+    # the body has not been sent yet: the worker must not drain and exit
+    assert (recycler.active, recycler.served) == (1, 0)
+    assert not limit_reached.wait(0.1)
+    assert b''.join(response) == b'a,b\n1,2\n'
+    response.close()
+
+    assert (recycler.active, recycler.served) == (0, 1)
+    assert limit_reached.wait(5)
+
+
+def test_drain_waits_for_a_response_being_streamed():
+    recycler = RecyclingMiddleware(streaming_app([b'row\n']), 10, lambda: None)
+    response = recycler({}, lambda status, headers: None)
+    threading.Timer(0.2, response.close).start()
+    recycler.drain(timeout=5)
+    assert recycler.active == 0
+
+
+def test_failed_call_is_counted_as_finished():
+    def failing_app(environ, start_response):
+        raise RuntimeError('boom')
+
+    recycler = RecyclingMiddleware(failing_app, 10, lambda: None)
+    try:
+        recycler({}, lambda status, headers: None)
+    except RuntimeError:
+        pass
+    assert (recycler.active, recycler.served) == (0, 1)
@@ -0,0 +1,39 @@
+import pytest
+
+STATS_PATHS = [
+    '/sql_stats/deadliest_attacks',
+    '/sql_stats/casualties_by_region',
+    '/sql_stats/top_casualty_groups',
+    '/sql_stats/attack_target_correlation',
+    '/sql_stats/attack_trends',
+    '/sql_stats/attack_change_by_region',
+    '/sql_stats/terror_heatmap',
+    '/sql_stats/active_groups_heatmap',
+    '/sql_stats/perpetrators_casualties_correlation',
+    '/sql_stats/events_casualties_correlation',
+    '/sql_stats/groups_common_goals',
+    '/sql_stats/group_activity_expansion',
+    '/sql_stats/groups_coparticipation',
+    '/sql_stats/common_attack_strategies',
+    '/sql_stats/intergroup_activity'
+]
+
+
+@pytest.mark.parametrize('path', STATS_PATHS)
+def test_stats_route_renders(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    assert response.get_data()
+
+
+# filters matching no events, and a single year, which leaves no year-over-year change
+@pytest.mark.parametrize('query', ['year_from=2100', 'year_from=1970&year_to=1970'])
+@pytest.mark.parametrize('path', STATS_PATHS)
+def test_stats_route_renders_narrow_filters(client, path, query):
+    response = client.get(f'{path}?{query}')
+    assert response.status_code == 200
+    assert response.get_data()
+
+
+def test_unknown_filter_name_is_404(client):
+    assert client.get('/sql_stats/deadliest_attacks?region=Atlantis').status_code == 404